@@ -21,7 +21,9 @@
 #  Oxford, United Kingdom
 # -----------------------------------------------------------------
 
-from activationmaps.coloring import getColor, showColorBar
+import numpy as np
+from activationmaps.coloring import showColorBar, saveColorBar
+from activationmaps.freesurfer import getColorTableCSV, getColorTableBlock, colorTableFromParcellation
 import activationmaps.parcellations as parc
 
 
@@ -34,9 +36,13 @@ class activationBase:
         self.parc = parcellation
         self.lastwritten = ''
 
+        # the value range of the most recent activation
+        self.simrange = (0.0, 1.0)
+
     def __fixpath(self,path):
         fixed = path
-        if fixed[-1] != '/':
+        # an empty path is left empty (rather than turned into '/')
+        if len(fixed) > 0 and fixed[-1] != '/':
             fixed = fixed + '/'
         return fixed
     
@@ -47,19 +53,54 @@ class activationBase:
         mplib, pcmap = self.parc.getCurrentMatplotlibColormapConfig()
         showColorBar(width, matplotlibcmap=mplib, cmap=pcmap)
 
-    def writeActivationCSV(self, path, filename):
-        fullpath = self.__fixpath(path) + filename + ".csv"
-        indx = self.parc.getRegionIndices()
+    # writes the colorbar currently associated with the parcellation
+    # to `filename' (e.g. 'colorbar.png' or 'colorbar.svg') without
+    # requiring a display.  The bar is labelled with the value range
+    # of the most recent activation unless minval and maxval are given.
+    # Set ticks=False to omit the labels.
+    def saveActivationColorbar(self, filename, width, minval=None, maxval=None, ticks=True):
+        mplib, pcmap = self.parc.getCurrentMatplotlibColormapConfig()
+
+        if minval is None:
+            minval = self.simrange[0]
+        if maxval is None:
+            maxval = self.simrange[1]
+
+        saveColorBar(filename, width, minval, maxval, matplotlibcmap=mplib, cmap=pcmap, ticks=ticks)
 
-        with open(fullpath, 'w') as ofile:
-            for i in indx:
-                lab = self.parc.getRegionLabel(i)
-                rgb = self.parc.getRegionRGB(i)
-                str = f"{i} {lab} {rgb[0]} {rgb[1]} {rgb[2]} 0\n"
-                ofile.write(str)
+    # writes the region labels and colors of the activation map as a
+    # color table (one "index label R G B 0" line per region) to
+    # path/filename.csv.  With binary=True Freesurfer's binary color
+    # table (as embedded in annotation files) is written to
+    # path/filename.ctab instead.
+    def writeActivationCSV(self, path, filename, binary=False):
+        if binary:
+            fullpath = self.__fixpath(path) + filename + ".ctab"
+
+            with open(fullpath, 'wb') as ofile:
+                ofile.write(getColorTableBlock(colorTableFromParcellation(self.parc)))
+        else:
+            fullpath = self.__fixpath(path) + filename + ".csv"
+
+            with open(fullpath, 'w') as ofile:
+                ofile.write(getColorTableCSV(self.parc.getRegionLabels(), self.parc.getRGBArray()))
 
         self.lastwritten = fullpath
 
+    # writes the color table (c.f. writeActivationCSV) of every frame of
+    # `frames', any iterable that sets the activation map to the next
+    # frame on every step (e.g. iterateSimulationFrames(series)).  The
+    # table of frame t is named filename + f'_{t:04d}'.  Returns the
+    # list of files written
+    def writeActivationCSVSeries(self, path, filename, frames, binary=False):
+        written = []
+
+        for t, frame in enumerate(frames):
+            self.writeActivationCSV(path, f"{filename}_{t:04d}", binary)
+            written.append(self.lastwritten)
+
+        return written
+
 
     def getLastFileWritten(self):
         return self.lastwritten
@@ -77,16 +118,11 @@ class activationBase:
     #   coincide with the colormap of the parcellation 
     #   passed into the function
     def activateFromParcellationRGB(self, parcIn, useParcColorScheme=True):
-        indxs = parcIn.getRegionIndices()
-        
         if useParcColorScheme:
             use, cmap = parcIn.getCurrentMatplotlibColormapConfig()
             self.setUseMatplotlibColorMap(use, cmap)
             
-        
-        for i in indxs:
-            rgb = parcIn.getRegionRGB(i)
-            self.parc.setRegionRGBValue(i, rgb[0], rgb[1], rgb[2])
+        self.parc.setRGBArray(parcIn.getRGBArray())
         
         
     # provides an interface for the activation classes to set the 
@@ -144,6 +180,7 @@ class activationBase:
                 parcValues[r] = 1.0
             
         self.parc.setRGBfromValueDictionary(parcValues, min=0.0, max=1.0, setMinToDefaultRGB=True)
+        self.simrange = (0.0, 1.0)
 
 
     #------------------------------------------------
@@ -187,15 +224,132 @@ class activationBase:
         minV = simMap[minkey] 
         maxV = simMap[maxkey]
         
-        parcValues = self.parc.getRegionValueDictionary(floatval=minV)
-        
-        for r in simMap:
-            if r!=minkey and r!=maxkey:
-                # the rest of the keys are parcellation regions
-                parcValues[r] = simMap[r]
-        
+        # the rest of the keys are parcellation regions
+        regionValues = dict(simMap)
+        del regionValues[minkey]
+        del regionValues[maxkey]
+
+        values = self.parc.getValueArrayFromDictionary(regionValues, floatval=minV)
+
         # set the parcellation colors for this activation
-        self.parc.setRGBfromValueDictionary(parcValues, min=minV, max=maxV, setMinToDefaultRGB=False)
+        self.parc.setRGBfromValueArray(values, min=minV, max=maxV, setMinToDefaultRGB=False)
+        self.simrange = (minV, maxV)
+
+    # sets the activation map from a dense array of simulation values
+    # ordered by region index (values[i] is the value of region i of
+    # the parcellation).  This is the array counterpart of
+    # setActivationFromSimulationResult and avoids building a
+    # simulation dictionary for every frame.
+    #
+    #   options:
+    #   simMinval, simMaxval: the global minimum and maximum of your
+    #       simulation values (c.f. getEmptySimulationMap)
+    #   setMinToDefaultRGB: set to True to color all regions whose
+    #       value equals simMinval with the default RGB color
+    #
+    # Example
+    #   myActivation.setActivationFromValueArray(myValues, simMinval=0.0, simMaxval=2.5)
+    def setActivationFromValueArray(self, values, simMinval=0.0, simMaxval=1.0, setMinToDefaultRGB=False):
+        if self.parc.setRGBfromValueArray(values, min=simMinval, max=simMaxval, setMinToDefaultRGB=setMinToDefaultRGB):
+            self.simrange = (simMinval, simMaxval)
+
+    # returns a whole simulation as a (T, nRegions) numpy array whose
+    # row t holds the region values (ordered by region index) at time t.
+    #
+    # Input series:
+    #   either a (T, nRegions) array or a dictionary whose keys are region
+    #   labels and whose values are sequences of length T (as in
+    #   simulation-activation-map-demo.py).  Regions missing from a
+    #   dictionary take the value simMinval or, if simMinval=None, the
+    #   minimum of the values provided.
+    # Returns None if the series does not fit the parcellation
+    def getSimulationSeriesArray(self, series, simMinval=None):
+        nR = self.parc.getNumberOfRegions()
+
+        if isinstance(series, dict):
+            lookup = self.parc.getRegionToIndexMap()
+            seqs = [np.asarray(series[r], dtype=float) for r in series]
+            nT = len(seqs[0]) if len(seqs) > 0 else 0
+
+            if any(seq.shape != (nT,) for seq in seqs):
+                print("All regions of a simulation series should have the same number of values")
+                return None
+
+            values = np.full((nT, nR), np.nan)
+            if len(seqs) > 0:
+                values[:, [lookup[r] for r in series]] = np.stack(seqs, axis=1)
+
+            fill = simMinval
+            if fill is None:
+                fill = np.nanmin(values) if len(seqs) > 0 else 0.0
+            values[np.isnan(values)] = fill
+        else:
+            values = np.asarray(series, dtype=float)
+
+            if values.ndim != 2 or values.shape[1] != nR:
+                print(f"Invalid simulation series of shape {values.shape}.  Expected (T, {nR})")
+                return None
+
+        return values
+
+    # a generator that yields the activation of every timestep of a
+    # simulation.  The series is colored in batches of `batchSize'
+    # timesteps (one vectorized call per batch) and frames are handed
+    # out on demand, so downstream work (e.g. exporting) can start
+    # before the whole series has been colored.
+    #
+    # Each frame is an (nRegions, 3) numpy uint8 RGB table ordered by
+    # region index.  Unless setParcellation=False the parcellation is
+    # also set to each frame before it is yielded, so the activation
+    # can be written or visualized exactly as after a call to
+    # setActivationFromSimulationResult.
+    #
+    #   options:
+    #   series: a (T, nRegions) array or a dictionary of region
+    #       sequences (c.f. getSimulationSeriesArray)
+    #   simMinval, simMaxval: the global minimum and maximum of your
+    #       simulation values.  If not given, the minimum and maximum
+    #       of the series are used
+    #   setMinToDefaultRGB: set to True to color all regions whose
+    #       value equals simMinval with the default RGB color
+    #
+    # Example
+    #   for frame in myActivation.iterateSimulationFrames(simValues, 0.0, 1.0):
+    #       vis(myActivation)
+    def iterateSimulationFrames(self, series, simMinval=None, simMaxval=None, batchSize=256,
+                                setMinToDefaultRGB=False, setParcellation=True):
+        values = self.getSimulationSeriesArray(series, simMinval)
+
+        if values is None:
+            return
+
+        if simMinval is None:
+            simMinval = float(values.min()) if values.size > 0 else 0.0
+        if simMaxval is None:
+            simMaxval = float(values.max()) if values.size > 0 else 1.0
+
+        batchSize = max(int(batchSize), 1)
+        blocks = (values[t:t + batchSize] for t in range(0, values.shape[0], batchSize))
+
+        yield from self.iterateColoredBlocks(blocks, simMinval, simMaxval, setMinToDefaultRGB, setParcellation)
+
+    # the batch coloring engine behind iterateSimulationFrames.  Takes
+    # an iterable of (t, nRegions) value blocks, colors each block in
+    # one call and yields its frames one by one
+    def iterateColoredBlocks(self, blocks, simMinval, simMaxval, setMinToDefaultRGB=False, setParcellation=True):
+        defaultRGB = self.parc.getDefaultRGB()
+
+        for block in blocks:
+            rgbs = self.parc.getColorsFromValues(block, simMinval, simMaxval)
+
+            if setMinToDefaultRGB:
+                rgbs[np.asarray(block) == simMinval] = defaultRGB
+
+            for frame in rgbs:
+                if setParcellation:
+                    self.parc.setRGBArray(frame)
+                    self.simrange = (simMinval, simMaxval)
+                yield frame
         
         
         
@@ -227,9 +381,9 @@ class activationDesikanKilliany(activationBase):
     # There is no need to specify a file extension.  Simply provide
     # a name for the file.
     # Example: writeParcellationCSV('/path/to/save/','myactivation')
-    def writeActivationCSV(self, path, filename):
+    def writeActivationCSV(self, path, filename, binary=False):
         filename = self.hemi + '.aparc.annot.ctab.' + filename
-        super().writeActivationCSV(path, filename)
+        super().writeActivationCSV(path, filename, binary)
 
 
     # Pass in the activation order of the lobes.  These should be
@@ -237,8 +391,6 @@ class activationDesikanKilliany(activationBase):
     # Example: setActivationOrder(2, 3, 1, 4)
     # means temporal --> frontal --> parietal --> occipital
     def setActivationOrder(self, frontal, parietal, temporal, occipital):
-        mplib, pcmap = self.parc.getCurrentMatplotlibColormapConfig()
-        
         if frontal not in self.actv:
             print(f"invalid activation order value {frontal} for the Frontal lobe")
         elif parietal not in self.actv:
@@ -248,19 +400,60 @@ class activationDesikanKilliany(activationBase):
         elif occipital not in self.actv:
             print(f"invalid activation order {occipital} for the Occipital lobe")
         else:
-            rgbv = getColor(frontal, 1, 4, matplotlibcmap=mplib, cmap = pcmap)
-            self.dkparc.setGroupRGB('Lobe', 'Frontal', rgbv['R'], rgbv['G'], rgbv['B'])
-
-            rgbv = getColor(parietal, 1, 4, matplotlibcmap=mplib, cmap = pcmap)
-            self.dkparc.setGroupRGB('Lobe', 'Parietal', rgbv['R'], rgbv['G'], rgbv['B'])
+            # color all four lobes in one call
+            lobes = ['Frontal', 'Parietal', 'Temporal', 'Occipital']
+            rgbs = self.dkparc.getColorsFromValues([frontal, parietal, temporal, occipital], 1, 4)
 
-            rgbv = getColor(temporal, 1, 4, matplotlibcmap=mplib, cmap = pcmap)
-            self.dkparc.setGroupRGB('Lobe', 'Temporal', rgbv['R'], rgbv['G'], rgbv['B'])
+            for lobe, rgbv in zip(lobes, rgbs.tolist()):
+                self.dkparc.setGroupRGB('Lobe', lobe, rgbv[0], rgbv[1], rgbv[2])
 
-            rgbv = getColor(occipital, 1, 4, matplotlibcmap=mplib, cmap = pcmap)
-            self.dkparc.setGroupRGB('Lobe', 'Occipital', rgbv['R'], rgbv['G'], rgbv['B'])
+            self.simrange = (1, 4)
     
     
  
 
-        
\ No newline at end of file
+        
+
+
+# Whole brain activation map holding both hemispheres of a hemisphere
+# parcellation (by default the Desikan-Killiany atlas) in one
+# parcellationBilateral.  The region labels are those of the hemisphere
+# prefixed with 'lh.' or 'rh.', e.g. 'lh.insula', so simulation maps
+# and value arrays cover both hemispheres and are colored in a single
+# call.  getHemisphereActivation returns the activation map of a single
+# hemisphere (sharing the colors) for use with the exporters, e.g.
+# offscreenVisualizeActivation.renderBilateralActivation.
+#
+# Example
+#   myActivation = activationBilateral()
+#   myActivation.setActivationFromHemisphereValues(lhValues, rhValues)
+#   renderIt.renderBilateralActivation(myActivation, '/path/to/frame0')
+class activationBilateral(activationBase):
+
+    def __init__(self, hemiParcellation=None):
+        if hemiParcellation is None:
+            hemiParcellation = parc.parcellationDesikanKillianyHemisphere()
+
+        super().__init__(parc.parcellationBilateral(hemiParcellation))
+
+        self.hemispheres = {}
+
+    # ------------
+    # Returns the activation map of the hemisphere hemistr ('lh' or
+    # 'rh').  Its parcellation is the hemisphere view of the whole brain
+    # parcellation, so it always shows the current whole brain colors.
+    def getHemisphereActivation(self, hemistr):
+        if hemistr not in self.hemispheres:
+            actv = activationBase(self.parc.getHemisphereParcellation(hemistr))
+            actv.simrange = self.simrange
+            self.hemispheres[hemistr] = actv
+
+        self.hemispheres[hemistr].simrange = self.simrange
+        return self.hemispheres[hemistr]
+
+    # ------------
+    # As setActivationFromValueArray for the separate value arrays
+    # (ordered by hemisphere region index) of the two hemispheres
+    def setActivationFromHemisphereValues(self, lhValues, rhValues, simMinval=0.0, simMaxval=1.0, setMinToDefaultRGB=False):
+        values = np.concatenate([np.asarray(lhValues, dtype=float).reshape(-1), np.asarray(rhValues, dtype=float).reshape(-1)])
+        self.setActivationFromValueArray(values, simMinval, simMaxval, setMinToDefaultRGB)
@@ -0,0 +1,269 @@
+# ----------------------------------------------------------------
+# Oxford Mathematical Brain Modelling Group
+#   This file defines a compact binary archive for the frames
+#   (region colors) of a whole activation map series
+#       1. Python v3.8 or higher
+#       2. Python numpy package
+#
+#
+#  Authors:
+#               Georgia S. Brennan          - georgia.brennan@maths.ox.ac.uk
+#               Travis B. Thompson          - thompsont@maths.ox.ac.uk
+#               Marie E. Rognes             - meg@simula.no
+#               Alain Goriely               - goriely@maths.ox.ac.uk
+#
+# Distribution
+# This code is distributed under the GNU GPL V3 License
+# https://www.gnu.org/licenses/gpl-3.0.html
+#
+#
+# Copyright (c) 2021 G.S. Brennan, A. Goriely. All rights reserved.
+#  Mathematical Institute, Oxford University
+#  Oxford, United Kingdom
+# -----------------------------------------------------------------
+
+import os
+import tempfile
+import zipfile
+import numpy as np
+from activationmaps.freesurfer import loadNpz
+
+
+# A frame archive is an uncompressed .npz file with the arrays
+#   labels:     the region labels of the parcellation
+#   colormap:   the name of the colormap ('builtin' for the default
+#               colormap of coloring.getColor)
+#   resolution: the colormap (lookup table) resolution (0 for exact)
+#   range:      the global [minimum, maximum] of the simulation
+#   rgb:        a (T, nRegions, 3) uint8 array of region colors
+# or, for palette archives, instead of rgb
+#   indices:    a (T, nRegions) uint8/uint16 array of palette indices
+#   palette:    an (nColors, 3) uint8 array of the distinct colors
+#
+# Since the archive is stored uncompressed its frame arrays are
+# memory-mapped when the archive is opened (c.f. frameArchive), so
+# any timestep is read directly from disk without parsing the others.
+
+
+# This class writes a frame archive (c.f. above) one frame at a time,
+# so series that do not fit in memory can be archived.  The frames are
+# spooled to a temporary file and copied into the archive by close.
+#
+# With palette=True every frame is stored as indices into a palette of
+# the distinct colors of the series (a colormap lookup table produces
+# at most `resolution' colors), which uses a third of the space.  At
+# most 65536 distinct colors are supported.
+#
+# Example
+#   with frameArchiveWriter('/path/to/run.npz', myParc, 0.0, 1.0) as writer:
+#       for frame in myActivation.iterateSimulationFrames(series, 0.0, 1.0):
+#           writer.addParcellationFrame(myParc)
+class frameArchiveWriter:
+
+    def __init__(self, filename, parc, simMinval=0.0, simMaxval=1.0, palette=False):
+        self.filename = filename
+        self.labels = list(parc.getRegionLabels())
+        self.nR = len(self.labels)
+        self.range = (float(simMinval), float(simMaxval))
+        self.palette = palette
+
+        usecm, cmap = parc.getCurrentMatplotlibColormapConfig()
+        self.colormap = getattr(cmap, 'name', '') if usecm else 'builtin'
+        self.resolution = 0 if parc.lutres is None else parc.lutres
+
+        self.nFrames = 0
+        self.colors = {}
+        self.spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        if exctype is None:
+            self.close()
+        else:
+            self.spool.close()
+        return False
+
+    # ------------
+    # Appends the frame with the region colors rgb (an (nRegions, 3)
+    # array ordered by region index)
+    def addFrame(self, rgb):
+        rgb = np.asarray(rgb, dtype=np.uint8).reshape(self.nR, 3)
+
+        if self.palette:
+            packed = (rgb[:, 0].astype(np.uint32) << 16) | (rgb[:, 1].astype(np.uint32) << 8) | rgb[:, 2]
+            colors, inverse = np.unique(packed, return_inverse=True)
+
+            for c in colors.tolist():
+                if c not in self.colors:
+                    if len(self.colors) == 65536:
+                        raise ValueError("A palette frame archive supports at most 65536 distinct colors")
+                    self.colors[c] = len(self.colors)
+
+            ids = np.array([self.colors[c] for c in colors.tolist()], dtype=np.uint16)
+            self.spool.write(ids[inverse.reshape(-1)].tobytes())
+        else:
+            self.spool.write(rgb.tobytes())
+
+        self.nFrames = self.nFrames + 1
+
+    # ------------
+    # Appends the current region colors of the parcellation `parc'
+    def addParcellationFrame(self, parc):
+        self.addFrame(parc.getRGBArray())
+
+    # ------------
+    def __writeArray(self, zf, name, arr):
+        with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asarray(arr), allow_pickle=False)
+
+    # ------------
+    # Copies the spooled frames into the archive member `name' as an
+    # array of the given shape and dtype (converted from spooldtype)
+    def __writeSpool(self, zf, name, shape, dtype, spooldtype, chunkSize=1 << 24):
+        self.spool.seek(0)
+        itemsize = np.dtype(spooldtype).itemsize
+
+        with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape}
+            np.lib.format.write_array_header_2_0(f, header)
+
+            while True:
+                buf = self.spool.read(chunkSize - chunkSize % itemsize)
+                if len(buf) == 0:
+                    break
+                f.write(np.frombuffer(buf, dtype=spooldtype).astype(dtype).tobytes())
+
+    # ------------
+    # Writes the archive and releases the spooled frames
+    def close(self):
+        if self.spool is None:
+            return
+
+        tmpfile = self.filename + f".{os.getpid()}.tmp"
+
+        with zipfile.ZipFile(tmpfile, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            self.__writeArray(zf, 'labels', np.array(self.labels, dtype=str))
+            self.__writeArray(zf, 'colormap', np.array(self.colormap))
+            self.__writeArray(zf, 'resolution', np.array(self.resolution, dtype=np.int64))
+            self.__writeArray(zf, 'range', np.array(self.range, dtype=np.float64))
+
+            if self.palette:
+                palette = np.zeros((len(self.colors), 3), dtype=np.uint8)
+                for c, i in self.colors.items():
+                    palette[i] = [(c >> 16) & 255, (c >> 8) & 255, c & 255]
+
+                self.__writeArray(zf, 'palette', palette)
+                dtype = np.uint8 if len(self.colors) <= 256 else np.uint16
+                self.__writeSpool(zf, 'indices', (self.nFrames, self.nR), dtype, np.uint16)
+            else:
+                self.__writeSpool(zf, 'rgb', (self.nFrames, self.nR, 3), np.uint8, np.uint8)
+
+        os.replace(tmpfile, self.filename)
+
+        self.spool.close()
+        self.spool = None
+
+
+# ------------
+# Writes the frames `frames' of the activation map `actv' to the frame
+# archive `filename'.  `frames' is any iterable that sets actv to the
+# next frame on every step, e.g. actv.iterateSimulationFrames(series).
+# simMinval and simMaxval are recorded as the range of the series.
+# Returns the number of frames written
+def writeFrameArchive(filename, actv, frames, simMinval=0.0, simMaxval=1.0, palette=False):
+    parc = actv.getParcellation()
+
+    with frameArchiveWriter(filename, parc, simMinval, simMaxval, palette) as writer:
+        for frame in frames:
+            writer.addParcellationFrame(parc)
+
+    return writer.nFrames
+
+
+# This class reads a frame archive (c.f. frameArchiveWriter).  The frame
+# arrays are memory-mapped, so opening an archive and reading any frame
+# costs the same however long the series is.
+#
+# Example
+#   archive = frameArchive('/path/to/run.npz')
+#   archive.setParcellationFrame(myActivation.getParcellation(), 120)
+#   vis(myActivation)
+class frameArchive:
+
+    def __init__(self, filename):
+        self.filename = filename
+        arrs = loadNpz(filename)
+
+        self.labels = [str(lab) for lab in arrs['labels']]
+        self.colormap = str(arrs['colormap'])
+        self.resolution = int(arrs['resolution'])
+        self.range = tuple(float(v) for v in arrs['range'])
+
+        self.rgb = arrs.get('rgb')
+        self.indices = arrs.get('indices')
+        self.palette = None if self.indices is None else np.asarray(arrs['palette'])
+
+    # ------------
+    def getNumberOfFrames(self):
+        return len(self.rgb) if self.rgb is not None else len(self.indices)
+
+    # ------------
+    def getNumberOfRegions(self):
+        return len(self.labels)
+
+    # ------------
+    def getRegionLabels(self):
+        return self.labels
+
+    # ------------
+    # Returns the name of the colormap of the series ('builtin' for the
+    # default colormap) and its lookup table resolution (0 for exact)
+    def getColormap(self):
+        return self.colormap, self.resolution
+
+    # ------------
+    # Returns the global (minimum, maximum) of the series
+    def getRange(self):
+        return self.range
+
+    # ------------
+    # Returns the (nRegions, 3) uint8 region colors of frame t
+    def getFrame(self, t):
+        if self.rgb is not None:
+            return np.asarray(self.rgb[t])
+
+        return self.palette[self.indices[t]]
+
+    # ------------
+    # Returns the (t, nRegions, 3) uint8 region colors of the
+    # frames start, ..., stop - 1
+    def getFrames(self, start=0, stop=None):
+        if self.rgb is not None:
+            return np.asarray(self.rgb[start:stop])
+
+        return self.palette[self.indices[start:stop]]
+
+    # ------------
+    # Sets the region colors of the parcellation `parc' to frame t.
+    # The parcellation should have the region labels of the archive.
+    def setParcellationFrame(self, parc, t):
+        if tuple(parc.getRegionLabels()) != tuple(self.labels):
+            print(f"The parcellation does not have the region labels of the frame archive {self.filename}")
+            return False
+
+        parc.setRGBArray(self.getFrame(t))
+        return True
+
+    # ------------
+    # A generator that sets the activation map `actv' to the frames
+    # start, ..., stop - 1 in turn and yields the frame index
+    def iterateFrames(self, actv, start=0, stop=None):
+        parc = actv.getParcellation()
+        frames = range(self.getNumberOfFrames())[start:stop]
+
+        for t in frames:
+            if not self.setParcellationFrame(parc, t):
+                return
+            yield t
@@ -0,0 +1,271 @@
+# ----------------------------------------------------------------
+# Oxford Mathematical Brain Modelling Group
+#   This file defines a driver for rendering simulation series
+#   onto a cohort of Freesurfer subjects in parallel
+#       1. Python v3.8 or higher
+#       2. Python numpy package
+#       3. Python matplotlib package
+#       4. Freesurfer v. 7 or higher (tksurfer renderer only)
+#
+#
+#  Authors:
+#               Georgia S. Brennan          - georgia.brennan@maths.ox.ac.uk
+#               Travis B. Thompson          - thompsont@maths.ox.ac.uk
+#               Marie E. Rognes             - meg@simula.no
+#               Alain Goriely               - goriely@maths.ox.ac.uk
+#
+# Distribution
+# This code is distributed under the GNU GPL V3 License
+# https://www.gnu.org/licenses/gpl-3.0.html
+#
+#
+# Copyright (c) 2021 G.S. Brennan, A. Goriely. All rights reserved.
+#  Mathematical Institute, Oxford University
+#  Oxford, United Kingdom
+# -----------------------------------------------------------------
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from activationmaps.activations import activationDesikanKilliany
+from activationmaps.simulations import simulationSeriesReader
+from activationmaps.exporting import fsVisualizeActivation, offscreenVisualizeActivation, frameCache
+
+
+# the exporter and activation map of a worker process.  They live for
+# the lifetime of the worker, so the annotations, surfaces and render
+# contexts loaded for a subject stay warm for all later jobs of the
+# worker (c.f. cohortRenderer)
+_worker = {}
+
+# ------------
+def _initWorker(config):
+    _worker.clear()
+    _worker['config'] = config
+
+    if config['renderer'] == 'tksurfer':
+        vis = fsVisualizeActivation(banner=False)
+        vis.setFreesurferPath(config['freesurferPath'])
+    else:
+        vis = offscreenVisualizeActivation()
+        vis.setImageOptions(config['size'][0], config['size'][1], config['background'])
+        vis.setSurface(config['surface'])
+
+    vis.setFreesurferSubjectPath(config['subjectPath'])
+    vis.setAnnotationCacheDirectory(config['annotationCacheDir'])
+
+    if config['frameCacheDir'] is not None:
+        vis.setFrameCache(frameCache(config['frameCacheDir']))
+
+    _worker['vis'] = vis
+    _worker['actv'] = {}
+
+# ------------
+# Returns the activation map of the hemisphere `hemi' of the worker
+def _getWorkerActivation(hemi):
+    if hemi not in _worker['actv']:
+        actv = activationDesikanKilliany(hemi)
+        config = _worker['config']
+
+        if config['cmap'] is not None:
+            actv.setUseMatplotlibColorMap(True, config['cmap'])
+
+        _worker['actv'][hemi] = actv
+
+    return _worker['actv'][hemi]
+
+# ------------
+# Passes on the frames `frames' and counts them in stats['frames']
+def _countFrames(frames, stats):
+    for t, frame in enumerate(frames):
+        stats['frames'] = t + 1
+        yield frame
+
+# ------------
+# Renders one (subject, hemi, series, name) job in a worker process.
+# Returns a dictionary with the statistics of the job.
+def _renderJob(index, subject, hemi, series, name):
+    config = _worker['config']
+    vis = _worker['vis']
+    stats = {'index': index, 'subject': subject, 'hemi': hemi, 'name': name, 'pid': os.getpid(),
+             'frames': 0, 'images': 0, 'elapsed': 0.0, 'error': None}
+
+    t0 = time.perf_counter()
+
+    try:
+        actv = _getWorkerActivation(hemi)
+        vis.setFreesurferSubjectName(subject)
+
+        outdir = os.path.join(config['outputDir'], subject, 'lh' if hemi == 'Left' else 'rh')
+        os.makedirs(outdir, exist_ok=True)
+        saveAs = os.path.join(outdir, name)
+
+        minval, maxval = config['simMinval'], config['simMaxval']
+
+        # series stored on disk are streamed by the worker
+        if isinstance(series, str):
+            frames = simulationSeriesReader(series).iterateFrames(actv, simMinval=minval, simMaxval=maxval)
+        else:
+            frames = actv.iterateSimulationFrames(series, minval, maxval)
+
+        if config['renderer'] == 'tksurfer':
+            written = vis.saveHemisphereActivationSeries(actv, _countFrames(frames, stats), saveAs, hemi, config['views'])
+        else:
+            written = []
+            for t, frame in enumerate(frames):
+                written.extend(vis.renderHemisphereActivation(actv, f"{saveAs}_{t:04d}", hemi, config['views']))
+                stats['frames'] = t + 1
+
+        stats['images'] = len(written)
+    except Exception:
+        stats['error'] = traceback.format_exc()
+
+    stats['elapsed'] = time.perf_counter() - t0
+    return stats
+
+# ------------
+# Renders the jobs `jobs' (a list of (index, subject, hemi, series, name)
+# tuples) one after the other in a worker process
+def _renderJobs(jobs):
+    return [_renderJob(*job) for job in jobs]
+
+
+# This class renders simulation series onto the Desikan-Killiany
+# parcellation of a cohort of Freesurfer subjects.  A job is the tuple
+# (subject, hemi, series) or (subject, hemi, series, name), where
+#   subject: the name of a subject in the subject directory
+#   hemi:    'Left' or 'Right' (or 'lh' or 'rh')
+#   series:  the simulation series (a dictionary or (T, nRegions) array,
+#            c.f. activationBase.iterateSimulationFrames) or the file
+#            name of a series on disk (c.f. simulationSeriesReader)
+#   name:    the prefix of the images of the job (default 'job<i>')
+#
+# The jobs are sorted by subject and hemisphere and sharded across a
+# pool of worker processes.  Each worker keeps one exporter and one
+# activation map per hemisphere alive for all of its jobs, so the
+# annotations, surfaces and render contexts of a subject are loaded
+# once per worker rather than once per job or frame.  Passing series
+# as file names avoids sending large arrays to the workers.
+#
+# The images of frame t of a job are written to
+#   outputDir/<subject>/<lh|rh>/<name>_<t>_<view>.png  (offscreen)
+#   outputDir/<subject>/<lh|rh>/<name>_<t>_<view>.tiff (tksurfer)
+#
+# Example
+#   cohort = cohortRenderer('/path/to/subjects/', '/path/to/output/', maxWorkers=8)
+#   jobs = [(s, 'Left', f'/path/to/run{r}.npy', f'run{r}') for s in subjects for r in range(100)]
+#   report = cohort.render(jobs)
+#   cohort.printReport()
+class cohortRenderer:
+
+    def __init__(self, subjectPath, outputDir, maxWorkers=None, renderer='offscreen', freesurferPath='',
+                 views=['lateral', 'medial'], surface='pial', size=(800, 600), background='white',
+                 simMinval=None, simMaxval=None, cmap=None, annotationCacheDir='', frameCacheDir=None,
+                 chunkSize=None):
+        if renderer not in ['offscreen', 'tksurfer']:
+            print(f"{renderer} is not a supported renderer.  Using the offscreen renderer")
+            renderer = 'offscreen'
+
+        self.maxWorkers = max(int(maxWorkers), 1) if maxWorkers is not None else (os.cpu_count() or 1)
+        self.chunkSize = chunkSize
+
+        self.config = {'renderer': renderer, 'freesurferPath': freesurferPath,
+                       'subjectPath': subjectPath, 'outputDir': outputDir,
+                       'views': list(views), 'surface': surface,
+                       'size': tuple(size), 'background': background,
+                       'simMinval': simMinval, 'simMaxval': simMaxval, 'cmap': cmap,
+                       'annotationCacheDir': annotationCacheDir, 'frameCacheDir': frameCacheDir}
+
+        self.report = None
+
+    # ------------
+    # Returns the jobs as (index, subject, hemi, series, name) tuples,
+    # sorted by subject and hemisphere
+    def __normalizeJobs(self, jobs):
+        res = []
+
+        for i, job in enumerate(jobs):
+            subject, hemi, series = job[:3]
+            name = job[3] if len(job) > 3 else f"job{i}"
+            hemi = 'Right' if hemi in ['Right', 'rh'] else 'Left'
+            res.append((i, subject, hemi, series, name))
+
+        return sorted(res, key=lambda job: (job[1], job[2], job[0]))
+
+    # ------------
+    # Renders the jobs `jobs' (c.f. above) and returns the throughput
+    # report (c.f. getReport)
+    def render(self, jobs):
+        jobs = self.__normalizeJobs(jobs)
+
+        # consecutive jobs of a subject go to the same worker; a few
+        # shards per worker balance the load
+        chunkSize = self.chunkSize
+        if chunkSize is None:
+            chunkSize = max(1, len(jobs) // (4 * self.maxWorkers))
+        shards = [jobs[i:i + chunkSize] for i in range(0, len(jobs), chunkSize)]
+
+        stats = []
+        t0 = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=self.maxWorkers, initializer=_initWorker, initargs=(self.config,)) as pool:
+            futures = [pool.submit(_renderJobs, shard) for shard in shards]
+
+            for future in as_completed(futures):
+                stats.extend(future.result())
+
+        wall = time.perf_counter() - t0
+        stats.sort(key=lambda s: s['index'])
+
+        self.report = self.__getReport(stats, wall)
+        return self.report
+
+    # ------------
+    def __getReport(self, stats, wall):
+        frames = sum(s['frames'] for s in stats)
+        images = sum(s['images'] for s in stats)
+
+        workers = {}
+        for s in stats:
+            w = workers.setdefault(s['pid'], {'jobs': 0, 'frames': 0, 'busy': 0.0})
+            w['jobs'] = w['jobs'] + 1
+            w['frames'] = w['frames'] + s['frames']
+            w['busy'] = w['busy'] + s['elapsed']
+
+        return {'jobs': len(stats),
+                'failed': [s for s in stats if s['error'] is not None],
+                'frames': frames,
+                'images': images,
+                'wall': wall,
+                'framesPerSecond': frames / wall if wall > 0 else 0.0,
+                'imagesPerSecond': images / wall if wall > 0 else 0.0,
+                'workers': workers,
+                'jobStats': stats}
+
+    # ------------
+    # Returns the report of the last call to render: a dictionary with
+    # the number of jobs, the failed jobs, the number of frames and
+    # images, the wall time (in seconds), the frames and images per
+    # second, the jobs/frames/busy time per worker process and the
+    # statistics of every job.  None if render has not been called.
+    def getReport(self):
+        return self.report
+
+    # ------------
+    def printReport(self):
+        if self.report is None:
+            print("No cohort has been rendered yet")
+            return
+
+        r = self.report
+        print(f"Rendered {r['jobs']} jobs ({r['frames']} frames, {r['images']} images) in {r['wall']:.2f} s")
+        print(f"   throughput: {r['framesPerSecond']:.2f} frames/s, {r['imagesPerSecond']:.2f} images/s")
+
+        for pid, w in sorted(r['workers'].items()):
+            utilization = w['busy'] / r['wall'] if r['wall'] > 0 else 0.0
+            print(f"   worker {pid}: {w['jobs']} jobs, {w['frames']} frames, {100 * utilization:.0f}% busy")
+
+        for s in r['failed']:
+            print(f"   job {s['index']} ({s['subject']}, {s['hemi']}, {s['name']}) failed:")
+            print(s['error'])
@@ -23,8 +23,12 @@
 #  Oxford, United Kingdom
 # -----------------------------------------------------------------
 
+import io
+import os
+from collections import OrderedDict
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 
 # this function gets an RGB value for a floating point value such
@@ -90,6 +94,216 @@ def getColor(value, minval, maxval, matplotlibcmap=False, cmap = None):
 
     return ret
 
+# this function is the array-based counterpart of getColor.  It
+# takes a numpy array (or list) of floating point values, of any
+# shape, such that min <= value <= max and returns a numpy uint8
+# array of shape values.shape + (3,) whose last axis holds the
+# [R, G, B] entries (0 <= R, G, B <= 255) of each value.
+#
+# The colors agree with those returned by getColor for every
+# value, but are computed in a single vectorized pass.  This
+# is the preferred route when coloring many regions (or many
+# timesteps) at once.
+#
+# The options matplotlibcmap and cmap have the same meaning
+# as they do for getColor
+def getColors(values, minval, maxval, matplotlibcmap=False, cmap = None):
+
+    # normalize values to [0,1]
+    nValues = (np.asarray(values, dtype=float) - minval) / (maxval - minval)
+
+    if matplotlibcmap:
+        # returns an RGBA value for every entry
+        rgb = cmap(nValues)[..., :3]
+    else: # the built in colormap of getColor
+        bounds = [(nValues >= 0) & (nValues <= float(1 / 8)),
+                  (nValues > float(1 / 8)) & (nValues <= float(3 / 8)),
+                  (nValues > float(3 / 8)) & (nValues <= float(5 / 8)),
+                  (nValues > float(5 / 8)) & (nValues <= float(7 / 8)),
+                  (nValues > float(7 / 8)) & (nValues <= 1.0)]
+
+        if not np.all(np.logical_or.reduce(bounds)):
+            print("Incorrect value range -- this indicates a bug in the script")
+
+        rgb = np.empty(nValues.shape + (3,))
+        rgb[..., 0] = np.select(bounds, [0, 0, 4.0 * nValues - 1.5, 1, -4 * nValues + 4.5], 0)
+        rgb[..., 1] = np.select(bounds, [0, 4 * nValues - 0.5, 1, -4 * nValues + 3.5, 0], 0)
+        rgb[..., 2] = np.select(bounds, [4 * nValues + 0.5, 1, -4 * nValues + 2.5, 0, 0], 0)
+
+    # scale to RGB values between 0 and 255 (truncating as getColor does)
+    return (rgb * 255).astype(np.uint8)
+
+# A colormap lookup table.  The colormap (either a matplotlib
+# colormap or the built in colormap of getColor) is sampled once
+# at `resolution' evenly spaced points of [0,1] and values are
+# subsequently colored by quantizing them to the nearest sample
+# and indexing the table.  This avoids calling into the colormap
+# for every colored value.
+#
+# Values outside of [min, max] are clamped to the end points of
+# the table.  Tables should normally be obtained from the bounded
+# cache through getColormapLUT(..) rather than constructed directly.
+class colormapLUT:
+
+    def __init__(self, matplotlibcmap=False, cmap=None, resolution=256):
+        self.resolution = int(resolution)
+        self.usecm = matplotlibcmap
+        self.cmap = cmap
+
+        samples = np.linspace(0.0, 1.0, num=self.resolution)
+        self.table = getColors(samples, 0.0, 1.0, matplotlibcmap, cmap)
+        self.table.setflags(write=False)
+
+    # ------------
+    # returns the table index of each entry of `values'
+    def getIndices(self, values, minval, maxval):
+        nValues = (np.asarray(values, dtype=float) - minval) / (maxval - minval)
+        idx = np.rint(nValues * (self.resolution - 1))
+        return np.clip(idx, 0, self.resolution - 1).astype(np.intp)
+
+    # ------------
+    # the table based counterpart of getColors(..)
+    def getColors(self, values, minval, maxval):
+        return self.table[self.getIndices(values, minval, maxval)]
+
+    # ------------
+    # the table based counterpart of getColor(..)
+    def getColor(self, value, minval, maxval):
+        rgb = self.getColors(value, minval, maxval).tolist()
+        return {'R': rgb[0], 'G': rgb[1], 'B': rgb[2]}
+
+
+# The LRU cache of colormap lookup tables used by getColormapLUT.
+# Entries are keyed by the identity of the colormap and the
+# resolution of the table.  The colormap is stored alongside its
+# table so that its identity can not be reused while it is cached.
+_lutCache = OrderedDict()
+_lutCacheSize = 32
+
+# Returns a (cached) colormapLUT for the given colormap options
+# and resolution.  The options matplotlibcmap and cmap have the
+# same meaning as they do for getColor
+#
+# Example
+#   lut = getColormapLUT(True, cmap=matplotlib.cm.get_cmap('jet'), resolution=4096)
+#   rgbs = lut.getColors(values, 0.0, 1.0)
+def getColormapLUT(matplotlibcmap=False, cmap=None, resolution=256):
+    key = (id(cmap) if matplotlibcmap else None, int(resolution))
+
+    if key in _lutCache:
+        _lutCache.move_to_end(key)
+        return _lutCache[key][1]
+
+    lut = colormapLUT(matplotlibcmap, cmap, resolution)
+    _lutCache[key] = (cmap, lut)
+
+    while len(_lutCache) > _lutCacheSize:
+        _lutCache.popitem(last=False)
+
+    return lut
+
+# Sets the maximum number of lookup tables held by the cache
+# used by getColormapLUT
+def setColormapLUTCacheSize(size):
+    global _lutCacheSize
+    _lutCacheSize = max(int(size), 0)
+
+    while len(_lutCache) > _lutCacheSize:
+        _lutCache.popitem(last=False)
+
+# The cache of colorbar images and rendered colorbar files used by
+# getColorBarImage and saveColorBar.  As for the lookup table cache,
+# colormaps are stored alongside their entries so that their identity
+# can not be reused while cached.
+_colorBarCache = OrderedDict()
+_colorBarCacheSize = 256
+
+def _getCachedColorBar(key):
+    if key in _colorBarCache:
+        _colorBarCache.move_to_end(key)
+        return _colorBarCache[key][1]
+    return None
+
+def _setCachedColorBar(key, cmap, value):
+    _colorBarCache[key] = (cmap, value)
+
+    while len(_colorBarCache) > _colorBarCacheSize:
+        _colorBarCache.popitem(last=False)
+
+# Sets the maximum number of entries held by the colorbar cache
+def setColorBarCacheSize(size):
+    global _colorBarCacheSize
+    _colorBarCacheSize = max(int(size), 0)
+
+    while len(_colorBarCache) > _colorBarCacheSize:
+        _colorBarCache.popitem(last=False)
+
+# returns the activation color bar as a (read only) numpy uint8
+# image of shape (length, width, 3).  The top row of the image
+# corresponds to the maximum value of the colormap.
+#
+# The options matplotlibcmap and cmap have the same meaning
+# as they do for getColor
+def getColorBarImage(width, length=1000, matplotlibcmap=False, cmap = None):
+    key = ('image', id(cmap) if matplotlibcmap else None, int(width), int(length))
+    img = _getCachedColorBar(key)
+
+    if img is None:
+        C = getColormapLUT(matplotlibcmap, cmap, int(length)).table
+        img = np.ascontiguousarray(np.broadcast_to(C[::-1, None, :], (int(length), int(width), 3)))
+        img.setflags(write=False)
+        _setCachedColorBar(key, cmap, img)
+
+    return img
+
+# writes the activation color bar to the file `filename'.  The
+# file format (e.g. png or svg) is deduced from the file extension
+# unless the option fileFormat is given.  The bar is drawn off-screen with
+# matplotlib's non-interactive backends so no display is required.
+#
+# Options:
+#   minval, maxval: the values labelled at the bottom and top of the
+#       bar (e.g. the global simulation minimum and maximum)
+#   ticks: set ticks=False to write the bar without tick labels
+#   length: the number of samples (pixels) along the bar
+#   dpi: the resolution of the written image
+#
+# The rendered file is cached per (colormap, range, size) so that
+# writing the same colorbar repeatedly only costs a file write.
+#
+# Example
+#   saveColorBar('colorbar.png', 30, minval=0.0, maxval=2.5)
+def saveColorBar(filename, width, minval=0.0, maxval=1.0, matplotlibcmap=False, cmap = None,
+                 length=1000, ticks=True, fileFormat=None, dpi=100):
+    if fileFormat is None:
+        fileFormat = os.path.splitext(filename)[1][1:].lower() or 'png'
+
+    key = ('file', id(cmap) if matplotlibcmap else None, int(width), int(length),
+           float(minval), float(maxval), bool(ticks), fileFormat, dpi)
+    data = _getCachedColorBar(key)
+
+    if data is None:
+        img = getColorBarImage(width, length, matplotlibcmap, cmap)
+
+        fig = Figure(figsize=(int(width) / dpi, int(length) / dpi), dpi=dpi)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.imshow(img, extent=(0, 1, minval, maxval), aspect='auto', interpolation='nearest')
+        ax.set_xticks([])
+
+        if ticks:
+            ax.yaxis.tick_right()
+            ax.set_yticks([minval, maxval])
+        else:
+            ax.set_yticks([])
+
+        buf = io.BytesIO()
+        fig.savefig(buf, format=fileFormat, dpi=dpi, bbox_inches='tight')
+        data = buf.getvalue()
+        _setCachedColorBar(key, cmap, data)
+
+    with open(filename, 'wb') as ofile:
+        ofile.write(data)
+
 # prints the activation color bar.
 # Input: width
 #        the integer width of the activation map color bar
@@ -101,29 +315,12 @@ def getColor(value, minval, maxval, matplotlibcmap=False, cmap = None):
 #      colormap.  Such colormaps can be obtained by using 
 #      matplotlib's get_cmap(..) function
 # c.f. https://matplotlib.org/3.1.0/tutorials/colors/colormap-manipulation.html
-
+#
+# To write the color bar to disk (without a display) use saveColorBar
 def showColorBar(width, matplotlibcmap=False, cmap = None):
-    x = np.linspace(0, 1, num=1000)
-    C = []
-    for xv in x:
-        if matplotlibcmap:
-            rgbvals = getColor(xv,0.0,1.0,matplotlibcmap, cmap)
-        else:
-            rgbvals = getColor(xv,0.0,1.0)
-        C.append([rgbvals['R'], rgbvals['G'], rgbvals['B']])
-
-    #rgb = np.array(C)/255
-
-    barlen = len(x)
-    flag = np.empty((barlen, width, 3))
-
-    extent = barlen-1
-    for n in range(barlen):
-        for w in range(width):
-            flag[n, w, :] = (C[extent-n][0]/255, C[extent-n][1]/255, C[extent-n][2]/255)
+    flag = getColorBarImage(width, 1000, matplotlibcmap, cmap)
 
     plt.xticks([])
     plt.yticks([])
     plt.imshow(flag)
     plt.show()
-
@@ -1,10 +1,10 @@
 # ----------------------------------------------------------------
 # Oxford Mathematical Brain Modelling Group
 #   This script contains utilities for exporting
-#   activation maps to freesurfer using matlab
+#   activation maps to freesurfer
 #       1. Python v3.8 or higher
 #       2. Freesurfer v. 7 or higher
-#       3. Matlab
+#       3. Python numpy package
 #
 #
 #  Authors:
@@ -24,13 +24,684 @@
 # -----------------------------------------------------------------
 
 import os
+import re
+import time
+import shlex
+import shutil
+import struct
+import hashlib
+import zipfile
+import queue
+import asyncio
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+import numpy as np
 from activationmaps.activations import *
+from matplotlib.figure import Figure
+from matplotlib.collections import PolyCollection
+from activationmaps.freesurfer import colorTable, colorTableFromParcellation, readAnnotation, readSurface, getColorTableBlock, loadNpz, saveNpz, getDefaultCacheDirectory
+from activationmaps.jobs import jobRunner
 
-# This class handles the visualization of annotated csv files using
-# freesurfer v7+ (tksurfer) and Matlab
+
+# Returns the default parent directory of export workspaces: the
+# memory backed /dev/shm when it is available and writable and the
+# system temporary directory (c.f. tempfile.gettempdir) otherwise
+def getDefaultWorkspaceDirectory():
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+
+    return tempfile.gettempdir()
+
+
+# This class is a private scratch directory for the intermediate files
+# of a single export (e.g. the annotation file handed to tksurfer).
+# Every workspace is a new, uniquely named directory, so any number of
+# exports of the same subject can run at once across threads and
+# processes without clobbering each other's files.  The directory and
+# everything in it are removed when the workspace is closed, also when
+# the export fails.
+#
+# Example
+#   with exportWorkspace() as ws:
+#       annotfile = ws.getPath('lh.aparc.annot.vis')
+#       ...
+class exportWorkspace:
+
+    def __init__(self, baseDir=None, prefix='pysurfing-'):
+        self.baseDir = getDefaultWorkspaceDirectory() if baseDir is None else baseDir
+        self.prefix = prefix
+        self.path = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.close()
+        return False
+
+    # ------------
+    # Creates the workspace directory and returns its path
+    def open(self):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self.baseDir)
+
+        return self.path
+
+    # ------------
+    # Removes the workspace directory and its contents
+    def close(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    # ------------
+    # Returns the path of the file `name' inside the workspace
+    def getPath(self, name):
+        return os.path.join(self.open(), name)
+
+
+# This class rewrites the color table and vertex labels of a base
+# annotation (e.g. label/lh.aparc.annot) for new color tables.  It is
+# the vectorized version of replace_ctab.m (copyright Dr. Anderson M.
+# Winkler, https://brainder.org): every structure of the new table is
+# looked up by name in the base table and its vertices take the new ID.
+# Vertices whose structure is not in the new table take the value 0.
+#
+# The mapping from each vertex to the entry of the new table is
+# computed once, on construction, with a single np.searchsorted pass
+# over the vertex labels.  Every rewrite afterwards is a gather, so one
+# rewriter should be reused for all frames of a run.
+#
+# Input regionLabels: the structure names of the new color tables, in
+#   order (e.g. parcellation.getRegionLabels())
+#
+# Example
+#   rw = annotationRewriter('/path/to/lh.aparc.annot', myParc.getRegionLabels())
+#   rw.writeAnnotation('/path/to/lh.aparc.annot.vis', colorTableFromParcellation(myParc))
+class annotationRewriter:
+
+    def __init__(self, annotfile, regionLabels):
+        self.regionLabels = tuple(regionLabels)
+
+        # the base annotation may also be passed as the
+        # tuple (vertices, labels, ctab) of readAnnotation
+        if isinstance(annotfile, tuple):
+            self.annotfile = ''
+            self.vertices, labels, oldctab = annotfile
+        else:
+            self.annotfile = annotfile
+            self.vertices, labels, oldctab = readAnnotation(annotfile)
+
+        # the new table entry of every old table entry (the last
+        # matching name wins, as in replace_ctab.m)
+        lookup = {name: s for s, name in enumerate(self.regionLabels)}
+        entryRegion = np.array([lookup.get(name, -1) for name in oldctab.names], dtype=np.int64)
+
+        # the new table entry of every vertex (-1 for none)
+        self.vertexRegion = np.full(len(labels), -1, dtype=np.int64)
+        self.surfaceRegions = None
+
+        if oldctab.getNumberOfEntries() > 0:
+            # look up the old table entry of every vertex label value
+            oldIds = oldctab.table[:, 4]
+            order = np.argsort(oldIds, kind='stable')
+            sortedIds = oldIds[order]
+
+            pos = np.minimum(np.searchsorted(sortedIds, labels), len(sortedIds) - 1)
+            found = sortedIds[pos] == labels
+
+            self.vertexRegion[found] = entryRegion[order[pos[found]]]
+
+        # the vertices of every region, grouped by region, so that
+        # the vertices of changed regions can be found directly
+        self.regionOrder = np.argsort(self.vertexRegion, kind='stable')
+        self.regionStarts = np.searchsorted(self.vertexRegion[self.regionOrder], np.arange(-1, len(self.regionLabels) + 1))
+
+        # the (big endian) vertex/label block of the last annotation
+        # written and the IDs of its color table
+        self.lastBlock = None
+        self.lastIds = None
+
+        # serializes the rewrites of threads sharing the rewriter
+        self.lock = threading.Lock()
+
+    # ------------
+    # Returns the (annotation order) positions of the vertices of
+    # the regions with indices `regions'
+    def getRegionVertexPositions(self, regions):
+        regions = np.asarray(regions, dtype=np.int64) + 1
+        if len(regions) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate([self.regionOrder[self.regionStarts[r]:self.regionStarts[r + 1]] for r in regions])
+
+    # ------------
+    # Returns the vertex label values for the colorTable `ctab'
+    # (whose entries are ordered as regionLabels)
+    def getLabels(self, ctab):
+        ids = np.append(ctab.table[:, 4], 0)
+        return ids[self.vertexRegion]
+
+    # ------------
+    # Returns the (big endian) vertex/label block of the annotation for
+    # the colorTable `ctab'.  Only the labels of regions whose ID changed
+    # since the previous call are rewritten; the block is reused between
+    # calls and is valid until the next call (hold the lock of the
+    # rewriter while using it when the rewriter is shared by threads).
+    def getAnnotationBlock(self, ctab):
+        ids = ctab.table[:, 4]
+
+        if self.lastBlock is None or len(ids) != len(self.lastIds):
+            self.lastBlock = np.empty((len(self.vertices), 2), dtype='>i4')
+            self.lastBlock[:, 0] = self.vertices
+            self.lastBlock[:, 1] = self.getLabels(ctab)
+        else:
+            changed = np.flatnonzero(ids != self.lastIds)
+            if len(changed) > 0:
+                pos = self.getRegionVertexPositions(changed)
+                self.lastBlock[pos, 1] = ids[self.vertexRegion[pos]]
+
+        self.lastIds = ids.copy()
+        return self.lastBlock
+
+    # ------------
+    # Returns the region (i.e. new table entry) index of every vertex
+    # of a surface with nVertices vertices (-1 for vertices without one).
+    # Returns None if the annotation does not match the surface, i.e.
+    # if it labels vertices the surface does not have.
+    def getVertexRegions(self, nVertices):
+        if self.surfaceRegions is None or len(self.surfaceRegions) != int(nVertices):
+            if len(self.vertices) > 0 and (self.vertices.min() < 0 or self.vertices.max() >= int(nVertices)):
+                print(f"The annotation does not match the surface: it labels vertex {int(self.vertices.max())} of a surface with {int(nVertices)} vertices")
+                return None
+
+            self.surfaceRegions = np.full(int(nVertices), -1, dtype=np.int64)
+            self.surfaceRegions[self.vertices] = self.vertexRegion
+
+        return self.surfaceRegions
+
+    # ------------
+    # Writes the annotation with the colorTable `ctab' to `newannotfile'
+    def writeAnnotation(self, newannotfile, ctab):
+        with self.lock:
+            block = self.getAnnotationBlock(ctab).tobytes()
+
+        with open(newannotfile, 'wb') as ofile:
+            ofile.write(struct.pack('>i', len(self.vertices)))
+            ofile.write(block)
+            ofile.write(struct.pack('>i', 1))
+            ofile.write(getColorTableBlock(ctab))
+
+
+# Replaces the color table of the annotation file `oldannotfile'
+# with the colorTable `ctab' and saves the result as `newannotfile'
+# (the Python version of replace_ctab.m).  Use an annotationRewriter
+# directly when rewriting the same annotation many times.
+def replaceColorTable(oldannotfile, ctab, newannotfile):
+    annotationRewriter(oldannotfile, ctab.names).writeAnnotation(newannotfile, ctab)
+
+# This class caches the parsed base annotations of Freesurfer subjects
+# (e.g. <subject>/label/lh.aparc.annot) per (subject, hemisphere) so
+# that they are read only once per run.  The vertex labels and color
+# table of every annotation stay resident in memory along with the
+# annotationRewriters built on them, so only the color table and the
+# label IDs are regenerated per frame.
+#
+# Parsed annotations are also stored in an on-disk .npz cache, so a
+# new process for the same subject starts warm.  Cached arrays are
+# memory-mapped from the cache file.  A cache entry is discarded when
+# the annotation file changes.  The cache directory defaults to
+# $XDG_CACHE_HOME/pysurfing (or ~/.cache/pysurfing); use
+# cacheDir=None to keep the cache in memory only.
+class annotationCache:
+
+    def __init__(self, cacheDir=''):
+        if cacheDir == '':
+            cacheDir = getDefaultCacheDirectory()
+
+        self.cacheDir = cacheDir
+        self.annotations = {}
+        self.rewriters = {}
+
+        # the cache may be shared by the threads of parallel exports
+        self.lock = threading.RLock()
+
+    # ------------
+    def __getCacheFile(self, annotfile):
+        digest = hashlib.sha1(os.path.abspath(annotfile).encode()).hexdigest()
+        return os.path.join(self.cacheDir, f"annot-{digest}.npz")
+
+    # ------------
+    def __loadCacheFile(self, annotfile, stamp):
+        cachefile = self.__getCacheFile(annotfile)
+
+        if not os.path.exists(cachefile):
+            return None
+
+        try:
+            arrs = loadNpz(cachefile)
+            if tuple(arrs['stamp'].tolist()) != stamp:
+                return None
+
+            ctab = colorTable(arrs['names'].tolist(), arrs['rgbt'], arrs['ids'], arrs['origTab'].tolist())
+            return arrs['vertices'], arrs['labels'], ctab
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+
+    # ------------
+    def __saveCacheFile(self, annotfile, stamp, annotation):
+        vertices, labels, ctab = annotation
+        cachefile = self.__getCacheFile(annotfile)
+
+        try:
+            saveNpz(cachefile, stamp=np.array(stamp, dtype=np.int64), vertices=vertices, labels=labels,
+                    names=np.array(ctab.names, dtype=str), rgbt=ctab.table[:, :4], ids=ctab.ids,
+                    origTab=np.array(ctab.origTab))
+        except OSError:
+            print(f"Unable to write the annotation cache file {cachefile}")
+
+    # ------------
+    # Returns the parsed annotation file `annotfile' as the tuple
+    # (vertices, labels, ctab) of freesurfer.readAnnotation
+    def getAnnotationFile(self, annotfile):
+        with self.lock:
+            st = os.stat(annotfile)
+            stamp = (st.st_mtime_ns, st.st_size)
+            key = os.path.abspath(annotfile)
+
+            entry = self.annotations.get(key)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+
+            annotation = None
+            if self.cacheDir is not None:
+                annotation = self.__loadCacheFile(annotfile, stamp)
+
+            if annotation is None:
+                annotation = readAnnotation(annotfile)
+                if self.cacheDir is not None:
+                    self.__saveCacheFile(annotfile, stamp, annotation)
+
+            self.annotations[key] = (stamp, annotation)
+
+            # rewriters built on an older version of the file are stale
+            for rkey in [k for k in self.rewriters if k[0] == key and self.rewriters[k][0] != stamp]:
+                del self.rewriters[rkey]
+
+            return annotation
+
+    # ------------
+    # Returns the parsed base annotation (c.f. getAnnotationFile) of
+    # the hemisphere hemistr ('lh' or 'rh') of the subject `subject'
+    # in the subject directory subjectPath
+    def getAnnotation(self, subjectPath, subject, hemistr, annot='aparc'):
+        return self.getAnnotationFile(os.path.join(subjectPath, subject, 'label', f"{hemistr}.{annot}.annot"))
+
+    # ------------
+    # Returns the (resident) annotationRewriter of the annotation file
+    # `annotfile' for the region labels regionLabels
+    def getRewriterFile(self, annotfile, regionLabels):
+        with self.lock:
+            annotation = self.getAnnotationFile(annotfile)
+            stamp = self.annotations[os.path.abspath(annotfile)][0]
+            key = (os.path.abspath(annotfile), tuple(regionLabels))
+
+            if key not in self.rewriters:
+                self.rewriters[key] = (stamp, annotationRewriter(annotation, regionLabels))
+
+            return self.rewriters[key][1]
+
+    # ------------
+    # As getRewriterFile for the base annotation of a subject hemisphere
+    def getRewriter(self, subjectPath, subject, hemistr, regionLabels, annot='aparc'):
+        return self.getRewriterFile(os.path.join(subjectPath, subject, 'label', f"{hemistr}.{annot}.annot"), regionLabels)
+
+
+# A content addressed disk cache of exported frames (annotation files
+# and images).  Frames are keyed by a hash of everything that determines
+# their content: the atlas, the subject (and the version of its base
+# annotation and surface files), the hemisphere, the RGB table, the
+# colormap and the view (c.f. getFrameKey).  Repeated frames, e.g.
+# the earlier stages re-included by appendPrior, revisited parameter
+# sweeps or reruns, are then copied from the cache instead of being
+# generated again.
+#
+# The total size of the cache is capped at maxBytes; the least recently
+# used frames are evicted first.  Only the frames of the cache (files
+# named <key>.<kind>, c.f. getFrameKey) are counted and evicted, so other
+# files in the cache directory are never removed.
+#
+# Example
+#   cache = frameCache('/path/to/cache', maxBytes=2*1024**3)
+#   renderIt.setFrameCache(cache)
+class frameCache:
+
+    # the names of the cached frames: a sha1 key and the frame kind
+    framePattern = re.compile(r'^[0-9a-f]{40}\.[A-Za-z0-9]+$')
+
+    def __init__(self, cacheDir, maxBytes=1024**3):
+        self.cacheDir = cacheDir
+        self.maxBytes = int(maxBytes)
+        os.makedirs(cacheDir, exist_ok=True)
+
+        # the cache may be shared by the threads of parallel exports
+        self.lock = threading.Lock()
+
+        self.__scan()
+
+    # ------------
+    # Reads the cached files, in least to most recently used order,
+    # from the cache directory (which may be shared between processes)
+    def __scan(self):
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not frameCache.framePattern.match(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cacheDir, name))
+                entries.append((st.st_mtime_ns, name, st.st_size))
+            except OSError:
+                pass
+
+        entries.sort()
+        self.entries = OrderedDict((name, size) for _, name, size in entries)
+        self.nBytes = sum(self.entries.values())
+
+    # ------------
+    # Returns the key of a frame of the parcellation `parc' exported
+    # for the hemisphere hemistr of the subject `subject' (the path of
+    # the subject directory).  The kind (the file extension, e.g. 'annot'
+    # or 'png'), the view and any further options that change the output
+    # (extra) are part of the key.  So are the modification time and size
+    # of the base annotation of the subject and, for images, of the
+    # surface `surface' (e.g. 'pial'), so frames built from files that
+    # were since replaced (e.g. by a new recon-all run) are not served.
+    def getFrameKey(self, parc, subject, hemistr, kind, view='', extra='', surface=None):
+        usecm, cmap = parc.getCurrentMatplotlibColormapConfig()
+        cmapName = getattr(cmap, 'name', '') if usecm else 'builtin'
+
+        sources = [os.path.join(subject, 'label', f"{hemistr}.aparc.annot")]
+        if surface is not None:
+            sources.append(os.path.join(subject, 'surf', f"{hemistr}.{surface}"))
+
+        stamps = []
+        for source in sources:
+            try:
+                st = os.stat(source)
+                stamps.append(f"{st.st_mtime_ns}:{st.st_size}")
+            except OSError:
+                stamps.append('')
+
+        h = hashlib.sha1()
+        h.update('\0'.join(parc.getRegionLabels()).encode())
+        h.update(f"\0{subject}\0{hemistr}\0{cmapName}\0{view}\0{extra}\0".encode())
+        h.update('\0'.join(stamps).encode())
+        h.update(np.ascontiguousarray(parc.getRGBArray()).tobytes())
+
+        return f"{h.hexdigest()}.{kind}"
+
+    # ------------
+    # Copies the cached frame `key' to `filename'.  Returns True on
+    # a cache hit and False otherwise
+    def fetch(self, key, filename):
+        cached = os.path.join(self.cacheDir, key)
+
+        try:
+            shutil.copyfile(cached, filename)
+            os.utime(cached)
+        except OSError:
+            return False
+
+        with self.lock:
+            # the frame may have been stored by another process
+            if key not in self.entries:
+                self.entries[key] = os.path.getsize(cached)
+                self.nBytes = self.nBytes + self.entries[key]
+
+            self.entries.move_to_end(key)
+
+        return True
+
+    # ------------
+    # Stores the file `filename' as the frame `key' and evicts the
+    # least recently used frames beyond the size cap
+    def store(self, key, filename):
+        cached = os.path.join(self.cacheDir, key)
+        tmpfile = cached + f".{os.getpid()}.{threading.get_ident()}.tmp"
+
+        shutil.copyfile(filename, tmpfile)
+        os.replace(tmpfile, cached)
+
+        with self.lock:
+            size = os.path.getsize(cached)
+            self.nBytes = self.nBytes - self.entries.pop(key, 0) + size
+            self.entries[key] = size
+
+            if self.nBytes > self.maxBytes:
+                # account for frames stored by other processes
+                self.__scan()
+
+            while self.nBytes > self.maxBytes and len(self.entries) > 1:
+                name, size = self.entries.popitem(last=False)
+                self.nBytes = self.nBytes - size
+                try:
+                    os.remove(os.path.join(self.cacheDir, name))
+                except OSError:
+                    pass
+
+
+# This class runs the stages of an export (e.g. writing the annotation
+# or vertex colors of a frame and rendering it) concurrently, connected
+# by bounded queues.  `stages' is a list of the pairs (function, nThreads):
+# every stage is run by nThreads threads and its function takes the
+# output of the previous stage and returns the input of the next one.
+#
+# run feeds the items of an iterable (e.g. the colored frames of a
+# series) into the first stage from the calling thread.  Since every
+# queue holds at most queueSize items, a fast stage blocks until the
+# slower stages downstream catch up, which keeps the memory bounded.
+# run returns the outputs of the last stage in the order of the items.
+# If a stage raises an exception the pipeline is stopped and the
+# exception is raised again by run.
+#
+# Example
+#   pipe = exportPipeline([(writeAnnotation, 1), (render, 4)], queueSize=8)
+#   images = pipe.run(coloredFrames)
+#   print(pipe.getStageTimings())
+class exportPipeline:
+
+    def __init__(self, stages, queueSize=8):
+        self.stages = [(fn, max(int(n), 1)) for fn, n in stages]
+        self.queueSize = max(int(queueSize), 1)
+        self.timings = []
+
+    # ------------
+    def __worker(self, k, inq, outq, state):
+        fn = self.stages[k][0]
+
+        while True:
+            item = inq.get()
+            if item is None:
+                break
+
+            # after a failure the remaining items are only drained
+            if state['error'] is not None:
+                continue
+
+            t, payload = item
+            t0 = time.perf_counter()
+
+            try:
+                res = fn(payload)
+            except BaseException as e:
+                with state['lock']:
+                    if state['error'] is None:
+                        state['error'] = e
+                continue
+
+            with state['lock']:
+                self.timings[k] = self.timings[k] + time.perf_counter() - t0
+
+            if outq is None:
+                with state['lock']:
+                    state['results'][t] = res
+            else:
+                outq.put((t, res))
+
+        # the last thread of a stage ends the next stage
+        with state['lock']:
+            state['running'][k] = state['running'][k] - 1
+            last = state['running'][k] == 0
+
+        if last and outq is not None:
+            for i in range(self.stages[k + 1][1]):
+                outq.put(None)
+
+    # ------------
+    # Runs the items `items' through the stages and returns the list
+    # of the outputs of the last stage
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queueSize) for stage in self.stages] + [None]
+        state = {'lock': threading.Lock(), 'error': None, 'results': {},
+                 'running': [n for fn, n in self.stages]}
+        self.timings = [0.0 for stage in self.stages]
+
+        threads = []
+        for k, (fn, n) in enumerate(self.stages):
+            for i in range(n):
+                th = threading.Thread(target=self.__worker, args=(k, queues[k], queues[k + 1], state), daemon=True)
+                th.start()
+                threads.append(th)
+
+        nItems = 0
+        try:
+            for item in items:
+                if state['error'] is not None:
+                    break
+                queues[0].put((nItems, item))
+                nItems = nItems + 1
+        finally:
+            for i in range(self.stages[0][1]):
+                queues[0].put(None)
+
+            for th in threads:
+                th.join()
+
+        if state['error'] is not None:
+            raise state['error']
+
+        return [state['results'][t] for t in range(nItems)]
+
+    # ------------
+    # Returns the time (in seconds) spent in every stage by the last
+    # call to run, summed over the threads of the stage
+    def getStageTimings(self):
+        return list(self.timings)
+
+
+# The tksurfer (tcl) commands that set up every view of a batch script
+# (c.f. getTksurferScript), starting from the lateral view
+tksurferViews = {'lateral': ['make_lateral_view'],
+                 'medial': ['make_lateral_view', 'rotate_brain_y 180'],
+                 'dorsal': ['make_lateral_view', 'rotate_brain_x 90'],
+                 'ventral': ['make_lateral_view', 'rotate_brain_x -90']}
+
+# ------------
+# Quotes the string `s' as a single tcl word
+def _tclQuote(s):
+    return '"' + ''.join('\\' + c if c in '\\"$[]' else c for c in str(s)) + '"'
+
+# ------------
+# Returns the tuple (hemistr, views) of an export of the hemisphere
+# `hemi' ('Left' or 'Right'): the Freesurfer hemisphere ('lh' or 'rh')
+# and the views of `views' that are keys of `supported' (e.g.
+# tksurferViews).  Unsupported views are reported and left out.
+def _parseHemiViews(hemi, views, supported):
+    hemistr = 'lh'
+
+    if hemi == 'Right':
+        hemistr = 'rh'
+
+    for view in views:
+        if view not in supported:
+            print(f"{view} is not a supported view.  Supported views are {list(supported.keys())}")
+
+    return hemistr, [view for view in views if view in supported]
+
+# ------------
+# Returns a tksurfer (tcl) script that saves a whole series of frames
+# in a single tksurfer session.  `frames' is a list of the pairs
+# (annotfile, images), where images maps every view (c.f. tksurferViews)
+# to the image file it is saved to.  For every frame the labels are
+# replaced by the annotation annotfile and every view is set up and
+# saved with save_tiff.  tksurfer exits at the end of the script.
+def getTksurferScript(frames):
+    lines = []
+
+    for annotfile, images in frames:
+        lines.append('labl_remove_all')
+        lines.append(f"labl_import_annotation {_tclQuote(annotfile)}")
+
+        for view, image in images.items():
+            lines.extend(tksurferViews[view])
+            lines.append('redraw')
+            lines.append(f"save_tiff {_tclQuote(image)}")
+
+    lines.append('exit')
+    return '\n'.join(lines) + '\n'
+
+
+# This class handles the visualization of activation maps using
+# freesurfer v7+ (tksurfer).  The annotation files visualized by
+# tksurfer are generated natively (c.f. freesurfer.py)
 class fsVisualizeActivation:
 
-    def __init__(self):
+    def __init__(self,banner=True):
+        # the banner can be turned off (e.g. for worker processes)
+        if banner:
+            self.__printBanner()
+
+        # freesurfer path (optional: tksurfer is run from the PATH)
+        self.fspath = ''
+        self.fsp = False
+
+        # subject path
+        self.fssubjp = ''
+        self.fssp = False
+
+        # subject name
+        self.fssubjn = ''
+        self.fssn = False;
+
+        # tksurfer command
+        self.tkpreload = ''
+        self.tkcmd = 'tksurfer'
+
+        # the parsed base annotations of the subjects
+        self.annotations = annotationCache()
+
+        # the off-screen renderer used by renderHemisphereActivation
+        self.offscreen = None
+
+        # the image last saved per subject hemisphere
+        self.lastSaved = {}
+
+        # the (optional) content addressed frame cache
+        self.frames = None
+
+        # the parent directory of the export workspaces (None for
+        # the default, c.f. exportWorkspace)
+        self.workspaceDir = None
+
+        # the runner of the tksurfer calls (c.f. jobs.py) and the
+        # last tksurfer job per subject hemisphere
+        self.jobs = jobRunner()
+        self.lastJobs = {}
+
+    def __printBanner(self):
         print("----------------------------------------------------------")
         print("")
         print("           ____       _____            ____               ")
@@ -44,7 +715,8 @@ class fsVisualizeActivation:
         print("       Oxford Mathematical Brain Modelling Group          ")
         print("   Portions copyright 2021 G.S. Brennan and A. Goriely    ")
         print("")
-        print("              replace_ctab.m is copyrighted by            ")
+        print("    The annotation color table replacement follows        ")
+        print("              replace_ctab.m, copyrighted by              ")
         print("    Dr. Anderson Winkler and distributed with permission  ") 
         print("                  https://brainder.org                    ")
         print("")
@@ -52,47 +724,15 @@ class fsVisualizeActivation:
         print("     according to the GNU GPL v3 Open-Source License      ")
         print("----------------------------------------------------------")
 
-        # freesurfer path
-        self.fspath = ''
-        self.fsp = False
-
-        # subject path
-        self.fssubjp = ''
-        self.fssp = False
-
-        # subject name
-        self.fssubjn = ''
-        self.fssn = False;
-
-        # tksurfer command
-        self.tkpreload = ''
-        self.tkcmd = 'tksurfer'
-
     def __fixpath(self,path):
         fixed = path
-        if fixed[-1] != '/':
+        # an empty path is left empty (rather than turned into '/')
+        if len(fixed) > 0 and fixed[-1] != '/':
             fixed = fixed + '/'
         return fixed
 
-    def __checkMatlab(self):
-        matlabready = False
-
-        if self.fsp:
-            matlabready = os.path.exists(self.fspath + "matlab/replace_ctab.m")
-            if matlabready == False:
-                print("This script requires that the script replace_ctab.m is located")
-                print(f"in the directory {self.fspath}" + "matlab")
-                print("A copy of replace_ctab.m (copyright Anderson M. Winkler, brainder.org)")
-                print("   that has been modified, from the original, to work with")
-                print("   Matlab R2020b is distributed with this Python package.")
-
-        return matlabready
-
     def isReady(self):
 
-        if self.fsp == False:
-            print("The freesurfer (root) path has not been set")
-
         if self.fssp == False:
             print("The freesurfer subject path has not been set")
 
@@ -101,9 +741,11 @@ class fsVisualizeActivation:
             print(" ** it is assumed that Freesurfer's recon_all command has already")
             print("    been run on any subject that you are trying to visualize")
 
-        return self.fsp and self.fssp and self.fssn
+        return self.fssp and self.fssn
 
 
+    # Records the Freesurfer (root) directory.  This is optional: the
+    # annotations are written natively and tksurfer is run from the PATH
     def setFreesurferPath(self,pathto):
             self.fspath = self.__fixpath(pathto)
             self.fsp = True
@@ -116,8 +758,37 @@ class fsVisualizeActivation:
         self.fssubjn = sname
         self.fssn = True
 
+    # Sets the directory of the on-disk annotation cache (c.f.
+    # annotationCache).  Use None to keep the cache in memory only.
+    def setAnnotationCacheDirectory(self,pathto):
+        self.annotations = annotationCache(pathto)
+
+        if self.offscreen is not None:
+            self.offscreen.annotations = self.annotations
+
+    # Sets the content addressed frame cache (c.f. frameCache) used to
+    # serve repeated annotation files and images.  Use None to disable.
+    def setFrameCache(self,cache):
+        self.frames = cache
+
+        if self.offscreen is not None:
+            self.offscreen.setFrameCache(cache)
+
+    # Sets the directory in which the scratch workspace of every export
+    # is created (c.f. exportWorkspace).  Use None for the default
+    # (/dev/shm if available, the system temporary directory otherwise).
+    def setWorkspaceDirectory(self,pathto):
+        self.workspaceDir = pathto
+
+    # Sets the jobRunner (c.f. jobs.py) that runs the tksurfer calls.
+    # Its number of workers bounds the number of concurrent tksurfer
+    # processes started by submitHemisphereActivation; its timeout and
+    # retries apply to every call.
+    def setJobRunner(self,runner):
+        self.jobs = runner
+
     def setTksurferPreloadCommand(self,cstr):
-        print(f"The tksurfer preload command {cstr} will be prepended to all (shell) calls to tksurfer")
+        print(f"The tksurfer preload command {cstr} will be prepended to all calls to tksurfer")
         print(f"i.e. the following call will be made for visualization")
         print(f"{cstr} tksurfer [further options]")
 
@@ -133,46 +804,844 @@ class fsVisualizeActivation:
     #    saveAs: set saveToDisk=True and provide a filename without
     #            extension for the image name (e.g. saveAs='myfile')
     #
-    # Note: Saving to disk is currently under development and does not yet work
-    #       correctly.  A tcl script needs to be generated and called to do this
+    # Returns the jobResult of the tksurfer call (c.f. jobs.py), or None
+    # if tksurfer was not run (e.g. when the image was copied from the
+    # previous frame or the frame cache)
+    #
+    # Note: Saving single frames to disk is currently under development and
+    #       does not yet work correctly.  Use saveHemisphereActivationSeries,
+    #       which drives tksurfer with a generated tcl script, instead
     def visualizeHemisphereActivation(self,actv,hemi='Left',saveToDisk=False,saveAs=''):
-        bMatlab = self.__checkMatlab()
+        return self.submitHemisphereActivation(actv, hemi, saveToDisk, saveAs).result()
+
+    # The asyncio version of visualizeHemisphereActivation
+    async def visualizeHemisphereActivationAsync(self,actv,hemi='Left',saveToDisk=False,saveAs=''):
+        return await asyncio.wrap_future(self.submitHemisphereActivation(actv, hemi, saveToDisk, saveAs))
+
+    # Saves both hemispheres of the whole brain activation map `actv'
+    # (c.f. activationBilateral) to the TIFF images saveAs + '_lh.tiff'
+    # and saveAs + '_rh.tiff'.  The annotations of both hemispheres are
+    # written from the one (shared) color table and the two tksurfer
+    # calls run concurrently on the job runner.  Returns the list of
+    # the jobResults (c.f. visualizeHemisphereActivation)
+    def saveBilateralActivation(self,actv,saveAs):
+        futures = [self.submitHemisphereActivation(actv.getHemisphereActivation(hemistr), hemi, True, f"{saveAs}_{hemistr}")
+                   for hemistr, hemi in [('lh', 'Left'), ('rh', 'Right')]]
+
+        return [f.result() for f in futures]
+
+    # As visualizeHemisphereActivation but tksurfer is run by the job
+    # runner (c.f. setJobRunner) and a concurrent.futures.Future of the
+    # result is returned immediately.  The annotation of the frame is
+    # written before the call returns, so the activation map can be
+    # set to the next frame right away.
+    #
+    # Example
+    #   futures = []
+    #   for t in range(nT):
+    #       myActivation.setActivationFromValueArray(values[t])
+    #       futures.append(visIt.submitHemisphereActivation(myActivation, saveToDisk=True, saveAs=f'frame{t}'))
+    #   results = [f.result() for f in futures]
+    def submitHemisphereActivation(self,actv,hemi='Left',saveToDisk=False,saveAs=''):
         bInit = self.isReady()
+        done = Future()
+        done.set_result(None)
 
         hemistr = 'lh'
 
         if hemi == 'Right':
             hemistr = 'rh'
 
-        fsparc = hemistr + ".aparc.annot"
-        fsparcvis = fsparc + '.vis'
-        tkparcvis = "aparc.annot.vis"
+        fsparcvis = hemistr + ".aparc.annot.vis"
+
+        parc = actv.getParcellation()
+        key = ('tksurfer', id(self), id(parc), self.fssubjp + self.fssubjn, hemistr)
+        previous = self.lastSaved.get(key)
+
+        imageKey = None
+        if bInit and saveToDisk and self.frames is not None:
+            imageKey = self.frames.getFrameKey(parc, self.fssubjp + self.fssubjn, hemistr, 'tiff', extra=self.tkcmd, surface='pial')
+
+        # when saving a series of frames, a frame whose regions did not
+        # change since the last saved frame is copied instead of rendered
+        # (once the previous frame is written)
+        unchanged = bInit and saveToDisk and previous is not None and not parc.hasChangedRegions(key)
+        if unchanged and key in self.lastJobs:
+            # wait for the previous frame (its errors were reported to
+            # the caller of that frame)
+            wait([self.lastJobs[key]])
+
+        if unchanged and os.path.exists(previous):
+            if os.path.abspath(previous) != os.path.abspath(f"{saveAs}.tiff"):
+                shutil.copyfile(previous, f"{saveAs}.tiff")
+
+        # frames that were saved before are served from the frame cache
+        elif imageKey is not None and self.frames.fetch(imageKey, f"{saveAs}.tiff"):
+            parc.markExported(key)
+            self.lastSaved[key] = f"{saveAs}.tiff"
 
         # We are ready to go
-        if bMatlab and bInit:
-            # write the activation map CSV
-            ctabpath = self.fssubjp + self.fssubjn + "/label/"
-            actv.writeActivationCSV(ctabpath, 'vis')
-            # We don't necessarily know if the user has overridden the writeActivationCSV
-            # function so we ask the base class for the filename it wrote
-            cstabcsv = actv.getLastFileWritten()
+        elif bInit:
+            # the annotation file is written to a private workspace (not
+            # the subject's label directory) so that concurrent exports
+            # of the same subject do not clobber each other.  The
+            # workspace is removed once tksurfer is done, or on failure.
+            ws = exportWorkspace(self.workspaceDir)
+
+            try:
+                annotfile = ws.getPath(fsparcvis)
+
+                # write the annotation file with the color table of the
+                # activation map (this replaces the call to replace_ctab.m)
+                annotKey = None
+                if self.frames is not None:
+                    annotKey = self.frames.getFrameKey(parc, self.fssubjp + self.fssubjn, hemistr, 'annot')
+
+                if annotKey is None or not self.frames.fetch(annotKey, annotfile):
+                    rewriter = self.annotations.getRewriter(self.fssubjp, self.fssubjn, hemistr, parc.getRegionLabels())
+                    rewriter.writeAnnotation(annotfile, colorTableFromParcellation(parc))
 
-            # the matlab command string
-            matlabcmd = f"matlab -batch \"replace_ctab('{ctabpath + fsparc}','{cstabcsv}','{ctabpath + fsparcvis}')\""
+                    if annotKey is not None:
+                        self.frames.store(annotKey, annotfile)
 
-            # execute the matlab command
-            os.system(matlabcmd)
+                args = ['-annotation', annotfile]
+                if saveToDisk:
+                    args = args + ['save_tiff', saveAs + '.tiff']
 
-            # the tksurfer command string
-            tksrfcmd = str(self.tkpreload + ' ' + self.tkcmd).strip()
-            tksrfcmd = tksrfcmd + f" {self.fssubjn}" + f" {hemistr}" + f" pial -annotation {tkparcvis}"
+                tksrfcmd = self.__tksurferCommand(hemistr, args)
+
+                # an interactive session keeps its console output
+                job = self.jobs.submit(tksrfcmd, capture=saveToDisk)
+            except BaseException:
+                ws.close()
+                raise
+
+            # the returned future completes once the job is cleaned up
+            done = Future()
+            job.add_done_callback(lambda f: self.__finishJob(f, done, ws, imageKey, f"{saveAs}.tiff" if saveToDisk else None))
 
             if saveToDisk:
-                tksrfcmd = tksrfcmd + f" save_tiff {saveAs}.tiff"
+                parc.markExported(key)
+                self.lastSaved[key] = f"{saveAs}.tiff"
+                self.lastJobs[key] = done
+
+        return done
+
+    # Reports a failed tksurfer job
+    def __reportJob(self,result):
+        reason = 'timed out' if result.timedOut else f"failed with exit status {result.returncode}"
+        print(f"tksurfer {reason} after {result.attempts} attempt(s): {result.command}")
+        if result.stderr.strip():
+            print(result.stderr.strip())
+
+    # Cleans up after the tksurfer job `job' of submitHemisphereActivation
+    # and passes its result on to the future `done'.  The future is
+    # always resolved, also if the clean up fails (e.g. when the frame
+    # cache directory was removed), so callers never wait forever.
+    def __finishJob(self,job,done,ws,imageKey,image):
+        try:
+            ws.close()
+
+            if job.cancelled():
+                done.cancel()
+            elif job.exception() is not None:
+                done.set_exception(job.exception())
+            else:
+                result = job.result()
+
+                if not result.succeeded():
+                    self.__reportJob(result)
+
+                elif image is not None and imageKey is not None and os.path.exists(image):
+                    self.frames.store(imageKey, image)
+
+                done.set_result(result)
+        except BaseException as e:
+            if not done.done():
+                done.set_exception(e)
+
+    # Saves a series of frames of the (hemispheric) activation map `actv'
+    # to TIFF images in a single tksurfer session, so that an N frame
+    # series costs one tksurfer startup instead of N.  `frames' is any
+    # iterable that sets actv to the next frame on every step, e.g.
+    # actv.iterateSimulationFrames(series).  The annotation of every
+    # frame is written to a workspace (c.f. exportWorkspace) and a tcl
+    # script that loads them in turn and saves every view is handed to
+    # tksurfer (c.f. getTksurferScript).  The image of frame t and view
+    # `view' is named saveAs + f'_{t:04d}_{view}.tiff'.
+    #
+    # Frames whose regions did not change since the previous frame are
+    # copied and frames in the frame cache (c.f. setFrameCache) are
+    # fetched instead of being passed to tksurfer.  All annotations of
+    # a session are kept in the workspace until tksurfer exits; use
+    # batchSize to bound the number of frames per tksurfer session.
+    #
+    # Returns the list of images written.  Images that were not saved
+    # (e.g. when a tksurfer session failed) are left out and the frames
+    # they belong to are reported.
+    #
+    # Options:
+    #   views: the views to save (c.f. tksurferViews)
+    #   batchSize: the maximum number of frames per tksurfer session
+    #              (None for a single session)
+    def saveHemisphereActivationSeries(self,actv,frames,saveAs,hemi='Left',views=['lateral'],batchSize=None):
+        written = []
+
+        if not self.isReady():
+            return written
+
+        hemistr, views = _parseHemiViews(hemi, views, tksurferViews)
+
+        parc = actv.getParcellation()
+        key = ('tksurfer-series', id(self), id(parc), self.fssubjp + self.fssubjn, hemistr, tuple(views))
+        rewriter = self.annotations.getRewriter(self.fssubjp, self.fssubjn, hemistr, parc.getRegionLabels())
+
+        # the images of every frame, the frames copied from an earlier
+        # frame, the frames passed to tksurfer as (annotfile, images,
+        # imageKeys) and the images saved (c.f. __iterateSeriesFrames)
+        frameImages = []
+        copies = []
+        batch = []
+        saved = set()
+
+        with exportWorkspace(self.workspaceDir) as ws:
+            for t, images, imageKeys in self.__iterateSeriesFrames(parc, frames, saveAs, hemistr, views, key, frameImages, copies):
+                if self.__fetchSeriesImages(images, imageKeys):
+                    saved.update(images.values())
+                    continue
+
+                annotfile = ws.getPath(f"{hemistr}.{t:04d}.annot.vis")
+                rewriter.writeAnnotation(annotfile, colorTableFromParcellation(parc))
+
+                batch.append((annotfile, images, imageKeys))
+
+                if batchSize is not None and len(batch) >= batchSize:
+                    saved.update(self.__runSeriesBatch(ws, hemistr, batch))
+                    batch = []
+
+            if len(batch) > 0:
+                saved.update(self.__runSeriesBatch(ws, hemistr, batch))
+
+        return self.__finishSeries(frameImages, copies, saved)
+
+    # The pipelined version of saveHemisphereActivationSeries.  Coloring
+    # the frames (in the calling thread), writing their annotations and
+    # running tksurfer are concurrent stages connected by queues of at
+    # most queueSize frames (c.f. exportPipeline).  Every frame is saved
+    # by its own tksurfer session and up to maxWorkers sessions of the
+    # job runner (c.f. setJobRunner) run at once, so tksurfer startups
+    # overlap with the coloring and annotation writing of later frames
+    # while at most about 2 * queueSize annotations exist at any time.
+    # The images are named as for saveHemisphereActivationSeries.
+    #
+    # Returns the list of images written (c.f. saveHemisphereActivationSeries)
+    def pipelineHemisphereActivationSeries(self,actv,frames,saveAs,hemi='Left',views=['lateral'],queueSize=8):
+        written = []
+
+        if not self.isReady():
+            return written
+
+        hemistr, views = _parseHemiViews(hemi, views, tksurferViews)
+
+        parc = actv.getParcellation()
+        key = ('tksurfer-pipeline', id(self), id(parc), self.fssubjp + self.fssubjn, hemistr, tuple(views))
+        rewriter = self.annotations.getRewriter(self.fssubjp, self.fssubjn, hemistr, parc.getRegionLabels())
+        frameImages = []
+        copies = []
+
+        # stage 1 (calling thread): the color table and image names of
+        # every changed frame.  Unchanged frames are copied at the end.
+        def colored():
+            for t, images, imageKeys in self.__iterateSeriesFrames(parc, frames, saveAs, hemistr, views, key, frameImages, copies):
+                yield (t, colorTableFromParcellation(parc), images, imageKeys)
+
+        # stage 2: the annotation of the frame (None for frames fetched
+        # from the frame cache)
+        def annotate(item):
+            t, ctab, images, imageKeys = item
+
+            if self.__fetchSeriesImages(images, imageKeys):
+                return (t, None, images, imageKeys)
+
+            annotfile = ws.getPath(f"{hemistr}.{t:04d}.annot.vis")
+            rewriter.writeAnnotation(annotfile, ctab)
+
+            return (t, annotfile, images, imageKeys)
+
+        # stage 3: the tksurfer session of the frame.  Returns the
+        # images saved
+        def render(item):
+            t, annotfile, images, imageKeys = item
+
+            if annotfile is None:
+                return list(images.values())
+
+            return self.__runSeriesBatch(ws, hemistr, [(annotfile, images, imageKeys)], f"{hemistr}.{t:04d}.tcl")
+
+        with exportWorkspace(self.workspaceDir) as ws:
+            pipe = exportPipeline([(annotate, 1), (render, self.jobs.maxWorkers)], queueSize)
+            saved = set(image for images in pipe.run(colored()) for image in images)
+
+        return self.__finishSeries(frameImages, copies, saved)
+
+    # Returns the tksurfer command for the hemisphere hemistr of the
+    # current subject followed by the (quoted) arguments args.  tksurfer
+    # finds the subject through SUBJECTS_DIR.
+    def __tksurferCommand(self,hemistr,args):
+        tksrfcmd = str(self.tkpreload + ' ' + self.tkcmd).strip()
+        tksrfcmd = f"SUBJECTS_DIR={shlex.quote(self.fssubjp)} " + tksrfcmd
+        tksrfcmd = tksrfcmd + f" {shlex.quote(self.fssubjn)} {hemistr} pial"
+
+        return tksrfcmd + ''.join(' ' + shlex.quote(str(arg)) for arg in args)
+
+    # A generator over the frames `frames' of a series export that
+    # yields (t, images, imageKeys) for every frame whose regions
+    # changed since the previous frame, where images maps every view to
+    # the image file of frame t and imageKeys maps every view to its key
+    # in the frame cache (empty without a frame cache).  The images of
+    # every frame are appended to frameImages and unchanged frames are
+    # appended to copies as (images, images of the frame they repeat).
+    def __iterateSeriesFrames(self,parc,frames,saveAs,hemistr,views,key,frameImages,copies):
+        previous = None
+
+        for t, frame in enumerate(frames):
+            images = {view: f"{saveAs}_{t:04d}_{view}.tiff" for view in views}
+            frameImages.append(images)
+
+            if previous is not None and not parc.hasChangedRegions(key):
+                copies.append((images, previous))
+                continue
+
+            parc.markExported(key)
+            previous = images
+
+            imageKeys = {}
+            if self.frames is not None:
+                imageKeys = {view: self.frames.getFrameKey(parc, self.fssubjp + self.fssubjn, hemistr, 'tiff', view, self.tkcmd, 'pial') for view in views}
+
+            yield t, images, imageKeys
+
+    # Fetches all images of a series frame from the frame cache.
+    # Returns True if they were all found
+    def __fetchSeriesImages(self,images,imageKeys):
+        return len(imageKeys) > 0 and all(self.frames.fetch(imageKeys[view], images[view]) for view in images)
+
+    # Copies the unchanged frames `copies' of a series, given as the
+    # pairs (images, source images), from the frames they repeat.  Returns
+    # the images of the frames frameImages that were saved, in order,
+    # where `saved' is the set of images saved before.  Frames with
+    # missing images are reported.
+    def __finishSeries(self,frameImages,copies,saved):
+        for images, source in copies:
+            for view, image in images.items():
+                if source[view] in saved:
+                    if os.path.abspath(source[view]) != os.path.abspath(image):
+                        shutil.copyfile(source[view], image)
+                    saved.add(image)
+
+        missing = [t for t, images in enumerate(frameImages) if not all(image in saved for image in images.values())]
+        if len(missing) > 0:
+            print(f"{len(missing)} frame(s) of the series were not saved: {missing}")
+
+        return [image for images in frameImages for image in images.values() if image in saved]
+
+    # Runs one tksurfer session for the frames `batch' of a series
+    # export, given as (annotfile, images, imageKeys), with the tcl
+    # script `name' in the workspace ws, stores the saved images in the
+    # frame cache and removes the annotations.  Returns the list of
+    # images saved
+    def __runSeriesBatch(self,ws,hemistr,batch,name=None):
+        script = ws.getPath(name if name is not None else f"{hemistr}.series.tcl")
+
+        with open(script, 'w') as ofile:
+            ofile.write(getTksurferScript([(annotfile, images) for annotfile, images, imageKeys in batch]))
+
+        result = self.jobs.run(self.__tksurferCommand(hemistr, ['-tcl', script]))
+        os.remove(script)
+
+        if not result.succeeded():
+            self.__reportJob(result)
+
+        saved = []
+
+        for annotfile, images, imageKeys in batch:
+            os.remove(annotfile)
+
+            if not result.succeeded():
+                continue
+
+            for view, image in images.items():
+                if os.path.exists(image):
+                    saved.append(image)
+
+                    if view in imageKeys:
+                        self.frames.store(imageKeys[view], image)
+
+        return saved
+
+    # Renders the (hemispheric) activation map `actv' to PNG images of
+    # the subject's surface off-screen, i.e. without tksurfer (c.f.
+    # offscreenVisualizeActivation).  The surface, camera and visibility
+    # of every view are computed for the first frame and reused for all
+    # further frames, so each additional frame costs only a color
+    # gather and a raster pass.  One image is written per view, named
+    # saveAs + '_' + view + '.png'.  Returns the list of images written
+    #
+    # Options:
+    #   surface: the surface to render (e.g. 'pial' or 'inflated')
+    #   views: the views to render (c.f. surfaceViews)
+    def renderHemisphereActivation(self,actv,saveAs,hemi='Left',surface='pial',views=['lateral','medial']):
+        if not self.isReady():
+            return []
+
+        if self.offscreen is None:
+            self.offscreen = offscreenVisualizeActivation()
+            self.offscreen.annotations = self.annotations
+            self.offscreen.setFrameCache(self.frames)
+
+        self.offscreen.setFreesurferSubjectPath(self.fssubjp)
+        self.offscreen.setFreesurferSubjectName(self.fssubjn)
+        self.offscreen.setSurface(surface)
+
+        return self.offscreen.renderHemisphereActivation(actv, saveAs, hemi=hemi, views=views)
+
+    # Returns the per-frame render timings of renderHemisphereActivation
+    # (c.f. surfaceRenderContext.getFrameTimings)
+    def getFrameTimings(self):
+        if self.offscreen is None:
+            return {}
+
+        return self.offscreen.getFrameTimings()
+
+
+# The camera of every view of the off-screen renderer as the pair
+# (forward, up) for the left hemisphere, where forward is the viewing
+# direction.  The right hemisphere mirrors the lateral/medial views.
+surfaceViews = {'lateral': ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+                'medial': ((-1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+                'dorsal': ((0.0, 0.0, -1.0), (0.0, 1.0, 0.0)),
+                'ventral': ((0.0, 0.0, 1.0), (0.0, 1.0, 0.0)),
+                'anterior': ((0.0, -1.0, 0.0), (0.0, 0.0, 1.0)),
+                'posterior': ((0.0, 1.0, 0.0), (0.0, 0.0, 1.0))}
+
+# This class holds everything needed to render one surface (e.g. the
+# pial surface of a subject hemisphere) that does not depend on the
+# vertex colors.  For every (view, image options) it precomputes, once,
+# the projected 2D coordinates, the culling of faces turned away from
+# the camera, the back to front drawing order of the remaining faces,
+# their Lambertian shading and the matplotlib (Agg) figure drawing
+# them.  Each frame rendered afterwards only costs a gather of the
+# vertex colors and a raster pass.
+#
+# The time spent on every rendered frame is recorded so that the
+# amortization can be verified (c.f. getFrameTimings).
+#
+# Example
+#   ctx = surfaceRenderContext(coords, faces, 'lh')
+#   for t, vertexRGB in enumerate(myFrames):
+#       ctx.render(f'frame{t}.png', vertexRGB, view='lateral')
+#   print(ctx.getFrameTimings())
+class surfaceRenderContext:
+
+    def __init__(self, coords, faces, hemistr='lh'):
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.faces = np.asarray(faces, dtype=np.int64)
+        self.hemistr = hemistr
+
+        # face normals, oriented to point away from the surface center
+        tri = self.coords[self.faces]
+        normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+        if np.sum(normals * (tri.mean(axis=1) - self.coords.mean(axis=0))) < 0:
+            normals = -normals
+
+        norms = np.linalg.norm(normals, axis=1)
+        norms[norms == 0] = 1.0
+        self.normals = normals / norms[:, None]
+
+        self.views = {}
+        self.timings = []
+
+        # the views are redrawn by one thread at a time
+        self.lock = threading.Lock()
+
+    # ------------
+    def getNumberOfVertices(self):
+        return len(self.coords)
+
+    # ------------
+    # Returns the (cached) precomputed state of a view
+    def getView(self, view='lateral', size=(800, 600), background='white', dpi=100):
+        key = (view, tuple(size), background, dpi)
+
+        if key not in self.views:
+            forward, up = surfaceViews[view]
+            forward = np.array(forward)
+            up = np.array(up)
+
+            if self.hemistr == 'rh' and view in ['lateral', 'medial']:
+                forward = -forward
+
+            right = np.cross(forward, up)
+
+            # project the vertices onto the image plane
+            uv = np.stack([self.coords @ right, self.coords @ up], axis=1)
+            depth = self.coords @ forward
+
+            # cull back faces and sort the rest from back to front
+            facing = -(self.normals @ forward)
+            visible = np.flatnonzero(facing > 0)
+            order = visible[np.argsort(-depth[self.faces[visible]].mean(axis=1), kind='stable')]
+            faces = self.faces[order]
+
+            fig = Figure(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi, facecolor=background)
+            ax = fig.add_axes([0, 0, 1, 1])
+            ax.set_axis_off()
+            collection = PolyCollection(uv[faces], linewidths=0.2, antialiased=False)
+            ax.add_collection(collection)
+            ax.set_xlim(uv[:, 0].min(), uv[:, 0].max())
+            ax.set_ylim(uv[:, 1].min(), uv[:, 1].max())
+            ax.set_aspect('equal')
+
+            self.views[key] = {'faces': faces,
+                               'shade': (0.4 + 0.6 * facing[order])[:, None] / 255.0,
+                               'figure': fig,
+                               'collection': collection,
+                               'vertexRGB': None,
+                               'colors': None,
+                               'lastFile': None}
+
+        return self.views[key]
+
+    # ------------
+    # Renders the surface with the vertex colors vertexRGB (an
+    # (nVertices, 3) uint8 array) from the view `view' (c.f.
+    # surfaceViews) to the image file `filename'.
+    #
+    # Only the faces touching vertices whose color changed since the
+    # previous frame of the view are recolored.  If no vertex changed
+    # the previous image is reused (copied if the filename differs)
+    # instead of being rasterized again.  Threads sharing the context
+    # render one after the other.
+    def render(self, filename, vertexRGB, view='lateral', size=(800, 600), background='white', dpi=100):
+        with self.lock:
+            t0 = time.perf_counter()
+            v = self.getView(view, size, background, dpi)
+
+            t1 = time.perf_counter()
+            last = v['vertexRGB']
+
+            if last is None or last.shape != vertexRGB.shape:
+                v['colors'] = vertexRGB[v['faces']].mean(axis=1) * v['shade']
+                v['vertexRGB'] = np.array(vertexRGB, dtype=np.uint8)
+                changed = True
+            else:
+                changedVertices = np.any(vertexRGB != last, axis=1)
+                changed = bool(changedVertices.any())
+
+                if changed:
+                    changedFaces = np.flatnonzero(changedVertices[v['faces']].any(axis=1))
+                    v['colors'][changedFaces] = vertexRGB[v['faces'][changedFaces]].mean(axis=1) * v['shade'][changedFaces]
+                    last[changedVertices] = vertexRGB[changedVertices]
+
+            t2 = time.perf_counter()
+            skipped = not changed and v['lastFile'] is not None and os.path.exists(v['lastFile'])
+
+            if skipped:
+                if os.path.abspath(v['lastFile']) != os.path.abspath(filename):
+                    shutil.copyfile(v['lastFile'], filename)
+            else:
+                v['collection'].set_facecolor(v['colors'])
+                v['collection'].set_edgecolor(v['colors'])
+                v['figure'].savefig(filename, dpi=dpi, facecolor=background)
+
+            v['lastFile'] = filename
+
+            t3 = time.perf_counter()
+            self.timings.append({'view': view, 'setup': t1 - t0, 'gather': t2 - t1, 'raster': t3 - t2, 'skipped': skipped})
+
+    # ------------
+    # Returns a list with the timings (in seconds) of every frame
+    # rendered so far.  Each entry is a dictionary holding the view,
+    # the time spent on the view setup (only non-zero when the view is
+    # first used), the color gather and the raster pass, and whether
+    # the raster pass was skipped because no color changed.
+    def getFrameTimings(self):
+        return list(self.timings)
+
+    # ------------
+    def clearFrameTimings(self):
+        self.timings = []
+
+
+# Renders a colored triangle surface to the image file `filename' from
+# the view `view' (c.f. surfaceViews) of the hemisphere hemistr.  The
+# surface is rasterized off-screen with matplotlib's Agg backend: faces
+# turned away from the camera are culled and the remaining faces are
+# drawn from back to front with a simple Lambertian shading.  Use a
+# surfaceRenderContext directly when rendering many frames.
+#
+# Inputs:
+#   coords, faces: the surface (c.f. freesurfer.readSurface)
+#   vertexRGB: an (nVertices, 3) uint8 array of vertex colors
+#   size: the (width, height) of the image in pixels
+def renderSurfaceImage(filename, coords, faces, vertexRGB, hemistr='lh', view='lateral',
+                       size=(800, 600), background='white', dpi=100):
+    ctx = surfaceRenderContext(coords, faces, hemistr)
+    ctx.render(filename, vertexRGB, view, size, background, dpi)
+
+
+# This class renders activation maps onto a Freesurfer subject's surface
+# entirely off-screen, i.e. without tksurfer, Matlab or an X server.  The
+# surface geometry (e.g. surf/lh.pial or surf/lh.inflated) is read with
+# numpy, every vertex is colored from the activation's region RGB table
+# via the subject's annotation labels and the views are rasterized to
+# PNG with matplotlib's Agg backend.  This makes it possible to produce
+# frames in batch on CPU-only render nodes.
+#
+# Example
+#   renderIt = offscreenVisualizeActivation()
+#   renderIt.setFreesurferSubjectPath('/path/to/subjects/')
+#   renderIt.setFreesurferSubjectName('bert')
+#   renderIt.renderHemisphereActivation(myActivation, '/path/to/frame0')
+#   --> writes /path/to/frame0_lateral.png and /path/to/frame0_medial.png
+class offscreenVisualizeActivation:
+
+    def __init__(self):
+        # subject path
+        self.fssubjp = ''
+        self.fssp = False
+
+        # subject name
+        self.fssubjn = ''
+        self.fssn = False
+
+        # the surface to render and the image options
+        self.surface = 'pial'
+        self.size = (800, 600)
+        self.background = 'white'
+
+        # the parsed base annotations of the subjects
+        self.annotations = annotationCache()
+
+        # the render contexts, keyed by (subject, hemisphere, surface)
+        self.contexts = {}
+        self.lock = threading.Lock()
+
+        # the images last written per export (c.f. renderHemisphereActivation)
+        self.lastWritten = {}
+
+        # the (optional) content addressed frame cache
+        self.frames = None
+
+    def __fixpath(self,path):
+        fixed = path
+        # an empty path is left empty (rather than turned into '/')
+        if len(fixed) > 0 and fixed[-1] != '/':
+            fixed = fixed + '/'
+        return fixed
+
+    def isReady(self):
+
+        if self.fssp == False:
+            print("The freesurfer subject path has not been set")
+
+        if self.fssn == False:
+            print("The freesurfer subject name (to visualize) has not been set")
+
+        return self.fssp and self.fssn
+
+    def setFreesurferSubjectPath(self,pathto):
+        self.fssubjp = self.__fixpath(pathto)
+        self.fssp = True
+
+    def setFreesurferSubjectName(self,sname):
+        self.fssubjn = sname
+        self.fssn = True
+
+    # Sets the surface to render (e.g. 'pial', 'inflated' or 'white')
+    def setSurface(self,surface):
+        self.surface = surface
+
+    # Sets the (width, height) of rendered images in pixels
+    # and their background color
+    def setImageOptions(self,width,height,background='white'):
+        self.size = (int(width), int(height))
+        self.background = background
+
+    # Sets the directory of the on-disk annotation cache (c.f.
+    # annotationCache).  Use None to keep the cache in memory only.
+    def setAnnotationCacheDirectory(self,pathto):
+        self.annotations = annotationCache(pathto)
+
+    # Sets the content addressed frame cache (c.f. frameCache) used to
+    # serve repeated images.  Use None to disable.
+    def setFrameCache(self,cache):
+        self.frames = cache
+
+    # Returns the (cached) surfaceRenderContext of the surface of the
+    # hemisphere hemistr ('lh' or 'rh') of the current subject
+    def getRenderContext(self,hemistr):
+        key = (self.fssubjp + self.fssubjn, hemistr, self.surface)
+
+        with self.lock:
+            if key not in self.contexts:
+                coords, faces = readSurface(self.fssubjp + self.fssubjn + f"/surf/{hemistr}.{self.surface}")
+                self.contexts[key] = surfaceRenderContext(coords, faces, hemistr)
+
+            return self.contexts[key]
+
+    # Returns the per-frame timings of all render contexts
+    # (c.f. surfaceRenderContext.getFrameTimings)
+    def getFrameTimings(self):
+        return {key: ctx.getFrameTimings() for key, ctx in self.contexts.items()}
+
+    # Returns an (nVertices, 3) uint8 array of the vertex colors of
+    # the activation `actv' for a surface with nVertices vertices.
+    # Vertices without a region take the default RGB color.  Returns
+    # None if the annotation of the subject does not match the surface
+    def getVertexRGB(self,actv,hemistr,nVertices):
+        parc = actv.getParcellation()
+        rewriter = self.annotations.getRewriter(self.fssubjp, self.fssubjn, hemistr, parc.getRegionLabels())
+        regions = rewriter.getVertexRegions(nVertices)
+
+        if regions is None:
+            return None
+
+        rgb = np.concatenate([parc.getRGBArray(), [parc.getDefaultRGB()]]).astype(np.uint8)
+        return rgb[regions]
+
+    # Renders the (hemispheric) activation map `actv' (c.f.
+    # activations.py) to PNG images.  It is assumed that you will
+    # render the left hemisphere (default) but you can override this
+    # with the option hemi='Right'.  One image is written per view,
+    # named saveAs + '_' + view + '.png'
+    #
+    # Returns the list of images written
+    def renderHemisphereActivation(self,actv,saveAs,hemi='Left',views=['lateral','medial']):
+        written = []
+
+        if not self.isReady():
+            return written
+
+        hemistr, views = _parseHemiViews(hemi, views, surfaceViews)
+
+        parc = actv.getParcellation()
+        key = ('offscreen', id(self), id(parc), self.fssubjp + self.fssubjn, hemistr, self.surface, tuple(views), self.size, self.background)
+        previous = self.lastWritten.get(key)
+
+        # skip the frame entirely if no region changed since the last export
+        if previous is not None and not parc.hasChangedRegions(key) and all(os.path.exists(f) for f in previous):
+            for view, prev in zip(views, previous):
+                filename = f"{saveAs}_{view}.png"
+                if os.path.abspath(prev) != os.path.abspath(filename):
+                    shutil.copyfile(prev, filename)
+                written.append(filename)
+        else:
+            ctx = None
+
+            for view in views:
+                filename = f"{saveAs}_{view}.png"
+
+                imageKey = None
+                if self.frames is not None:
+                    extra = f"{self.surface}\0{self.size}\0{self.background}"
+                    imageKey = self.frames.getFrameKey(parc, self.fssubjp + self.fssubjn, hemistr, 'png', view, extra, self.surface)
+
+                if imageKey is None or not self.frames.fetch(imageKey, filename):
+                    if ctx is None:
+                        ctx = self.getRenderContext(hemistr)
+                        vertexRGB = self.getVertexRGB(actv, hemistr, ctx.getNumberOfVertices())
+
+                        if vertexRGB is None:
+                            return []
+
+                    ctx.render(filename, vertexRGB, view, self.size, self.background)
+
+                    if imageKey is not None:
+                        self.frames.store(imageKey, filename)
+
+                written.append(filename)
+
+            parc.markExported(key)
+
+        self.lastWritten[key] = written
+        return written
+
+    # Renders a series of frames of the (hemispheric) activation map
+    # `actv' to PNG images.  `frames' is any iterable that sets actv to
+    # the next frame on every step, e.g. actv.iterateSimulationFrames(series).
+    # Coloring the frames (in the calling thread), gathering the vertex
+    # colors and rasterizing the views are concurrent stages connected
+    # by queues of at most queueSize frames (c.f. exportPipeline), so
+    # the coloring of later frames overlaps with the rendering of
+    # earlier ones while the memory stays bounded.  The image of frame t
+    # and view `view' is named saveAs + f'_{t:04d}_{view}.png'.
+    #
+    # Returns the list of images written
+    def renderHemisphereActivationSeries(self,actv,frames,saveAs,hemi='Left',views=['lateral','medial'],queueSize=8):
+        written = []
+
+        if not self.isReady():
+            return written
+
+        hemistr, views = _parseHemiViews(hemi, views, surfaceViews)
+
+        parc = actv.getParcellation()
+        ctx = self.getRenderContext(hemistr)
+        rewriter = self.annotations.getRewriter(self.fssubjp, self.fssubjn, hemistr, parc.getRegionLabels())
+        regions = rewriter.getVertexRegions(ctx.getNumberOfVertices())
+
+        if regions is None:
+            return written
+
+        default = np.asarray(parc.getDefaultRGB(), dtype=np.uint8)
+
+        # stage 1 (calling thread): a snapshot of the region colors
+        # of every frame
+        def colored():
+            for t, frame in enumerate(frames):
+                images = {view: f"{saveAs}_{t:04d}_{view}.png" for view in views}
+                written.extend(images.values())
+
+                imageKeys = {}
+                if self.frames is not None:
+                    extra = f"{self.surface}\0{self.size}\0{self.background}"
+                    imageKeys = {view: self.frames.getFrameKey(parc, self.fssubjp + self.fssubjn, hemistr, 'png', view, extra, self.surface) for view in views}
+
+                yield (np.array(parc.getRGBArray(), dtype=np.uint8), images, imageKeys)
+
+        # stage 2: the vertex colors of the frame
+        def gather(item):
+            rgb, images, imageKeys = item
+            return (np.concatenate([rgb, [default]])[regions], images, imageKeys)
+
+        # stage 3: the images of the frame
+        def render(item):
+            vertexRGB, images, imageKeys = item
+
+            for view in views:
+                if view in imageKeys and self.frames.fetch(imageKeys[view], images[view]):
+                    continue
+
+                ctx.render(images[view], vertexRGB, view, self.size, self.background)
+
+                if view in imageKeys:
+                    self.frames.store(imageKeys[view], images[view])
+
+        pipe = exportPipeline([(gather, 1), (render, 1)], queueSize)
+        pipe.run(colored())
+
+        return written
 
-            os.system(tksrfcmd)
+    # Renders both hemispheres of the whole brain activation map `actv'
+    # (c.f. activationBilateral) in one pass.  One image is written per
+    # hemisphere and view, named saveAs + '_' + hemisphere + '_' + view
+    # + '.png' (e.g. frame0_lh_lateral.png).  Returns the list of
+    # images written
+    def renderBilateralActivation(self,actv,saveAs,views=['lateral','medial']):
+        written = []
 
-            # Cleanup: remove the csv tab file we created
-            rmcmd = f"rm {self.fspath + self.fssubjn}" + f"/label/{fsparcvis}"
+        for hemistr, hemi in [('lh', 'Left'), ('rh', 'Right')]:
+            written.extend(self.renderHemisphereActivation(actv.getHemisphereActivation(hemistr), f"{saveAs}_{hemistr}", hemi, views))
 
-            os.system(rmcmd)
\ No newline at end of file
+        return written
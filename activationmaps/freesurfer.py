@@ -0,0 +1,394 @@
+# ----------------------------------------------------------------
+# Oxford Mathematical Brain Modelling Group
+#   This file contains native Python readers and writers for
+#   the Freesurfer file formats used by the activation maps
+#       1. Python v3.8 or higher
+#       2. Python numpy package
+#
+#   The annotation format is the one read and written by
+#   Freesurfer's read_annotation.m / write_annotation.m
+#
+#
+#  Authors:
+#               Georgia S. Brennan          - georgia.brennan@maths.ox.ac.uk
+#               Travis B. Thompson          - thompsont@maths.ox.ac.uk
+#               Marie E. Rognes             - meg@simula.no
+#               Alain Goriely               - goriely@maths.ox.ac.uk
+#
+# Distribution
+# This code is distributed under the GNU GPL V3 License
+# https://www.gnu.org/licenses/gpl-3.0.html
+#
+#
+# Copyright (c) 2021 G.S. Brennan, A. Goriely. All rights reserved.
+#  Mathematical Institute, Oxford University
+#  Oxford, United Kingdom
+# -----------------------------------------------------------------
+
+import os
+import struct
+import hashlib
+import zipfile
+import threading
+import numpy as np
+
+
+# A Freesurfer color table.  This mirrors the colortable structure
+# of read_annotation.m:
+#   names:  the structure names
+#   table:  an (nEntries, 5) integer array whose rows are
+#           [R, G, B, T, ID] with ID = R + G*2^8 + B*2^16 + T*2^24
+#           the label value of the structure in an annotation
+#   ids:    the structure index of every entry
+#   origTab: the name of the original color table file
+class colorTable:
+
+    def __init__(self, names, rgbt, ids=None, origTab=''):
+        self.names = [str(n) for n in names]
+        self.origTab = origTab
+
+        rgbt = np.asarray(rgbt, dtype=np.int64).reshape(-1, 4)
+        self.table = np.empty((rgbt.shape[0], 5), dtype=np.int64)
+        self.table[:, :4] = rgbt
+        self.table[:, 4] = rgbt @ np.array([1, 2**8, 2**16, 2**24], dtype=np.int64)
+
+        if ids is None:
+            ids = np.arange(rgbt.shape[0])
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    # ------------
+    def getNumberOfEntries(self):
+        return len(self.names)
+
+    # ------------
+    # returns the entry index of the structure `name' or None
+    # if the color table has no such structure
+    def getStructureIndex(self, name):
+        if name in self.names:
+            return self.names.index(name)
+        return None
+
+
+# ------------
+# Returns a colorTable holding the region labels and current
+# RGB values of the parcellation `parc' (c.f. parcellations.py)
+# with one entry per region, in region index order
+def colorTableFromParcellation(parc, origTab=''):
+    rgb = parc.getRGBArray()
+    rgbt = np.zeros((rgb.shape[0], 4), dtype=np.int64)
+    rgbt[:, :3] = rgb
+
+    return colorTable(parc.getRegionLabels(), rgbt, origTab=origTab)
+
+# ------------
+# Reads a color table in the text format written by
+# activationBase.writeActivationCSV, i.e. one line per
+# structure of the form "index name R G B T"
+def readColorTableCSV(filename):
+    names = []
+    rgbt = []
+
+    with open(filename) as ifile:
+        for line in ifile:
+            fields = line.split()
+            if len(fields) >= 6:
+                names.append(fields[1])
+                rgbt.append([int(f) for f in fields[2:6]])
+
+    return colorTable(names, rgbt, origTab=filename)
+
+
+# ------------
+# Reads a color lookup table in Freesurfer's text format, e.g.
+# FreeSurferColorLUT.txt or the *.ctab files of an atlas: one line
+# "index name R G B A" per structure.  Blank lines and # comments are
+# skipped.  The index of every line is kept as the structure index.
+def readColorLUT(filename):
+    names = []
+    rgbt = []
+    ids = []
+
+    with open(filename) as ifile:
+        for line in ifile:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) >= 5:
+                ids.append(int(fields[0]))
+                names.append(fields[1])
+                rgba = [int(f) for f in fields[2:6]] + [0] * (6 - len(fields))
+                rgbt.append(rgba)
+
+    return colorTable(names, rgbt, ids, os.path.basename(filename))
+
+# ------------
+# Returns the text of a color table with the structure names `names'
+# and the (nEntries, 3) RGB array `rgb' in the format read by
+# readColorTableCSV (the transparency T is 0)
+def getColorTableCSV(names, rgb):
+    rows = np.asarray(rgb).tolist()
+    return ''.join([f"{i} {name} {r} {g} {b} 0\n" for i, (name, (r, g, b)) in enumerate(zip(names, rows))])
+
+
+# ------------
+def _readString(buf, offset):
+    n, = struct.unpack_from('>i', buf, offset)
+    s = buf[offset + 4:offset + 4 + n].split(b'\0', 1)[0].decode('latin-1')
+    return s, offset + 4 + n
+
+def _packString(s):
+    b = s.encode('latin-1') + b'\0'
+    return struct.pack('>i', len(b)) + b
+
+# ------------
+# Reads the color table of an annotation file starting at `offset'
+# of the file contents `buf'.  Both the original and the version 2
+# color table layouts are supported.
+def readColorTableBlock(buf, offset=0):
+    n, = struct.unpack_from('>i', buf, offset)
+    offset = offset + 4
+    names = []
+    rgbt = []
+    ids = []
+
+    if n > 0:
+        # the original format: the entries are not numbered
+        origTab, offset = _readString(buf, offset)
+        for i in range(n):
+            name, offset = _readString(buf, offset)
+            names.append(name)
+            rgbt.append(struct.unpack_from('>4i', buf, offset))
+            ids.append(i)
+            offset = offset + 16
+    else:
+        version = -n
+        if version != 2:
+            raise ValueError(f"Unsupported annotation color table version {version}")
+
+        # the maximum structure index (unused) precedes the file name
+        offset = offset + 4
+        origTab, offset = _readString(buf, offset)
+        nRead, = struct.unpack_from('>i', buf, offset)
+        offset = offset + 4
+
+        for i in range(nRead):
+            sid, = struct.unpack_from('>i', buf, offset)
+            name, offset = _readString(buf, offset + 4)
+            names.append(name)
+            rgbt.append(struct.unpack_from('>4i', buf, offset))
+            ids.append(sid)
+            offset = offset + 16
+
+    return colorTable(names, rgbt, ids, origTab), offset
+
+# ------------
+# Returns the bytes of the (version 2) color table block of an
+# annotation file for the colorTable `ctab'
+def getColorTableBlock(ctab):
+    parts = [struct.pack('>ii', -2, int(ctab.ids.max()) + 1 if len(ctab.ids) > 0 else 0),
+             _packString(ctab.origTab),
+             struct.pack('>i', ctab.getNumberOfEntries())]
+
+    # the numeric fields of all entries are packed at once
+    ids = ctab.ids.astype('>i4').tobytes()
+    rgbt = ctab.table[:, :4].astype('>i4').tobytes()
+
+    for i, name in enumerate(ctab.names):
+        parts.append(ids[4 * i:4 * i + 4])
+        parts.append(_packString(name))
+        parts.append(rgbt[16 * i:16 * i + 16])
+
+    return b''.join(parts)
+
+# ------------
+# Reads only the color table embedded in a Freesurfer annotation file
+# (None if there is none); the vertex labels are skipped
+def readAnnotationColorTable(filename):
+    with open(filename, 'rb') as ifile:
+        nv, = struct.unpack('>i', ifile.read(4))
+        ifile.seek(4 + 8 * nv)
+        buf = ifile.read()
+
+    if len(buf) < 4 or struct.unpack_from('>i', buf, 0)[0] == 0:
+        return None
+
+    return readColorTableBlock(buf, 4)[0]
+
+# ------------
+# Reads a Freesurfer annotation file (e.g. label/lh.aparc.annot).
+# Returns the tuple (vertices, labels, ctab) where
+#   vertices: the (0 based) vertex indices
+#   labels:   the label value of every vertex (c.f. colorTable)
+#   ctab:     the embedded colorTable (None if there is none)
+def readAnnotation(filename):
+    with open(filename, 'rb') as ifile:
+        buf = ifile.read()
+
+    nv, = struct.unpack_from('>i', buf, 0)
+    vl = np.frombuffer(buf, dtype='>i4', count=2 * nv, offset=4).reshape(nv, 2)
+    vertices = vl[:, 0].astype(np.int64)
+    labels = vl[:, 1].astype(np.int64)
+
+    ctab = None
+    offset = 4 + 8 * nv
+
+    if len(buf) >= offset + 4:
+        hasct, = struct.unpack_from('>i', buf, offset)
+        if hasct:
+            ctab, offset = readColorTableBlock(buf, offset + 4)
+
+    return vertices, labels, ctab
+
+# ------------
+# Writes a Freesurfer annotation file with the vertex indices
+# `vertices', vertex label values `labels' and colorTable `ctab'
+# (c.f. readAnnotation)
+def writeAnnotation(filename, vertices, labels, ctab):
+    vl = np.empty((len(vertices), 2), dtype='>i4')
+    vl[:, 0] = vertices
+    vl[:, 1] = labels
+
+    with open(filename, 'wb') as ofile:
+        ofile.write(struct.pack('>i', len(vertices)))
+        ofile.write(vl.tobytes())
+        ofile.write(struct.pack('>i', 1))
+        ofile.write(getColorTableBlock(ctab))
+
+# ------------
+# Reads a Freesurfer surface in the binary triangle format
+# (e.g. surf/lh.pial or surf/lh.inflated).  Returns the tuple
+# (coords, faces) where
+#   coords: an (nVertices, 3) float array of vertex coordinates
+#   faces:  an (nFaces, 3) integer array of (0 based) vertex indices
+def readSurface(filename):
+    with open(filename, 'rb') as ifile:
+        buf = ifile.read()
+
+    if buf[:3] != b'\xff\xff\xfe':
+        raise ValueError(f"{filename} is not a Freesurfer triangle surface file")
+
+    # the magic number is followed by two lines of text
+    offset = buf.index(b'\n', 3) + 1
+    offset = buf.index(b'\n', offset) + 1
+
+    nv, nf = struct.unpack_from('>ii', buf, offset)
+    offset = offset + 8
+
+    coords = np.frombuffer(buf, dtype='>f4', count=3 * nv, offset=offset).reshape(nv, 3)
+    faces = np.frombuffer(buf, dtype='>i4', count=3 * nf, offset=offset + 12 * nv).reshape(nf, 3)
+
+    return coords.astype(np.float64), faces.astype(np.int64)
+
+# ------------
+# Writes a Freesurfer surface in the binary triangle format
+# (c.f. readSurface)
+def writeSurface(filename, coords, faces, createdBy='pysurfing'):
+    with open(filename, 'wb') as ofile:
+        ofile.write(b'\xff\xff\xfe')
+        ofile.write(f"created by {createdBy}\n\n".encode('latin-1'))
+        ofile.write(struct.pack('>ii', len(coords), len(faces)))
+        ofile.write(np.asarray(coords, dtype='>f4').tobytes())
+        ofile.write(np.asarray(faces, dtype='>i4').tobytes())
+
+# ------------
+# Loads the arrays of an .npz file into a dictionary.  Arrays that
+# are stored uncompressed (as written by np.savez) are memory-mapped
+# directly from the archive instead of being read into memory.
+def loadNpz(filename):
+    res = {}
+
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as raw:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+
+            with zf.open(info) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+                headerlen = f.tell()
+
+            if info.compress_type == zipfile.ZIP_STORED and not dtype.hasobject and int(np.prod(shape)) > 0:
+                # the data follows the local file header of the member
+                raw.seek(info.header_offset + 26)
+                nlen, xlen = struct.unpack('<HH', raw.read(4))
+                offset = info.header_offset + 30 + nlen + xlen + headerlen
+
+                res[name] = np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                                      shape=shape, order='F' if fortran else 'C')
+            else:
+                with np.load(filename) as npz:
+                    res[name] = npz[name]
+
+    return res
+
+# ------------
+# Writes the arrays `arrays' (keyword arguments, as for np.savez) to the
+# .npz file `filename', creating its directory if needed.  The file is
+# written under a temporary name and then moved into place, so other
+# threads and processes never read a partial file.  Raises OSError if
+# the file cannot be written (the temporary file is removed).
+def saveNpz(filename, **arrays):
+    tmpfile = filename + f".{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(tmpfile, 'wb') as ofile:
+            np.savez(ofile, **arrays)
+        os.replace(tmpfile, filename)
+    except OSError:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+# ------------
+# Returns the default directory of the on-disk caches (e.g. of parsed
+# annotations and atlases): $XDG_CACHE_HOME/pysurfing, or
+# ~/.cache/pysurfing if XDG_CACHE_HOME is not set
+def getDefaultCacheDirectory():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'pysurfing')
+
+# ------------
+# Reads the color table of an atlas from a text lookup table (c.f.
+# readColorLUT) or, for *.annot files, from the table embedded in an
+# annotation (c.f. readAnnotationColorTable).  Parsed tables are kept in
+# a compiled .npz cache in cacheDir, so an atlas is parsed only once
+# and later processes load it directly.  A cache entry is discarded when
+# the atlas file changes.  The cache directory defaults to
+# $XDG_CACHE_HOME/pysurfing (or ~/.cache/pysurfing); use cacheDir=None
+# to disable the cache.
+def readAtlasColorTable(filename, cacheDir=''):
+    if cacheDir == '':
+        cacheDir = getDefaultCacheDirectory()
+
+    st = os.stat(filename)
+    stamp = [st.st_mtime_ns, st.st_size]
+
+    cachefile = None
+    if cacheDir is not None:
+        digest = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        cachefile = os.path.join(cacheDir, f"atlas-{digest}.npz")
+
+        try:
+            with np.load(cachefile) as npz:
+                if npz['stamp'].tolist() == stamp:
+                    return colorTable(npz['names'].tolist(), npz['rgbt'], npz['ids'], str(npz['origTab']))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
+
+    if filename.endswith('.annot'):
+        ctab = readAnnotationColorTable(filename)
+        if ctab is None:
+            raise ValueError(f"The annotation file {filename} has no color table")
+    else:
+        ctab = readColorLUT(filename)
+
+    if cachefile is not None:
+        try:
+            saveNpz(cachefile, stamp=np.array(stamp, dtype=np.int64), names=np.array(ctab.names, dtype=str),
+                    rgbt=ctab.table[:, :4], ids=ctab.ids, origTab=np.array(ctab.origTab))
+        except OSError:
+            # the cache is an optimization only
+            pass
+
+    return ctab
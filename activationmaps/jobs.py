@@ -0,0 +1,193 @@
+# ----------------------------------------------------------------
+# Oxford Mathematical Brain Modelling Group
+#   This file defines a job runner for the external programs
+#   (e.g. tksurfer) called by the activation map exporters
+#       1. Python v3.8 or higher
+#
+#
+#  Authors:
+#               Georgia S. Brennan          - georgia.brennan@maths.ox.ac.uk
+#               Travis B. Thompson          - thompsont@maths.ox.ac.uk
+#               Marie E. Rognes             - meg@simula.no
+#               Alain Goriely               - goriely@maths.ox.ac.uk
+#
+# Distribution
+# This code is distributed under the GNU GPL V3 License
+# https://www.gnu.org/licenses/gpl-3.0.html
+#
+#
+# Copyright (c) 2021 G.S. Brennan, A. Goriely. All rights reserved.
+#  Mathematical Institute, Oxford University
+#  Oxford, United Kingdom
+# -----------------------------------------------------------------
+
+import os
+import re
+import time
+import shlex
+import asyncio
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ------------
+# Splits the command `command' (a string or a list of arguments) into
+# the tuple (env, args) where env holds the leading NAME=value
+# assignments of the command (e.g. an LD_PRELOAD=... prefix as used
+# by setTksurferPreloadCommand) and args the program and its arguments
+def splitCommand(command):
+    args = shlex.split(command) if isinstance(command, str) else [str(a) for a in command]
+    env = {}
+
+    while len(args) > 0 and re.match(r'^[A-Za-z_][A-Za-z0-9_]*=', args[0]):
+        name, value = args.pop(0).split('=', 1)
+        env[name] = value
+
+    return env, args
+
+
+# The outcome of a job run by a jobRunner
+#   command:    the command that was run
+#   returncode: the exit status of the last attempt (None if it
+#               timed out or could not be started)
+#   stdout:     the captured standard output of the last attempt
+#               ('' if the output was not captured)
+#   stderr:     the captured standard error of the last attempt
+#               ('' if the output was not captured)
+#   attempts:   the number of times the command was run
+#   elapsed:    the wall time (in seconds) of all attempts
+#   timedOut:   True if the last attempt was killed at the timeout
+class jobResult:
+
+    def __init__(self, command):
+        self.command = command
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.attempts = 0
+        self.elapsed = 0.0
+        self.timedOut = False
+
+    # ------------
+    def succeeded(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return f"jobResult(returncode={self.returncode}, attempts={self.attempts}, elapsed={self.elapsed:.3f}, timedOut={self.timedOut})"
+
+
+# This class runs external programs (e.g. tksurfer) in a pool of at
+# most maxWorkers concurrent subprocesses.  Every job is run without
+# a shell, its output is captured and it is killed after `timeout'
+# seconds (None for no limit).  A job that fails or times out is run
+# again up to `retries' times.  The default timeout and number of
+# retries can be overridden per job.
+#
+# Jobs are run with run (blocking), submit (returns a
+# concurrent.futures.Future) or runAsync (a coroutine for asyncio
+# code); runAll and runAllAsync run a list of jobs concurrently and
+# return their results in order.  Use capture=False for interactive
+# programs whose console output should reach the terminal as it is
+# written instead of being buffered in memory.
+#
+# Example
+#   runner = jobRunner(maxWorkers=4, timeout=600, retries=1)
+#   results = runner.runAll([f"tksurfer bert lh pial -tcl frame{t}.tcl" for t in range(10)])
+#   print([r.succeeded() for r in results])
+class jobRunner:
+
+    def __init__(self, maxWorkers=None, timeout=None, retries=0, env=None):
+        self.maxWorkers = max(int(maxWorkers), 1) if maxWorkers is not None else (os.cpu_count() or 1)
+        self.timeout = timeout
+        self.retries = max(int(retries), 0)
+        self.env = dict(env) if env is not None else None
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.shutdown()
+        return False
+
+    # ------------
+    def __getPool(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix='pysurfing-job')
+
+        return self.pool
+
+    # ------------
+    # Waits for the submitted jobs and stops the worker threads
+    def shutdown(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
+            self.pool = None
+
+    # ------------
+    # Runs the command `command' (a string or a list of arguments, c.f.
+    # splitCommand) in the calling thread and returns its jobResult.
+    # With capture=False the output of the command is not captured but
+    # passed through to the standard output and error of this process.
+    def run(self, command, timeout=-1, retries=-1, cwd=None, capture=True):
+        timeout = self.timeout if timeout == -1 else timeout
+        retries = self.retries if retries == -1 else max(int(retries), 0)
+
+        result = jobResult(command)
+        extra, args = splitCommand(command)
+
+        env = dict(os.environ if self.env is None else self.env)
+        env.update(extra)
+
+        pipe = subprocess.PIPE if capture else None
+        t0 = time.perf_counter()
+
+        while result.attempts <= retries:
+            result.attempts = result.attempts + 1
+            result.timedOut = False
+
+            try:
+                proc = subprocess.run(args, stdout=pipe, stderr=pipe, env=env, cwd=cwd,
+                                      timeout=timeout, universal_newlines=True, errors='replace')
+                result.returncode = proc.returncode
+                result.stdout = proc.stdout or ''
+                result.stderr = proc.stderr or ''
+            except subprocess.TimeoutExpired as e:
+                result.returncode = None
+                result.timedOut = True
+                result.stdout = e.stdout.decode(errors='replace') if isinstance(e.stdout, bytes) else (e.stdout or '')
+                result.stderr = e.stderr.decode(errors='replace') if isinstance(e.stderr, bytes) else (e.stderr or '')
+            except OSError as e:
+                result.returncode = None
+                result.stdout = ''
+                result.stderr = str(e)
+
+            if result.succeeded():
+                break
+
+        result.elapsed = time.perf_counter() - t0
+        return result
+
+    # ------------
+    # Queues the command `command' (c.f. run) for one of the worker
+    # threads.  Returns a concurrent.futures.Future of its jobResult
+    def submit(self, command, timeout=-1, retries=-1, cwd=None, capture=True):
+        return self.__getPool().submit(self.run, command, timeout, retries, cwd, capture)
+
+    # ------------
+    # Runs the commands `commands' concurrently and returns the list of
+    # their jobResults (in the order of the commands)
+    def runAll(self, commands, timeout=-1, retries=-1, cwd=None, capture=True):
+        futures = [self.submit(c, timeout, retries, cwd, capture) for c in commands]
+        return [f.result() for f in futures]
+
+    # ------------
+    # The asyncio version of run: a coroutine that runs the command on
+    # the worker pool and returns its jobResult
+    async def runAsync(self, command, timeout=-1, retries=-1, cwd=None, capture=True):
+        return await asyncio.wrap_future(self.submit(command, timeout, retries, cwd, capture))
+
+    # ------------
+    # The asyncio version of runAll
+    async def runAllAsync(self, commands, timeout=-1, retries=-1, cwd=None, capture=True):
+        return list(await asyncio.gather(*[self.runAsync(c, timeout, retries, cwd, capture) for c in commands]))
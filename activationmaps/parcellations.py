@@ -23,41 +23,212 @@
 #  Oxford, United Kingdom
 # -----------------------------------------------------------------
 
-from activationmaps.coloring import getColor
+import numpy as np
+from activationmaps.coloring import getColors, getColormapLUT
+from activationmaps.freesurfer import readAtlasColorTable
+
+# A grouping of the regions of a parcellation into named groups (e.g.
+# the lobes of an atlas).  `groups' is a dictionary whose keys are the
+# group names and whose values are the region indices of the group;
+# groups may overlap.  The grouping is held as
+#   indices:    a sorted integer index array (without repeats) per group
+#   membership: a dense (nRegions, nGroups) 0/1 matrix whose entry (i, g)
+#               is 1 if region i belongs to group g
+#   regionGroup: the group of every region (the last group listed if
+#               a region is in several groups and -1 if in none)
+# so group values are aggregated from region values, and expanded back
+# to region values, for any number of timesteps in a single matrix
+# operation.
+#
+# Example (lobe averaged series)
+#   lobes = myParc.getRegionGrouping('Lobe')
+#   lobeValues = lobes.aggregate(series, 'mean')   # (T, nLobes)
+#   smoothed = lobes.expand(lobeValues)            # (T, nRegions)
+class regionGrouping:
+
+    def __init__(self, nRegions, groups):
+        self.nR = int(nRegions)
+        self.names = list(groups.keys())
+
+        # a region listed twice in a group counts once
+        self.indices = {name: np.unique(np.asarray(groups[name], dtype=np.int64).reshape(-1)) for name in self.names}
+
+        self.membership = np.zeros((self.nR, len(self.names)))
+        self.regionGroup = np.full(self.nR, -1, dtype=np.int64)
+
+        for g, name in enumerate(self.names):
+            self.membership[self.indices[name], g] = 1.0
+            self.regionGroup[self.indices[name]] = g
+
+        self.counts = self.membership.sum(axis=0)
+
+        # the region indices of all groups, concatenated in group
+        # order, and the start of every group (c.f. aggregate)
+        self.order = np.concatenate([self.indices[name] for name in self.names] + [np.empty(0, dtype=np.int64)])
+        self.starts = np.concatenate([[0], np.cumsum(self.counts[:-1])]).astype(np.int64) if len(self.names) > 0 else np.empty(0, dtype=np.int64)
+
+    # ------------
+    def getNumberOfGroups(self):
+        return len(self.names)
+
+    # ------------
+    def getGroupNames(self):
+        return list(self.names)
+
+    # ------------
+    # returns the region indices of the group `name' or None if the
+    # grouping has no such group
+    def getGroupIndices(self, name):
+        return self.indices.get(name)
+
+    # ------------
+    # returns the (nRegions, nGroups) membership matrix
+    def getMembershipMatrix(self):
+        return self.membership
+
+    # ------------
+    # returns the group index of every region (c.f. above)
+    def getRegionGroups(self):
+        return self.regionGroup
+
+    # ------------
+    # Aggregates region values into group values.  `values' is an array
+    # whose last axis is the region index, e.g. (nRegions,) for a single
+    # frame or (T, nRegions) for a series, and `how' is one of 'mean',
+    # 'sum', 'max' or 'min'.  Returns an array whose last axis is the
+    # group index.  Empty groups take the value nan (0 for 'sum').
+    def aggregate(self, values, how='mean'):
+        values = np.asarray(values, dtype=float)
+
+        if values.shape[-1] != self.nR:
+            print(f"Invalid value array of shape {values.shape}.  Expected one value for each of the {self.nR} regions")
+            return None
+
+        if how == 'sum':
+            return values @ self.membership
+
+        if how == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return (values @ self.membership) / self.counts
+
+        if how in ['max', 'min']:
+            ufunc = np.maximum if how == 'max' else np.minimum
+            res = np.full(values.shape[:-1] + (len(self.names),), np.nan)
+            nonempty = self.counts > 0
+
+            if nonempty.any():
+                res[..., nonempty] = ufunc.reduceat(values[..., self.order], self.starts[nonempty], axis=-1)
+
+            return res
+
+        print(f"{how} is not a supported aggregation.  Supported aggregations are ['mean', 'sum', 'max', 'min']")
+        return None
+
+    # ------------
+    # Expands group values (an array whose last axis is the group index)
+    # to region values: every region takes the value of its group (c.f.
+    # getRegionGroups) and regions in no group take floatval
+    def expand(self, groupValues, floatval=0.0):
+        groupValues = np.asarray(groupValues, dtype=float)
+        padded = np.concatenate([groupValues, np.full(groupValues.shape[:-1] + (1,), float(floatval))], axis=-1)
 
+        return padded[..., self.regionGroup]
+
+    # ------------
+    # Returns the grouping of the regions into parent groups of groups,
+    # e.g. hemispheres of lobes.  `parents' is a dictionary whose keys
+    # are the parent group names and whose values are lists of group
+    # names of this grouping; a parent holds the regions of its groups.
+    def getParentGrouping(self, parents):
+        groups = {}
+
+        for parent, children in parents.items():
+            members = [self.indices[child] for child in children if child in self.indices]
+            groups[parent] = np.unique(np.concatenate(members + [np.empty(0, dtype=np.int64)]))
+
+        return regionGrouping(self.nR, groups)
+
+    # ------------
+    # Returns the (nGroups, nParents) matrix that aggregates the values
+    # of these groups into the parent groups of getParentGrouping (1 if
+    # a group belongs to a parent)
+    def getParentMembershipMatrix(self, parents):
+        res = np.zeros((len(self.names), len(parents)))
+
+        for p, children in enumerate(parents.values()):
+            for child in children:
+                if child in self.indices:
+                    res[self.names.index(child), p] = 1.0
+
+        return res
+
+
+# The parcellation state is array backed: region labels are held in
+# a list indexed by region and the region colors in a contiguous
+# (nRegions, 3) numpy uint8 array whose row i is the [R, G, B] entry
+# of region i.  The per-region methods below operate on these arrays
+# and the bulk methods (e.g. getRGBArray) expose them directly.
 class parcellationBase:
 
+    __slots__ = ('nR', 'labels', 'RGB', 'defaultRGB', 'usecm', 'cmap', 'lutres',
+                 'labelTuple', 'labelLookup', 'exportedRGB', 'regionGroupings')
+
     # ------------
     def __init__(self,nRegions):
-        # A dictionary of the regions supported by
-        # your parcellation.
+        # The labels and colors of the regions supported
+        # by your parcellation.
 
         self.nR = int(nRegions)
-        self.RGB = {}
-        self.regionMap = {}
 
         # The default RGB value (defaults to gray in freesurfer)
         self.defaultRGB = [160, 160, 160]
         dstr = 'nolabel'
+
+        self.labels = [dstr] * self.nR
+        self.RGB = np.empty((self.nR, 3), dtype=np.uint8)
+        self.RGB[:] = self.defaultRGB
+
+        # The ordered label tuple and the label --> index lookup
+        # are built on demand and kept until a label changes
+        self.labelTuple = None
+        self.labelLookup = None
+
+        # The region colors at the time of the last export, keyed
+        # by exporter (c.f. getChangedRegions)
+        self.exportedRGB = {}
         
         # Do we use a matplotlib colormap
         self.usecm = False
         self.cmap = None
 
-        for i in range(self.nR):
-            self.regionMap[i] = dstr
-            self.RGB[i] = self.defaultRGB
+        # The resolution of the colormap lookup table used to
+        # color values (None means values are colored exactly)
+        self.lutres = None
+
+        # The named region groupings of the parcellation (c.f.
+        # regionGrouping), e.g. the lobes of an atlas
+        self.regionGroupings = {}
 
     # ------------
     def __checkRegionIndex(self,idxRgn):
         idxRgn = int(idxRgn)
 
-        if idxRgn < 0 or idxRgn > self.nR:
+        if idxRgn < 0 or idxRgn >= self.nR:
             print(f"Invalid Region index.  Valid range is an integer from 0 to {self.nR-1}")
             return False
 
         return True
 
+    # ------------
+    # Returns the persistent label --> index lookup (building it if
+    # a label has changed since it was last built).  This is the
+    # internal dictionary and must not be modified.
+    def __getLabelLookup(self):
+        if self.labelLookup is None:
+            self.labelLookup = {lab: i for i, lab in enumerate(self.labels)}
+
+        return self.labelLookup
+
     # ------------
     # Determines whether a matplotlib colormap should be used 
     # when deducing RGB values for this parcellation
@@ -81,6 +252,33 @@ class parcellationBase:
         else:
             self.cmap = None
             
+    # -------------
+    # Determines whether values are colored through a precomputed
+    # colormap lookup table (c.f. coloring.getColormapLUT) with
+    # `resolution' entries.  A table is considerably faster when
+    # many values are colored, e.g. over many simulation frames,
+    # at the cost of quantizing values to the table resolution.
+    #
+    # Example
+    #   use a 4096 entry table: setColormapResolution(4096)
+    #   color values exactly:   setColormapResolution(None)
+    def setColormapResolution(self, resolution):
+        if resolution is None:
+            self.lutres = None
+        else:
+            self.lutres = int(resolution)
+
+    # -------------
+    # Returns a numpy uint8 array of shape values.shape + (3,)
+    # holding the RGB colors of `values' (with min <= value <= max)
+    # under the current colormap configuration of this parcellation
+    def getColorsFromValues(self, values, min=0.0, max=1.0):
+        if self.lutres is None:
+            return getColors(values, min, max, self.usecm, self.cmap)
+
+        lut = getColormapLUT(self.usecm, self.cmap, self.lutres)
+        return lut.getColors(values, min, max)
+
     # -------------
     # Returns the internal colormap variables.  This function 
     # is used by the activation map <--> parcellation interface
@@ -93,7 +291,27 @@ class parcellationBase:
         idxRgn = int(idxRgn)
 
         if self.__checkRegionIndex(idxRgn):
-            self.regionMap[idxRgn] = strLabel
+            self.labels[idxRgn] = strLabel
+            self.labelTuple = None
+            self.labelLookup = None
+            self.exportedRGB = {}
+
+    # ------------
+    # label all regions at once; labels[i] is the label of region i
+    # Returns True if successful and False otherwise
+    def setRegionLabels(self, labels):
+        labels = [str(lab) for lab in labels]
+
+        if len(labels) != self.nR:
+            print(f"Invalid number of labels {len(labels)}.  Expected one label for each of the {self.nR} regions")
+            return False
+
+        self.labels = labels
+        self.labelTuple = None
+        self.labelLookup = None
+        self.exportedRGB = {}
+
+        return True
 
     # ------------
     def setRegionRGBValue(self, idxRgn, r, g, b):
@@ -102,17 +320,78 @@ class parcellationBase:
         if self.__checkRegionIndex(idxRgn):
             self.RGB[idxRgn] = [r, g, b]
 
+    # ------------
+    # Returns the (nRegions, 3) numpy uint8 array of region colors.
+    # Row i holds the [R, G, B] entry of region i.  This is the
+    # internal array (not a copy) so writes to it recolor regions.
+    def getRGBArray(self):
+        return self.RGB
+
+    # ------------
+    # Sets all region colors from an (nRegions, 3) array (or nested
+    # list) whose row i is the [R, G, B] entry of region i
+    def setRGBArray(self, rgb):
+        self.RGB[:] = rgb
+
+    # ------------
+    # Returns the default [R, G, B] color of the parcellation
+    def getDefaultRGB(self):
+        return self.defaultRGB
+
     # ------------
     def getNumberOfRegions(self):
         return self.nR
 
     # returns a list of all valid numerical region indices
     def getRegionIndices(self):
-        #x = []
-        #for i in range(self.nR):
-        #    x.append(i)
-        #return x
-        return list(self.regionMap.keys())
+        return list(range(self.nR))
+
+    # ------------
+    # Dirty region tracking.  Exporters call markExported(key) once
+    # they have exported the current colors; getChangedRegions(key)
+    # then returns the indices of the regions whose colors differ from
+    # those exported, so exporters can update only the affected
+    # vertices (or skip a frame entirely).  The key identifies the
+    # exporter so that several exporters can track the same parcellation.
+    #
+    # Returns None if nothing has been exported under `key' (or a
+    # label has changed since), i.e. every region should be exported
+    def getChangedRegions(self, key='default'):
+        exported = self.exportedRGB.get(key)
+
+        if exported is None:
+            return None
+
+        return np.flatnonzero(np.any(self.RGB != exported, axis=1))
+
+    # ------------
+    # Returns True if any region color changed since the last export
+    # under `key' (c.f. getChangedRegions)
+    def hasChangedRegions(self, key='default'):
+        exported = self.exportedRGB.get(key)
+        return exported is None or not np.array_equal(self.RGB, exported)
+
+    # ------------
+    # Records the current region colors as exported under `key'
+    def markExported(self, key='default'):
+        exported = self.exportedRGB.get(key)
+
+        if exported is None:
+            self.exportedRGB[key] = self.RGB.copy()
+        else:
+            exported[:] = self.RGB
+
+    # ------------
+    # Forgets all exports, i.e. every region is considered changed
+    def clearExported(self):
+        self.exportedRGB = {}
+
+    # returns a tuple of all region labels ordered by region index
+    def getRegionLabels(self):
+        if self.labelTuple is None:
+            self.labelTuple = tuple(self.labels)
+
+        return self.labelTuple
 
     #------------
     def getRegionLabel(self, idxRgn):
@@ -120,7 +399,7 @@ class parcellationBase:
         idxRgn = int(idxRgn)
 
         if self.__checkRegionIndex(idxRgn):
-            lab = self.regionMap[idxRgn]
+            lab = self.labels[idxRgn]
         else:
             print(f"Invalid region index {idxRgn} passed to getRegionLabel")
 
@@ -128,11 +407,11 @@ class parcellationBase:
 
     #------------
     def getRegionRGB(self, idxRgn):
-        rgbv = self.defaultRGB
+        rgbv = list(self.defaultRGB)
         idxRgn = int(idxRgn)
 
         if self.__checkRegionIndex(idxRgn):
-            rgbv = self.RGB[idxRgn]
+            rgbv = self.RGB[idxRgn].tolist()
         else:
             print(f"Invalid region index {idxRgn} passed to getRegionRGB")
 
@@ -143,13 +422,7 @@ class parcellationBase:
     # keys are region labels and whose indices
     # are the region indexes
     def getRegionToIndexMap(self):
-        res = {}
-
-        for k in self.regionMap:
-            val = self.regionMap[k]
-            res[val] = k
-
-        return res
+        return dict(self.__getLabelLookup())
 
 
     #-----------------
@@ -159,14 +432,7 @@ class parcellationBase:
     # an integer list [R, G, B] where
     # 0<= R, G, B, <= 255
     def getRegionRGBDictionary(self):
-        res = {}
-
-        ndx = self.getRegionIndices()
-        for i in ndx:
-            rgnstr = self.getRegionLabel(i)
-            res[rgnstr] = self.RGB[i]
-
-        return res
+        return dict(zip(self.getRegionLabels(), self.RGB.tolist()))
 
     # -----------------
     # Takes as input a dictionary whose keys
@@ -175,13 +441,12 @@ class parcellationBase:
     # integer array of the form [R, G, B]
     # where 0<= R,G,B <= 255
     def setFromRegionRGBDictionary(self,rdict):
-        lookup = self.getRegionToIndexMap()
+        lookup = self.__getLabelLookup()
         strndx = list(rdict.keys())
 
-        for j in strndx:
-            iRegion = lookup[strndx]
-            rgb = rdict[j]
-            self.setRegionRGBValue(iRegion, int(rgb[0]), int(rgb[1]), int(rgb[2]))
+        if len(strndx) > 0:
+            iRegions = [lookup[j] for j in strndx]
+            self.RGB[iRegions] = np.asarray([rdict[j][:3] for j in strndx], dtype=int)
 
     #------------
     # Returns a dictionary whose keys are region
@@ -191,15 +456,7 @@ class parcellationBase:
     #    floatval = x where x is a floating point.
     #    floatval = 0.0 by default
     def getRegionValueDictionary(self, floatval=0.0):
-        res = {}
-        finit = float(floatval)
-
-        ndx = self.getRegionIndices()
-        for i in ndx:
-            rgnstr = self.getRegionLabel(i)
-            res[rgnstr] = finit
-        
-        return res
+        return dict.fromkeys(self.getRegionLabels(), float(floatval))
 
 
     # -----------------
@@ -214,27 +471,274 @@ class parcellationBase:
     # if the option setMinToDefault == True then 
     # the default RGB color is used for all minimum values
     def setRGBfromValueDictionary(self, rdict, min=0.0, max=1.0, setMinToDefaultRGB=False):
-        lookup = self.getRegionToIndexMap()
+        lookup = self.__getLabelLookup()
         strndx = list(rdict.keys())
+        vals = [rdict[j] for j in strndx]
 
-        for j in strndx:
-            iRegion = lookup[j]
-            val = rdict[j]
-            
-            rgb = {'R':self.defaultRGB[0], 'G':self.defaultRGB[1], 'B':self.defaultRGB[2]}
-            
-            if setMinToDefaultRGB == False or val != min:
-                rgb = getColor(val, min, max, self.usecm, self.cmap)
-            
-            self.setRegionRGBValue(iRegion, rgb['R'], rgb['G'], rgb['B'])
+        # color all of the values in one pass
+        rgbs = self.getColorsFromValues(vals, min, max)
+
+        if setMinToDefaultRGB:
+            rgbs[np.asarray(vals, dtype=float) == min] = self.defaultRGB
+
+        if len(strndx) > 0:
+            self.RGB[[lookup[j] for j in strndx]] = rgbs
+
+    # -----------------
+    # Takes as input a dense array of floating point values ordered
+    # by region index, i.e. values[i] is the value of region i, and
+    # sets the colors of all regions in one vectorized step.  The
+    # options min, max and setMinToDefaultRGB have the same meaning
+    # as they do for setRGBfromValueDictionary.
+    # Returns True if successful and False otherwise
+    def setRGBfromValueArray(self, values, min=0.0, max=1.0, setMinToDefaultRGB=False):
+        vals = np.asarray(values, dtype=float)
+
+        if vals.shape != (self.nR,):
+            print(f"Invalid value array of shape {vals.shape}.  Expected one value for each of the {self.nR} regions")
+            return False
+
+        self.RGB[:] = self.getColorsFromValues(vals, min, max)
+
+        if setMinToDefaultRGB:
+            self.RGB[vals == min] = self.defaultRGB
+
+        return True
+
+    # -----------------
+    # Converts a dictionary whose keys are region labels
+    # (of the parcellation) and whose values are floating
+    # points into a dense numpy array ordered by region
+    # index.  Regions that are not present in the dictionary
+    # take the value floatval (0.0 by default)
+    def getValueArrayFromDictionary(self, rdict, floatval=0.0):
+        lookup = self.__getLabelLookup()
+        vals = np.full(self.nR, float(floatval))
+
+        if len(rdict) > 0:
+            vals[[lookup[j] for j in rdict]] = list(rdict.values())
+
+        return vals
+
+    #------------
+    # Adds (or replaces) the region grouping `groupStr'.  `groups' is a
+    # dictionary whose keys are the group names and whose values are
+    # the region indices of the group (c.f. regionGrouping)
+    def addRegionGrouping(self, groupStr, groups):
+        self.regionGroupings[groupStr] = regionGrouping(self.nR, groups)
+
+    #------------
+    # Returns the regionGrouping `groupStr' or None if there is none
+    def getRegionGrouping(self, groupStr):
+        return self.regionGroupings.get(groupStr)
+
+    # This function returns a list of supported groupings defined for this
+    # atlas.  The grouping keys can be used to set group-wide RGB values
+    def getSupportedGroupings(self):
+        return list(self.regionGroupings.keys())
+
+    # This function returns a list of identifiers for a particular grouping
+    # this list of identifiers can be used, directly, to set group RGB values
+    def getSubgroupings(self, groupStr):
+
+        retv = ['invalid group identifier string']
+
+        if groupStr in self.regionGroupings:
+            retv = self.regionGroupings[groupStr].getGroupNames()
+
+        return retv
+
+    # Set all RGB entries in the subgroup `subgroupStr' belonging to
+    # grouping `groupStr' to the indicated values.
+    # Example: setGroupRGB('Lobe', 'Frontal', 255, 0, 0)
+    # Returns true if successful and false otherwise
+    def setGroupRGB(self, groupStr, subgroupStr, R, G, B):
+        retv = False
+
+        if groupStr in self.regionGroupings:
+            subgids = self.regionGroupings[groupStr].getGroupIndices(subgroupStr)
+            if subgids is not None:
+                self.RGB[subgids] = [R, G, B]
+                retv = True
+            else:
+                print(f"{subgroupStr} is not a subgroup identifier of the grouping {groupStr}")
+        else:
+            print(f"{groupStr} is an invalid group identifier")
+
+        return retv
+
+    # Colors every group of the grouping `groupStr' by its value in the
+    # array groupValues (ordered as getSubgroupings(groupStr)) in one
+    # call.  Regions in no group keep their color.  The options min,
+    # max and setMinToDefaultRGB are as for setRGBfromValueArray.
+    # Returns True if successful and False otherwise
+    def setGroupRGBfromValueArray(self, groupStr, groupValues, min=0.0, max=1.0, setMinToDefaultRGB=False):
+        grouping = self.regionGroupings.get(groupStr)
+
+        if grouping is None:
+            print(f"{groupStr} is an invalid group identifier")
+            return False
+
+        vals = np.asarray(groupValues, dtype=float)
+
+        if vals.shape != (grouping.getNumberOfGroups(),):
+            print(f"Invalid value array of shape {vals.shape}.  Expected one value for each of the {grouping.getNumberOfGroups()} groups")
+            return False
+
+        rgbs = self.getColorsFromValues(vals, min, max)
+
+        if setMinToDefaultRGB:
+            rgbs[vals == min] = self.defaultRGB
+
+        regions = grouping.getRegionGroups()
+        member = regions >= 0
+        self.RGB[member] = rgbs[regions[member]]
+
+        return True
 
     #------------
     # Reset all regions to the default RGB color
     #    (amounts to a uniform reset of the parcellation)
     def resetToDefaultRGB(self):
-        indxs = self.getRegionIndices()
-        for i in indxs:
-            self.setRegionRGBValue(i, self.defaultRGB[0], self.defaultRGB[1], self.defaultRGB[2])
+        self.RGB[:] = self.defaultRGB
+
+
+# Returns a parcellation with one region per structure of the atlas
+# color table `filename', in table order.  The table can be a
+# Freesurfer text lookup table (e.g. FreeSurferColorLUT.txt or the
+# *.ctab of an atlas such as aparc.a2009s, DKT40 or a Schaefer
+# parcellation) or an annotation file (*.annot) whose embedded table is
+# used.  The parsed table is cached in cacheDir (c.f.
+# freesurfer.readAtlasColorTable) so large atlases load quickly.
+#
+# Options:
+#   atlasColors: set to True to start from the atlas colors instead
+#                of the default RGB color
+#
+# Example
+#   parc = parcellationFromAtlas('/path/to/bert/label/lh.aparc.a2009s.annot')
+#   myActivation = activationBase(parc)
+def parcellationFromAtlas(filename, cacheDir='', atlasColors=False):
+    ctab = readAtlasColorTable(filename, cacheDir)
+
+    parc = parcellationBase(ctab.getNumberOfEntries())
+    parc.setRegionLabels(ctab.names)
+
+    if atlasColors:
+        parc.setRGBArray(ctab.table[:, :3])
+
+    return parc
+
+
+# A whole brain parcellation holding the regions of both hemispheres
+# of the hemisphere parcellation `hemiParcellation' (e.g. an instance
+# of parcellationDesikanKillianyHemisphere) in one table.  Regions
+# 0, ..., n-1 are the left hemisphere and regions n, ..., 2n-1 the right
+# hemisphere; their labels are prefixed with 'lh.' and 'rh.'.
+#
+# getHemisphereParcellation returns a parcellation of a single
+# hemisphere whose colors are a view of the rows of that hemisphere, so
+# both hemispheres are colored by a single call on the whole brain
+# parcellation and each can be exported as an ordinary (hemisphere)
+# parcellation without copying.
+#
+# The region groupings of the hemisphere parcellation (e.g. 'Lobe') are
+# carried over: a group of the whole brain parcellation holds its
+# regions in both hemispheres and the hemisphere parcellations keep the
+# groupings of a single hemisphere.  So does its colormap configuration.
+class parcellationBilateral(parcellationBase):
+
+    __slots__ = ('nHemi', 'hemispheres')
+
+    def __init__(self, hemiParcellation):
+        labels = list(hemiParcellation.getRegionLabels())
+        self.nHemi = len(labels)
+
+        super().__init__(2 * self.nHemi)
+        self.defaultRGB = list(hemiParcellation.getDefaultRGB())
+        self.RGB[:] = self.defaultRGB
+        self.setRegionLabels(['lh.' + lab for lab in labels] + ['rh.' + lab for lab in labels])
+
+        self.hemispheres = {'lh': parcellationHemisphereView(self, 'lh', labels),
+                            'rh': parcellationHemisphereView(self, 'rh', labels)}
+
+        for groupStr, grouping in hemiParcellation.regionGroupings.items():
+            groups = {name: grouping.getGroupIndices(name) for name in grouping.getGroupNames()}
+            self.addRegionGrouping(groupStr, {name: np.concatenate([idx, idx + self.nHemi]) for name, idx in groups.items()})
+
+            for hemi in self.hemispheres.values():
+                hemi.addRegionGrouping(groupStr, groups)
+
+        self.setUseMatplotlibColorMap(*hemiParcellation.getCurrentMatplotlibColormapConfig())
+        self.setColormapResolution(hemiParcellation.lutres)
+
+    # ------------
+    # Returns the slice of the region indices of the hemisphere
+    # hemistr ('lh' or 'rh')
+    def getHemisphereSlice(self, hemistr):
+        if hemistr == 'lh':
+            return slice(0, self.nHemi)
+        return slice(self.nHemi, 2 * self.nHemi)
+
+    # ------------
+    # Returns the parcellation of the hemisphere hemistr ('lh' or 'rh')
+    # c.f. parcellationHemisphereView
+    def getHemisphereParcellation(self, hemistr):
+        return self.hemispheres[hemistr]
+
+    # ------------
+    # the colormap configuration is shared with the hemispheres
+    def setUseMatplotlibColorMap(self, use, cmap=None):
+        super().setUseMatplotlibColorMap(use, cmap)
+
+        for hemi in self.hemispheres.values():
+            parcellationBase.setUseMatplotlibColorMap(hemi, use, cmap)
+
+    # ------------
+    def setColormapResolution(self, resolution):
+        super().setColormapResolution(resolution)
+
+        for hemi in self.hemispheres.values():
+            parcellationBase.setColormapResolution(hemi, resolution)
+
+
+# The parcellation of one hemisphere of a parcellationBilateral.  Its
+# labels are the (unprefixed) hemisphere labels and its colors are a
+# view of the hemisphere's rows of the whole brain color table, so
+# changes to either are seen by both.  The colormap configuration
+# follows the whole brain parcellation.
+class parcellationHemisphereView(parcellationBase):
+
+    __slots__ = ('bilateral', 'hemi')
+
+    def __init__(self, bilateral, hemistr, labels):
+        super().__init__(len(labels))
+        self.setRegionLabels(labels)
+
+        self.bilateral = bilateral
+        self.hemi = hemistr
+        self.defaultRGB = bilateral.getDefaultRGB()
+        self.RGB = bilateral.getRGBArray()[bilateral.getHemisphereSlice(hemistr)]
+
+        use, cmap = bilateral.getCurrentMatplotlibColormapConfig()
+        parcellationBase.setUseMatplotlibColorMap(self, use, cmap)
+        parcellationBase.setColormapResolution(self, bilateral.lutres)
+
+    # ------------
+    def getHemisphere(self):
+        return self.hemi
+
+    # ------------
+    def getBilateralParcellation(self):
+        return self.bilateral
+
+    # ------------
+    def setUseMatplotlibColorMap(self, use, cmap=None):
+        self.bilateral.setUseMatplotlibColorMap(use, cmap)
+
+    # ------------
+    def setColormapResolution(self, resolution):
+        self.bilateral.setColormapResolution(resolution)
 
 
 # Specific parcellations provide two things
@@ -246,6 +750,8 @@ class parcellationBase:
 #       companion DK activation class
 class parcellationDesikanKillianyHemisphere(parcellationBase):
 
+    __slots__ = ()
+
     def __init__(self):
 
         # The Desikan Killiany atlas has 36 regions
@@ -291,10 +797,9 @@ class parcellationDesikanKillianyHemisphere(parcellationBase):
         super().setRegionLabel(34, 'transversetemporal')
         super().setRegionLabel(35, 'insula')
 
-        # Here we populate an internal dictionary which we must
-        # build manually.  This internal dictionary defines groupings
-        # for this atlas.
-        self.regionGroupings = {'Lobe':self.__setLobeIndices()}
+        # Here we populate the groupings of this atlas from
+        # dictionaries which we must build manually.
+        self.addRegionGrouping('Lobe', self.__setLobeIndices())
 
     def __setLobeIndices(self):
         # The list of lobes for the DK atlas can be found here
@@ -306,41 +811,3 @@ class parcellationDesikanKillianyHemisphere(parcellationBase):
                  'Occipital':[5, 11, 13, 21]}
 
         return lobes
-
-    # This function returns a list of supported groupings defined for this
-    # atlas.  The grouping keys can be used to set group-wide RGB values
-    def getSupportedGroupings(self):
-        return list(self.regionGroupings.keys())
-
-    # This function returns a list of identifiers for a particular grouping
-    # this list of identifiers can be used, directly, to set group RGB values
-    def getSubgroupings(self, groupStr):
-
-        retv = ['invalid group identifier string']
-
-        if groupStr in self.regionGroupings:
-            retv = list(self.regionGroupings[groupStr].keys())
-
-        return retv
-
-    # Set all RGB entries in the subgroup `subgroupStr' belonging to
-    # grouping `groupStr' to the indicated values.
-    # Example: setGroupRGB('Lobes', 'Frontal', 255, 0, 0)
-    # Returns true if successful and false otherwise
-    def setGroupRGB(self, groupStr, subgroupStr, R, G, B):
-        retv = False
-
-        if groupStr in self.regionGroupings:
-            if subgroupStr in self.regionGroupings[groupStr]:
-                subgids = self.regionGroupings[groupStr][subgroupStr]
-                for id in subgids:
-                    super().setRegionRGBValue(id, R, G, B)
-            else:
-                print(f"{subgroupStr} is not a subgroup identifier of the grouping {groupStr}")
-        else:
-            print(f"{groupStr} is an invalid group identifier")
-
-
-
-
-
@@ -0,0 +1,282 @@
+# ----------------------------------------------------------------
+# Oxford Mathematical Brain Modelling Group
+#   This file defines utilities for streaming (large) simulation
+#   results into the activation maps
+#       1. Python v3.8 or higher
+#       2. Python numpy package
+#
+#
+#  Authors:
+#               Georgia S. Brennan          - georgia.brennan@maths.ox.ac.uk
+#               Travis B. Thompson          - thompsont@maths.ox.ac.uk
+#               Marie E. Rognes             - meg@simula.no
+#               Alain Goriely               - goriely@maths.ox.ac.uk
+#
+# Distribution
+# This code is distributed under the GNU GPL V3 License
+# https://www.gnu.org/licenses/gpl-3.0.html
+#
+#
+# Copyright (c) 2021 G.S. Brennan, A. Goriely. All rights reserved.
+#  Mathematical Institute, Oxford University
+#  Oxford, United Kingdom
+# -----------------------------------------------------------------
+
+import os
+import zipfile
+from itertools import islice
+import numpy as np
+
+
+# This class reads simulation results, stored as a two dimensional
+# (time x region or region x time) table on disk, in chunks of
+# timesteps so that runs that do not fit in memory can be fed into
+# an activation map.  The supported formats are
+#
+#   .npy  the file is memory-mapped; only the chunk being colored
+#         is read from disk
+#   .npz  the array stored under `key' (by default the first array)
+#         is streamed from the archive.  The optional array `labels'
+#         of the archive holds the region label of every column
+#   .csv  (or any other extension) a delimited text table that is
+#         parsed a chunk of lines at a time.  If the first line is
+#         not numeric it is taken to be a header of region labels
+#
+# By default rows are timesteps and columns are regions (timeAxis=0).
+# Use timeAxis=1 for region x time files.  Region x time .npz and
+# text tables can not be streamed by timestep and are read into
+# memory once (.npy files are always memory-mapped).
+#
+# Example
+#   reader = simulationSeriesReader('/path/to/run.npy', timeAxis=1)
+#   for frame in reader.iterateFrames(myActivation):
+#       vis(myActivation)
+class simulationSeriesReader:
+
+    def __init__(self, filename, timeAxis=0, key=None, delimiter=',', labels=None):
+        self.filename = filename
+        self.timeAxis = int(timeAxis)
+        self.key = key
+        self.delimiter = delimiter
+        self.labels = None if labels is None else list(labels)
+
+        self.ext = os.path.splitext(filename)[1].lower()
+        self.shape = None
+        self.data = None
+        self.header = 0
+        self.range = None
+        self.ready = False
+
+        if self.timeAxis not in [0, 1]:
+            print(f"Invalid time axis {timeAxis}.  The time axis should be 0 or 1")
+        elif not os.path.exists(filename):
+            print(f"The simulation file {filename} does not exist")
+        elif self.ext == '.npy':
+            self.__openNpy()
+        elif self.ext == '.npz':
+            self.__openNpz()
+        else:
+            self.__openText()
+
+    # ------------
+    def __openNpy(self):
+        self.data = np.load(self.filename, mmap_mode='r')
+
+        if self.data.ndim != 2:
+            print(f"The simulation file {self.filename} should hold a two dimensional array")
+            return
+
+        self.shape = self.data.shape
+        self.ready = True
+
+    # ------------
+    def __openNpz(self):
+        with np.load(self.filename) as npz:
+            names = [n for n in npz.files if n != 'labels']
+
+            if self.key is None and len(names) > 0:
+                self.key = names[0]
+
+            if self.key not in npz.files:
+                print(f"The simulation file {self.filename} has no array {self.key}")
+                return
+
+            if self.labels is None and 'labels' in npz.files:
+                self.labels = [str(lab) for lab in npz['labels']]
+
+        with zipfile.ZipFile(self.filename) as zf:
+            with zf.open(self.key + '.npy') as f:
+                shape, fortran, dtype = self.__readNpyHeader(f)
+
+        if len(shape) != 2:
+            print(f"The array {self.key} of {self.filename} should be two dimensional")
+            return
+
+        self.shape = shape
+
+        # only C ordered time x region arrays are streamed by timestep
+        if fortran or self.timeAxis != 0:
+            with np.load(self.filename) as npz:
+                self.data = npz[self.key]
+
+        self.ready = True
+
+    # ------------
+    def __readNpyHeader(self, f):
+        version = np.lib.format.read_magic(f)
+
+        if version == (1, 0):
+            return np.lib.format.read_array_header_1_0(f)
+
+        return np.lib.format.read_array_header_2_0(f)
+
+    # ------------
+    def __openText(self):
+        with open(self.filename) as ifile:
+            first = ifile.readline().strip()
+            nRows = sum(1 for line in ifile if line.strip())
+
+        fields = [fld.strip() for fld in first.split(self.delimiter)]
+
+        try:
+            [float(fld) for fld in fields]
+            nRows = nRows + 1
+        except ValueError:
+            self.header = 1
+            if self.labels is None:
+                self.labels = fields
+
+        self.shape = (nRows, len(fields))
+
+        # region x time tables are read once
+        if self.timeAxis != 0:
+            self.data = np.loadtxt(self.filename, delimiter=self.delimiter, skiprows=self.header, ndmin=2)
+
+        self.ready = True
+
+    # ------------
+    def isReady(self):
+        return self.ready
+
+    # ------------
+    def getNumberOfTimesteps(self):
+        return self.shape[self.timeAxis] if self.ready else 0
+
+    # ------------
+    def getNumberOfRegions(self):
+        return self.shape[1 - self.timeAxis] if self.ready else 0
+
+    # ------------
+    # returns the region label of every column of the simulation
+    # or None if the file does not provide them
+    def getRegionLabels(self):
+        return self.labels
+
+    # ------------
+    # A generator of (t, nRegions) floating point blocks of (at most)
+    # chunkSize consecutive timesteps.  The columns are in file order.
+    def iterateChunks(self, chunkSize=256):
+        if not self.ready:
+            return
+
+        chunkSize = max(int(chunkSize), 1)
+        nT = self.getNumberOfTimesteps()
+
+        if self.data is not None:
+            for t in range(0, nT, chunkSize):
+                if self.timeAxis == 0:
+                    block = self.data[t:t + chunkSize]
+                else:
+                    block = self.data[:, t:t + chunkSize].T
+                yield np.asarray(block, dtype=float)
+
+        elif self.ext == '.npz':
+            with zipfile.ZipFile(self.filename) as zf:
+                with zf.open(self.key + '.npy') as f:
+                    shape, fortran, dtype = self.__readNpyHeader(f)
+                    rowbytes = shape[1] * dtype.itemsize
+
+                    for t in range(0, nT, chunkSize):
+                        nRows = min(chunkSize, nT - t)
+                        buf = f.read(nRows * rowbytes)
+                        yield np.frombuffer(buf, dtype=dtype).reshape(nRows, shape[1]).astype(float)
+
+        else:
+            with open(self.filename) as ifile:
+                lines = (line for line in islice(ifile, self.header, None) if line.strip())
+
+                while True:
+                    chunk = list(islice(lines, chunkSize))
+                    if len(chunk) == 0:
+                        break
+                    yield np.loadtxt(chunk, delimiter=self.delimiter, ndmin=2)
+
+    # ------------
+    # Returns the global (minimum, maximum) of the simulation.  The
+    # range is computed in a single streaming pass over the file (and
+    # remembered for later calls) so that it can be passed on as
+    # simMinval and simMaxval (c.f. activationBase.getEmptySimulationMap)
+    def getRange(self, chunkSize=256):
+        if self.range is None and self.ready:
+            minV = np.inf
+            maxV = -np.inf
+
+            for block in self.iterateChunks(chunkSize):
+                if block.size > 0:
+                    minV = min(minV, float(np.nanmin(block)))
+                    maxV = max(maxV, float(np.nanmax(block)))
+
+            if minV > maxV:
+                minV, maxV = 0.0, 1.0
+
+            self.range = (minV, maxV)
+
+        return self.range
+
+    # ------------
+    # As iterateChunks but the columns of every block are ordered by
+    # the region index of the parcellation `parc'.  If the file provides
+    # region labels, regions of the parcellation without a column take
+    # the value floatval.  Otherwise the file should hold one column per
+    # region of the parcellation, in region index order.
+    def iterateParcellationChunks(self, parc, chunkSize=256, floatval=0.0):
+        if not self.ready:
+            return
+
+        nR = parc.getNumberOfRegions()
+
+        if self.labels is None:
+            if self.getNumberOfRegions() != nR:
+                print(f"The simulation file has {self.getNumberOfRegions()} regions but the parcellation has {nR}")
+                return
+
+            yield from self.iterateChunks(chunkSize)
+            return
+
+        lookup = parc.getRegionToIndexMap()
+        cols = [j for j, lab in enumerate(self.labels) if lab in lookup]
+        ndx = [lookup[self.labels[j]] for j in cols]
+
+        for block in self.iterateChunks(chunkSize):
+            values = np.full((block.shape[0], nR), float(floatval))
+            values[:, ndx] = block[:, cols]
+            yield values
+
+    # ------------
+    # A generator that feeds the simulation into the activation map
+    # `actv' chunk by chunk and yields the frame of every timestep
+    # (c.f. activationBase.iterateSimulationFrames).  The global minimum
+    # and maximum are computed with getRange unless they are given.
+    def iterateFrames(self, actv, chunkSize=256, simMinval=None, simMaxval=None,
+                      setMinToDefaultRGB=False, setParcellation=True):
+        if not self.ready:
+            return
+
+        if simMinval is None or simMaxval is None:
+            minV, maxV = self.getRange(chunkSize)
+            simMinval = minV if simMinval is None else simMinval
+            simMaxval = maxV if simMaxval is None else simMaxval
+
+        blocks = self.iterateParcellationChunks(actv.getParcellation(), chunkSize, simMinval)
+
+        yield from actv.iterateColoredBlocks(blocks, simMinval, simMaxval, setMinToDefaultRGB, setParcellation)
@@ -3,10 +3,9 @@
 #   Lobe activation map script - This script requires the
 #   following software / packages to be present
 #       1. Freesurfer v.7  (https://surfer.nmr.mgh.harvard.edu/fswiki/rel7downloads)
-#       2. Matlab
-#       3. Python v3.8 or higher
-#       4. Python numpy package
-#       5. Python matplotlib package
+#       2. Python v3.8 or higher
+#       3. Python numpy package
+#       4. Python matplotlib package
 #
 #
 #  Authors:
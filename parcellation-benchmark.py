@@ -0,0 +1,125 @@
+# ----------------------------------------------------------------
+# Oxford Mathematical Brain Modelling Group
+#   Parcellation micro-benchmark - This script requires the
+#   following software / packages to be present
+#       1. Python v3.8 or higher
+#       2. Python numpy package
+#       3. Python matplotlib package
+#       4. git (to time the code of an earlier revision)
+#
+#
+#  Authors:
+#               Georgia S. Brennan          - georgia.brennan@maths.ox.ac.uk
+#               Travis B. Thompson          - thompsont@maths.ox.ac.uk
+#               Marie E. Rognes             - meg@simula.no
+#               Alain Goriely               - goriely@maths.ox.ac.uk
+#
+# Distribution
+# This code is distributed under the GNU GPL V3 License
+# https://www.gnu.org/licenses/gpl-3.0.html
+#
+#
+# Copyright (c) 2021 G.S. Brennan, A. Goriely. All rights reserved.
+#  Mathematical Institute, Oxford University
+#  Oxford, United Kingdom
+# -----------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import subprocess
+import timeit
+import numpy as np
+from activationmaps.parcellations import parcellationBase
+from activationmaps.activations import activationBase
+
+
+#-----------------------------------------------------------------
+# A synthetic atlas with nRegions labelled regions
+def syntheticParcellation(nRegions):
+    p = parcellationBase(nRegions)
+    for i in range(nRegions):
+        p.setRegionLabel(i, f"region{i}")
+    return p
+
+#-----------------------------------------------------------------
+# Returns the time (in seconds) of coloring one simulation frame on a
+# synthetic nRegions region atlas with the activationmaps package that
+# was imported.  Only calls that every version of the package supports
+# are used, so the same function times the current and older versions.
+def timeFrame(nRegions, nRepeat):
+    myActivationMap = activationBase(syntheticParcellation(nRegions))
+    simulationResults = myActivationMap.getEmptySimulationMap(simMinval=0.0, simMaxval=1.0)
+
+    regions = [r for r in simulationResults if r not in ['simulationMinimumValue', 'simulationMaximumValue']]
+    rng = np.random.default_rng(0)
+    for region, value in zip(regions, rng.random(nRegions)):
+        simulationResults[region] = float(value)
+
+    return timeit.timeit(lambda: myActivationMap.setActivationFromSimulationResult(simulationResults), number=nRepeat) / nRepeat
+
+#-----------------------------------------------------------------
+# Times a frame with the activationmaps package of the git revision
+# `revision' of this repository.  The package of that revision is
+# extracted to a temporary directory and this script is run there
+# (with --frame-only), so the old code is measured as it was written.
+def timeRevisionFrame(revision, nRegions, nRepeat):
+    repo = os.path.dirname(os.path.abspath(__file__))
+    tmpdir = tempfile.mkdtemp(prefix='pysurfing-benchmark-')
+
+    try:
+        archive = subprocess.run(['git', 'archive', revision, 'activationmaps'], cwd=repo,
+                                 stdout=subprocess.PIPE, check=True).stdout
+        with open(os.path.join(tmpdir, 'package.tar'), 'wb') as ofile:
+            ofile.write(archive)
+        with tarfile.open(os.path.join(tmpdir, 'package.tar')) as tar:
+            tar.extractall(tmpdir)
+
+        shutil.copyfile(os.path.abspath(__file__), os.path.join(tmpdir, 'benchmark.py'))
+        out = subprocess.run([sys.executable, os.path.join(tmpdir, 'benchmark.py'), '--frame-only', str(nRegions), str(nRepeat)],
+                             cwd=tmpdir, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+
+        return float(out.split()[-1])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+#-----------------------------------------------------------------
+# Returns the first commit of this repository (the code before any
+# of the array backed parcellation work)
+def getBaselineRevision():
+    repo = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run(['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=repo,
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+
+    return out.split()[-1]
+#-----------------------------------------------------------------
+
+
+
+
+# Main function - this is where the program begins execution
+#
+# Usage
+#   python parcellation-benchmark.py [revision]
+#
+# times the coloring of a single simulation frame on a synthetic 1000
+# region atlas with the current code and with the code of the git
+# revision `revision' (by default the first commit of the repository)
+if __name__ == "__main__":
+    nRegions = 1000
+    nRepeat = 50
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--frame-only':
+        print(timeFrame(int(sys.argv[2]), int(sys.argv[3])))
+        sys.exit(0)
+
+    revision = sys.argv[1] if len(sys.argv) > 1 else getBaselineRevision()
+
+    before = timeRevisionFrame(revision, nRegions, nRepeat)
+    after = timeFrame(nRegions, nRepeat)
+
+    print(f"Per-frame cost on a {nRegions} region atlas")
+    print(f"   before (revision {revision[:12]}): {1000 * before:.3f} ms")
+    print(f"   after  (working tree):         {1000 * after:.3f} ms")
@@ -3,10 +3,9 @@
 #   Simulation activation map demo script - This script requires the
 #   following software / packages to be present
 #       1. Freesurfer v.7  (https://surfer.nmr.mgh.harvard.edu/fswiki/rel7downloads)
-#       2. Matlab
-#       3. Python v3.8 or higher
-#       4. Python numpy package
-#       5. Python matplotlib package
+#       2. Python v3.8 or higher
+#       3. Python numpy package
+#       4. Python matplotlib package
 #
 #
 #  Authors:
@@ -190,6 +189,12 @@ if __name__ == "__main__":
         # you can manipulate the visualization, as desired, and save the 
         # resulting figure for your publication.
         vis(myActivationMap)
+
+    # Alternatively, the whole series can be colored in batches and
+    # visualized frame by frame without building a simulation map:
+    #
+    # for frame in myActivationMap.iterateSimulationFrames(simValues, simMinval=0.0, simMaxval=1.0):
+    #     vis(myActivationMap)
    
     # Show the activation color bar (optional) 
     # myActivationMap.showActivationColorbar(30)
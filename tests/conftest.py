@@ -0,0 +1,65 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# the tests import the activationmaps package from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from activationmaps.freesurfer import colorTable, writeAnnotation, writeSurface
+
+
+# ------------
+# Returns the (coords, faces) of an octahedron, a small closed mesh
+# of 6 vertices and 8 triangles
+def getOctahedron():
+    coords = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]], dtype=float)
+    faces = np.array([[0, 2, 4], [2, 1, 4], [1, 3, 4], [3, 0, 4],
+                      [2, 0, 5], [1, 2, 5], [3, 1, 5], [0, 3, 5]])
+    return coords, faces
+
+
+# ------------
+# A synthetic Freesurfer subject 'synth' with a pial surface and an
+# aparc annotation for both hemispheres.  The annotation labels
+# vertices 0-4 with Desikan-Killiany structures and leaves vertex 5
+# without a structure.  Returns the subject directory.
+@pytest.fixture
+def subjectPath(tmp_path):
+    coords, faces = getOctahedron()
+    names = ['unknown', 'bankssts', 'cuneus', 'insula', 'precuneus']
+    ctab = colorTable(names, [[25, 5, 25, 0], [25, 100, 40, 0], [220, 180, 140, 0],
+                              [255, 192, 32, 0], [160, 140, 180, 0]], origTab='synth.ctab')
+    labels = np.append(ctab.table[[1, 2, 3, 4, 1], 4], 0)
+
+    for hemistr in ['lh', 'rh']:
+        os.makedirs(tmp_path / 'synth' / 'surf', exist_ok=True)
+        os.makedirs(tmp_path / 'synth' / 'label', exist_ok=True)
+        writeSurface(str(tmp_path / 'synth' / 'surf' / f"{hemistr}.pial"), coords, faces)
+        writeAnnotation(str(tmp_path / 'synth' / 'label' / f"{hemistr}.aparc.annot"), np.arange(6), labels, ctab)
+
+    return str(tmp_path)
+
+
+# ------------
+# Puts the stand-in tksurfer of tests/bin first on the PATH and logs
+# its calls (c.f. tests/bin/tksurfer).  Returns the log file.
+@pytest.fixture
+def tksurferLog(tmp_path, monkeypatch):
+    bindir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+    log = str(tmp_path / 'tksurfer.log')
+
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('TKSURFER_LOG', log)
+
+    return log
+
+
+# ------------
+# Returns the calls logged by the stand-in tksurfer
+def readTksurferLog(log):
+    if not os.path.exists(log):
+        return []
+
+    with open(log) as ifile:
+        return [line.rstrip('\n') for line in ifile]
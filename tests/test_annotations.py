@@ -0,0 +1,123 @@
+# Round-trip tests of the native Freesurfer annotation reader and
+# writer (c.f. freesurfer.py) and of the color table replacement that
+# replaces replace_ctab.m (c.f. exporting.replaceColorTable)
+
+import struct
+import numpy as np
+import pytest
+from activationmaps.freesurfer import colorTable, readAnnotation, writeAnnotation, readAnnotationColorTable
+from activationmaps.exporting import replaceColorTable
+
+
+# ------------
+def _packString(s):
+    b = s.encode('latin-1') + b'\0'
+    return struct.pack('>i', len(b)) + b
+
+# ------------
+# Writes an annotation with the original (unnumbered) color table
+# layout, as written by old versions of Freesurfer
+def _writeOriginalAnnotation(filename, vertices, labels, ctab):
+    with open(filename, 'wb') as ofile:
+        ofile.write(struct.pack('>i', len(vertices)))
+        vl = np.empty((len(vertices), 2), dtype='>i4')
+        vl[:, 0] = vertices
+        vl[:, 1] = labels
+        ofile.write(vl.tobytes())
+        ofile.write(struct.pack('>ii', 1, ctab.getNumberOfEntries()))
+        ofile.write(_packString(ctab.origTab))
+        for name, row in zip(ctab.names, ctab.table):
+            ofile.write(_packString(name))
+            ofile.write(struct.pack('>4i', *[int(v) for v in row[:4]]))
+
+# ------------
+# A synthetic annotation of 12 vertices with 4 structures; the
+# vertices are listed out of order and vertex 11 has no structure
+@pytest.fixture
+def annotation():
+    ctab = colorTable(['unknown', 'bankssts', 'cuneus', 'insula'],
+                      [[25, 5, 25, 0], [25, 100, 40, 0], [220, 180, 140, 0], [255, 192, 32, 0]],
+                      origTab='synthetic.ctab')
+    vertices = np.array([3, 0, 1, 2, 4, 5, 6, 7, 8, 9, 10, 11])
+    regions = np.array([1, 1, 2, 2, 3, 3, 0, 1, 2, 3, 0, -1])
+    labels = np.where(regions >= 0, ctab.table[regions, 4], 0)
+
+    return vertices, labels, ctab
+
+# ------------
+def _assertSameTable(a, b):
+    assert a.names == b.names
+    assert a.origTab == b.origTab
+    assert np.array_equal(a.table, b.table)
+    assert np.array_equal(a.ids, b.ids)
+
+# ------------
+@pytest.mark.parametrize('layout', ['original', 'version2'])
+def test_read_annotation(tmp_path, annotation, layout):
+    vertices, labels, ctab = annotation
+    filename = str(tmp_path / 'lh.synthetic.annot')
+
+    if layout == 'original':
+        _writeOriginalAnnotation(filename, vertices, labels, ctab)
+    else:
+        writeAnnotation(filename, vertices, labels, ctab)
+
+    rv, rl, rctab = readAnnotation(filename)
+
+    assert np.array_equal(rv, vertices)
+    assert np.array_equal(rl, labels)
+    _assertSameTable(rctab, ctab)
+    _assertSameTable(readAnnotationColorTable(filename), ctab)
+
+# ------------
+def test_write_annotation_round_trip(tmp_path, annotation):
+    vertices, labels, ctab = annotation
+    first = str(tmp_path / 'first.annot')
+    second = str(tmp_path / 'second.annot')
+
+    _writeOriginalAnnotation(first, vertices, labels, ctab)
+    writeAnnotation(second, *readAnnotation(first))
+    rv, rl, rctab = readAnnotation(second)
+
+    assert np.array_equal(rv, vertices)
+    assert np.array_equal(rl, labels)
+    _assertSameTable(rctab, ctab)
+
+    # writing what was read reproduces the file byte for byte
+    third = str(tmp_path / 'third.annot')
+    writeAnnotation(third, rv, rl, rctab)
+    with open(second, 'rb') as a, open(third, 'rb') as b:
+        assert a.read() == b.read()
+
+# ------------
+@pytest.mark.parametrize('layout', ['original', 'version2'])
+def test_replace_color_table(tmp_path, annotation, layout):
+    vertices, labels, ctab = annotation
+    oldfile = str(tmp_path / 'lh.synthetic.annot')
+    newfile = str(tmp_path / 'lh.synthetic.annot.vis')
+
+    if layout == 'original':
+        _writeOriginalAnnotation(oldfile, vertices, labels, ctab)
+    else:
+        writeAnnotation(oldfile, vertices, labels, ctab)
+
+    # the new table is reordered, recolored and lacks 'bankssts'
+    newctab = colorTable(['insula', 'cuneus', 'unknown', 'precuneus'],
+                         [[255, 0, 0, 0], [0, 255, 0, 0], [0, 0, 255, 0], [9, 9, 9, 0]],
+                         origTab='new.ctab')
+    replaceColorTable(oldfile, newctab, newfile)
+
+    rv, rl, rctab = readAnnotation(newfile)
+    _assertSameTable(rctab, newctab)
+    assert np.array_equal(rv, vertices)
+
+    oldnames = {int(row[4]): name for name, row in zip(ctab.names, ctab.table)}
+    newids = {name: int(row[4]) for name, row in zip(newctab.names, newctab.table)}
+
+    for label, newlabel in zip(labels, rl):
+        # vertices whose structure is missing from the new table
+        # (or that had no structure) take the label 0
+        expected = newids.get(oldnames.get(int(label)), 0)
+        assert newlabel == expected
+
+    assert np.count_nonzero(rl == 0) == 4
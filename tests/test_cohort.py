@@ -0,0 +1,19 @@
+# Tests of the process-pool cohort renderer (c.f. cohort.py), using the
+# stand-in tksurfer of tests/bin
+
+import os
+import numpy as np
+from activationmaps.cohort import cohortRenderer
+
+
+# ------------
+def test_tksurfer_cohort(tksurferLog, subjectPath, tmp_path, monkeypatch):
+    # tksurfer is run from the PATH, so no Freesurfer path is needed
+    monkeypatch.delenv('FREESURFER_HOME', raising=False)
+    cohort = cohortRenderer(subjectPath, str(tmp_path / 'out'), 1, renderer='tksurfer', annotationCacheDir=None)
+
+    report = cohort.render([('synth', 'Left', np.random.rand(3, 36), 'run')])
+
+    assert report['failed'] == []
+    assert report['frames'] == 3 and report['images'] == 6
+    assert os.path.exists(str(tmp_path / 'out' / 'synth' / 'lh' / 'run_0002_lateral.tiff'))
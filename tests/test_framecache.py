@@ -0,0 +1,52 @@
+# Tests of the disk cache of exported frames (c.f. exporting.frameCache)
+
+import os
+from conftest import getOctahedron
+from activationmaps.freesurfer import writeSurface
+from activationmaps.activations import activationDesikanKilliany
+from activationmaps.exporting import frameCache
+
+
+# ------------
+def test_foreign_files_survive_eviction(tmp_path):
+    cacheDir = str(tmp_path / 'cache')
+    os.makedirs(cacheDir)
+    foreign = os.path.join(cacheDir, 'notes.txt')
+    with open(foreign, 'wb') as f:
+        f.write(b'x' * 4096)
+
+    frame = str(tmp_path / 'frame.png')
+    with open(frame, 'wb') as f:
+        f.write(b'y' * 1024)
+
+    cache = frameCache(cacheDir, maxBytes=1500)
+    assert cache.nBytes == 0
+
+    cache.store('a' * 40 + '.png', frame)
+    cache.store('b' * 40 + '.png', frame)
+
+    assert os.path.exists(foreign)
+    assert not os.path.exists(os.path.join(cacheDir, 'a' * 40 + '.png'))
+    assert os.path.exists(os.path.join(cacheDir, 'b' * 40 + '.png'))
+    assert cache.nBytes == 1024
+
+# ------------
+def test_key_follows_subject_files(subjectPath):
+    cache = frameCache(os.path.join(subjectPath, 'cache'))
+    parc = activationDesikanKilliany('Left').getParcellation()
+    subject = os.path.join(subjectPath, 'synth')
+
+    annotKey = cache.getFrameKey(parc, subject, 'lh', 'annot')
+    imageKey = cache.getFrameKey(parc, subject, 'lh', 'png', 'lat', surface='pial')
+    assert cache.getFrameKey(parc, subject, 'lh', 'annot') == annotKey
+
+    # a new surface changes the keys of the images only
+    coords, faces = getOctahedron()
+    writeSurface(os.path.join(subject, 'surf', 'lh.pial'), 2 * coords, faces)
+    os.utime(os.path.join(subject, 'surf', 'lh.pial'), ns=(1, 1))
+    assert cache.getFrameKey(parc, subject, 'lh', 'annot') == annotKey
+    assert cache.getFrameKey(parc, subject, 'lh', 'png', 'lat', surface='pial') != imageKey
+
+    # a new base annotation changes all the keys
+    os.utime(os.path.join(subject, 'label', 'lh.aparc.annot'), ns=(1, 1))
+    assert cache.getFrameKey(parc, subject, 'lh', 'annot') != annotKey
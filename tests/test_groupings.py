@@ -0,0 +1,95 @@
+# Tests of the vectorized region groupings (c.f.
+# parcellations.regionGrouping) and group coloring
+
+import numpy as np
+import pytest
+from activationmaps.parcellations import regionGrouping, parcellationDesikanKillianyHemisphere
+from activationmaps.activations import activationDesikanKilliany, activationBilateral
+
+
+# ------------
+@pytest.mark.parametrize('how, reduce', [('mean', np.mean), ('sum', np.sum), ('max', np.max), ('min', np.min)])
+def test_aggregate(how, reduce):
+    # overlapping groups, a repeated region and an empty group
+    groups = {'A': [0, 0, 1], 'B': [], 'C': [2, 3], 'D': [3, 4, 1]}
+    grouping = regionGrouping(6, groups)
+    values = np.random.default_rng(1).random((10, 6))
+
+    res = grouping.aggregate(values, how)
+
+    assert res.shape == (10, 4)
+    for g, name in enumerate(groups):
+        if len(groups[name]) == 0:
+            assert np.all(np.isnan(res[:, g])) if how != 'sum' else np.all(res[:, g] == 0)
+        else:
+            assert np.allclose(res[:, g], reduce(values[:, np.unique(groups[name])], axis=1))
+
+    # a single frame
+    assert np.allclose(grouping.aggregate(values[3], how), res[3], equal_nan=True)
+
+# ------------
+def test_repeated_regions():
+    grouping = regionGrouping(4, {'A': [0, 0, 1], 'C': [2, 3]})
+    values = np.array([1.0, 2.0, 3.0, 4.0])
+
+    assert np.array_equal(grouping.aggregate(values, 'max'), [2.0, 4.0])
+    assert np.array_equal(grouping.aggregate(values, 'min'), [1.0, 3.0])
+    assert np.array_equal(grouping.aggregate(values, 'mean'), [1.5, 3.5])
+
+# ------------
+def test_expand_and_parents():
+    grouping = regionGrouping(5, {'A': [0, 1], 'B': [2], 'C': [3]})
+
+    assert np.array_equal(grouping.expand([[1.0, 2.0, 3.0]], floatval=-1.0), [[1.0, 1.0, 2.0, 3.0, -1.0]])
+
+    parents = {'AB': ['A', 'B'], 'C': ['C']}
+    parent = grouping.getParentGrouping(parents)
+    values = np.arange(5.0)
+
+    assert parent.getGroupNames() == ['AB', 'C']
+    assert np.array_equal(parent.aggregate(values, 'sum'), grouping.aggregate(values, 'sum') @ grouping.getParentMembershipMatrix(parents))
+
+# ------------
+def test_lobe_coloring():
+    actv = activationDesikanKilliany('Left')
+    parc = actv.getParcellation()
+    lobes = parc.getRegionGrouping('Lobe')
+
+    assert parc.getSubgroupings('Lobe') == ['Frontal', 'Parietal', 'Temporal', 'Occipital']
+    assert parc.setGroupRGB('Lobe', 'Temporal', 1, 2, 3)
+    assert all(tuple(parc.getRGBArray()[r]) == (1, 2, 3) for r in lobes.getGroupIndices('Temporal'))
+    assert not parc.setGroupRGB('Lobe', 'Limbic', 1, 2, 3)
+
+    assert parc.setGroupRGBfromValueArray('Lobe', [0.0, 0.25, 0.5, 1.0])
+    rgb = parc.getRGBArray()
+    for g, name in enumerate(lobes.getGroupNames()):
+        expected = parc.getColorsFromValues(np.array([[0.0, 0.25, 0.5, 1.0][g]]))[0]
+        assert all(tuple(rgb[r]) == tuple(expected) for r in lobes.getGroupIndices(name))
+
+# ------------
+def test_bilateral_lobes():
+    actv = activationBilateral()
+    parc = actv.getParcellation()
+    nHemi = parc.getNumberOfRegions() // 2
+    lobes = parc.getRegionGrouping('Lobe')
+    hemiLobes = parc.getHemisphereParcellation('rh').getRegionGrouping('Lobe')
+    values = np.random.default_rng(2).random(2 * nHemi)
+
+    assert lobes.getGroupNames() == ['Frontal', 'Parietal', 'Temporal', 'Occipital']
+    res = lobes.aggregate(values, 'mean')
+    for g, name in enumerate(lobes.getGroupNames()):
+        idx = hemiLobes.getGroupIndices(name)
+        assert np.isclose(res[g], np.mean(np.concatenate([values[idx], values[idx + nHemi]])))
+
+    assert np.allclose(hemiLobes.aggregate(values[nHemi:], 'mean'), [np.mean(values[nHemi + hemiLobes.getGroupIndices(name)]) for name in hemiLobes.getGroupNames()])
+
+# ------------
+def test_bilateral_colormap_config():
+    hemiParc = parcellationDesikanKillianyHemisphere()
+    hemiParc.setUseMatplotlibColorMap(True, 'viridis')
+    hemiParc.setColormapResolution(256)
+    parc = activationBilateral(hemiParc).getParcellation()
+
+    for p in [parc, parc.getHemisphereParcellation('lh'), parc.getHemisphereParcellation('rh')]:
+        assert p.getCurrentMatplotlibColormapConfig() == (True, 'viridis')
+        assert p.lutres == 256
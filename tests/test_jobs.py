@@ -0,0 +1,139 @@
+# Tests of the job runner of the tksurfer calls (c.f. jobs.py) and of
+# the concurrent tksurfer exports built on it, using the stand-in
+# tksurfer of tests/bin
+
+import os
+import shutil
+import pytest
+from conftest import readTksurferLog
+from activationmaps.jobs import splitCommand, jobRunner
+from activationmaps.activations import activationDesikanKilliany
+from activationmaps.exporting import fsVisualizeActivation, frameCache
+
+
+# ------------
+def test_split_command():
+    env, args = splitCommand("LD_PRELOAD=/opt/matlab/sys/opengl/lib/glnxa64/libGL.so.1 SUBJECTS_DIR='/my subjects/' "
+                             "tksurfer bert lh pial -annotation '/tmp/a b.annot'")
+
+    assert env == {'LD_PRELOAD': '/opt/matlab/sys/opengl/lib/glnxa64/libGL.so.1', 'SUBJECTS_DIR': '/my subjects/'}
+    assert args == ['tksurfer', 'bert', 'lh', 'pial', '-annotation', '/tmp/a b.annot']
+
+    # only leading assignments are environment variables
+    env, args = splitCommand(['tksurfer', 'X=1'])
+    assert env == {} and args == ['tksurfer', 'X=1']
+
+# ------------
+def test_run_passes_the_environment(tksurferLog, subjectPath):
+    result = jobRunner().run(f"PYSURFING_PRELOAD=/opt/libGL.so.1 SUBJECTS_DIR={subjectPath} tksurfer synth lh pial")
+
+    assert result.succeeded() and result.attempts == 1
+    assert readTksurferLog(tksurferLog) == [f"SUBJECTS_DIR={subjectPath} PYSURFING_PRELOAD=/opt/libGL.so.1 synth lh pial"]
+
+# ------------
+def test_run_nonzero_exit(tksurferLog, subjectPath, monkeypatch):
+    monkeypatch.setenv('TKSURFER_EXIT', '3')
+    result = jobRunner().run(f"SUBJECTS_DIR={subjectPath} tksurfer synth lh pial")
+
+    assert not result.succeeded()
+    assert result.returncode == 3 and not result.timedOut
+    assert 'status 3' in result.stderr
+
+# ------------
+def test_run_missing_program():
+    result = jobRunner().run("no-such-program-pysurfing")
+
+    assert not result.succeeded()
+    assert result.returncode is None and result.stderr != ''
+
+# ------------
+def test_run_timeout(tksurferLog, subjectPath, monkeypatch):
+    monkeypatch.setenv('TKSURFER_SLEEP', '5')
+    result = jobRunner(timeout=0.3).run(f"SUBJECTS_DIR={subjectPath} tksurfer synth lh pial")
+
+    assert result.timedOut and result.returncode is None
+    assert result.elapsed < 4
+
+# ------------
+def test_run_retries(tksurferLog, subjectPath, monkeypatch):
+    monkeypatch.setenv('TKSURFER_FAILURES', '2')
+    command = f"SUBJECTS_DIR={subjectPath} tksurfer synth lh pial"
+
+    result = jobRunner(retries=1).run(command)
+    assert not result.succeeded() and result.attempts == 2
+
+    # the third call succeeds; the per-call override wins
+    os.remove(tksurferLog + '.count')
+    result = jobRunner(retries=0).run(command, retries=2)
+    assert result.succeeded() and result.attempts == 3
+
+# ------------
+def test_run_without_capture(tksurferLog, subjectPath, monkeypatch, capfd):
+    monkeypatch.setenv('TKSURFER_EXIT', '3')
+    result = jobRunner().run(f"SUBJECTS_DIR={subjectPath} tksurfer synth lh pial", capture=False)
+
+    assert result.returncode == 3 and result.stderr == ''
+    assert 'status 3' in capfd.readouterr().err
+
+# ------------
+def test_run_all(tksurferLog, subjectPath):
+    with jobRunner(maxWorkers=3) as runner:
+        results = runner.runAll([f"SUBJECTS_DIR={subjectPath} tksurfer synth {h} pial" for h in ['lh', 'rh', 'xx', 'lh']])
+
+    assert [r.succeeded() for r in results] == [True] * 4
+    assert len(readTksurferLog(tksurferLog)) == 4
+
+# ------------
+def _getVisualizer(subjectPath):
+    vis = fsVisualizeActivation(banner=False)
+    vis.setFreesurferPath('/usr/local/freesurfer')
+    vis.setFreesurferSubjectPath(subjectPath)
+    vis.setFreesurferSubjectName('synth')
+    vis.setAnnotationCacheDirectory(None)
+    return vis
+
+# ------------
+def test_submit_hemisphere_activation(tksurferLog, subjectPath, tmp_path):
+    vis = _getVisualizer(subjectPath)
+    vis.setWorkspaceDirectory(str(tmp_path))
+    actv = activationDesikanKilliany('Left')
+    actv.setActivationOrder(1, 2, 3, 4)
+
+    result = vis.submitHemisphereActivation(actv, 'Left', True, str(tmp_path / 'frame')).result(timeout=30)
+
+    assert result.succeeded()
+    assert os.path.exists(str(tmp_path / 'frame.tiff'))
+    assert readTksurferLog(tksurferLog)[0].endswith(f"save_tiff {tmp_path / 'frame.tiff'}")
+
+    # the workspace of the annotation was removed
+    assert [name for name in os.listdir(str(tmp_path)) if name.startswith('pysurfing-')] == []
+
+# ------------
+def test_interactive_session_is_not_captured(tksurferLog, subjectPath, monkeypatch, capfd):
+    monkeypatch.setenv('TKSURFER_EXIT', '3')
+    vis = _getVisualizer(subjectPath)
+
+    result = vis.visualizeHemisphereActivation(activationDesikanKilliany('Left'))
+
+    assert result.returncode == 3 and result.stderr == ''
+    assert 'status 3' in capfd.readouterr().err
+
+# ------------
+def test_failed_cleanup_resolves_the_future(tksurferLog, subjectPath, tmp_path, monkeypatch):
+    monkeypatch.setenv('TKSURFER_SLEEP', '0.5')
+    vis = _getVisualizer(subjectPath)
+    vis.setFrameCache(frameCache(str(tmp_path / 'cache')))
+    actv = activationDesikanKilliany('Left')
+
+    # the cache directory disappears while tksurfer runs, so storing
+    # the image in the done-callback fails
+    done = vis.submitHemisphereActivation(actv, 'Left', True, str(tmp_path / 'frame'))
+    shutil.rmtree(str(tmp_path / 'cache'))
+
+    with pytest.raises(OSError):
+        done.result(timeout=30)
+
+    # the next, unchanged, frame does not wait forever either
+    done = vis.submitHemisphereActivation(actv, 'Left', True, str(tmp_path / 'next'))
+    assert done.result(timeout=30) is None
+    assert os.path.exists(str(tmp_path / 'next.tiff'))
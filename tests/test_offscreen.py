@@ -0,0 +1,100 @@
+# Tests of the surface reader/writer and of the headless off-screen
+# renderer (c.f. exporting.offscreenVisualizeActivation) on a small
+# synthetic mesh
+
+import os
+import numpy as np
+from conftest import getOctahedron
+from activationmaps.freesurfer import readSurface, writeSurface
+from activationmaps.activations import activationDesikanKilliany
+from activationmaps.exporting import offscreenVisualizeActivation, fsVisualizeActivation
+
+
+# ------------
+def test_surface_round_trip(tmp_path):
+    coords, faces = getOctahedron()
+    filename = str(tmp_path / 'lh.pial')
+
+    writeSurface(filename, coords, faces)
+    rc, rf = readSurface(filename)
+
+    assert np.array_equal(rc, coords)
+    assert np.array_equal(rf, faces)
+    assert rc.dtype == np.float64 and rf.dtype == np.int64
+
+# ------------
+def _getRenderer(subjectPath):
+    vis = offscreenVisualizeActivation()
+    vis.setFreesurferSubjectPath(subjectPath)
+    vis.setFreesurferSubjectName('synth')
+    vis.setAnnotationCacheDirectory(None)
+    vis.setImageOptions(64, 48)
+    return vis
+
+# ------------
+def _getActivation():
+    actv = activationDesikanKilliany('Left')
+    parc = actv.getParcellation()
+    rgb = np.zeros((parc.getNumberOfRegions(), 3), dtype=np.uint8)
+    rgb[:, 0] = np.arange(parc.getNumberOfRegions())
+    parc.setRGBArray(rgb)
+    return actv
+
+# ------------
+def test_vertex_rgb(subjectPath):
+    vis = _getRenderer(subjectPath)
+    actv = _getActivation()
+    parc = actv.getParcellation()
+
+    rgb = vis.getVertexRGB(actv, 'lh', 6)
+    regions = ['bankssts', 'cuneus', 'insula', 'precuneus', 'bankssts']
+
+    for v, region in enumerate(regions):
+        assert tuple(rgb[v]) == tuple(parc.getRegionRGB(parc.getRegionToIndexMap()[region]))
+
+    # the vertex without a structure takes the default color
+    assert tuple(rgb[5]) == tuple(parc.getDefaultRGB())
+
+# ------------
+def test_render_hemisphere_activation(subjectPath, tmp_path):
+    vis = _getRenderer(subjectPath)
+    actv = _getActivation()
+    saveAs = str(tmp_path / 'frame')
+
+    written = vis.renderHemisphereActivation(actv, saveAs, 'Left', ['lateral', 'medial', 'nosuchview'])
+
+    assert written == [saveAs + '_lateral.png', saveAs + '_medial.png']
+    for filename in written:
+        with open(filename, 'rb') as ifile:
+            assert ifile.read(8) == b'\x89PNG\r\n\x1a\n'
+
+    # an unchanged frame is copied rather than rendered again
+    copies = vis.renderHemisphereActivation(actv, str(tmp_path / 'again'), 'Left', ['lateral', 'medial'])
+    assert all(os.path.exists(f) for f in copies)
+
+# ------------
+def test_render_without_freesurfer(subjectPath, tmp_path):
+    # the off-screen path of the tksurfer exporter needs no Freesurfer
+    # installation, so the Freesurfer path is not set
+    vis = fsVisualizeActivation(banner=False)
+    vis.setFreesurferSubjectPath(subjectPath)
+    vis.setFreesurferSubjectName('synth')
+    vis.setAnnotationCacheDirectory(None)
+
+    assert vis.isReady()
+    written = vis.renderHemisphereActivation(_getActivation(), str(tmp_path / 'frame'), views=['lateral'])
+    assert written == [str(tmp_path / 'frame_lateral.png')] and os.path.exists(written[0])
+
+# ------------
+def test_annotation_does_not_match_surface(subjectPath, tmp_path, capsys):
+    # a surface with fewer vertices than the annotation labels
+    coords, faces = getOctahedron()
+    writeSurface(os.path.join(subjectPath, 'synth', 'surf', 'lh.pial'), coords[:4], faces[:1] % 4)
+
+    vis = _getRenderer(subjectPath)
+    actv = _getActivation()
+
+    assert vis.getVertexRGB(actv, 'lh', 4) is None
+    assert 'does not match the surface' in capsys.readouterr().out
+    assert vis.renderHemisphereActivation(actv, str(tmp_path / 'frame'), 'Left', ['lateral']) == []
+    assert not os.path.exists(str(tmp_path / 'frame_lateral.png'))
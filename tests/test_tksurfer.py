@@ -0,0 +1,117 @@
+# Tests of the tcl scripts and sessions of the tksurfer series exports
+# (c.f. exporting.saveHemisphereActivationSeries), using the stand-in
+# tksurfer of tests/bin
+
+import os
+import numpy as np
+import pytest
+from conftest import readTksurferLog
+from activationmaps.activations import activationDesikanKilliany
+from activationmaps.exporting import fsVisualizeActivation, getTksurferScript
+
+
+# ------------
+def test_tksurfer_script():
+    script = getTksurferScript([('/ws/lh.0000.annot.vis', {'lateral': '/out/f_0000_lateral.tiff',
+                                                           'medial': '/out/f_0000_medial.tiff'}),
+                                ('/ws/my "odd" $name[1].annot', {'dorsal': '/out/f_0001_dorsal.tiff'})])
+
+    assert script.split('\n') == ['labl_remove_all',
+                                  'labl_import_annotation "/ws/lh.0000.annot.vis"',
+                                  'make_lateral_view',
+                                  'redraw',
+                                  'save_tiff "/out/f_0000_lateral.tiff"',
+                                  'make_lateral_view',
+                                  'rotate_brain_y 180',
+                                  'redraw',
+                                  'save_tiff "/out/f_0000_medial.tiff"',
+                                  'labl_remove_all',
+                                  'labl_import_annotation "/ws/my \\"odd\\" \\$name\\[1\\].annot"',
+                                  'make_lateral_view',
+                                  'rotate_brain_x 90',
+                                  'redraw',
+                                  'save_tiff "/out/f_0001_dorsal.tiff"',
+                                  'exit',
+                                  '']
+
+# ------------
+def _getVisualizer(subjectPath):
+    vis = fsVisualizeActivation(banner=False)
+    vis.setFreesurferPath('/usr/local/freesurfer')
+    vis.setFreesurferSubjectPath(subjectPath)
+    vis.setFreesurferSubjectName('synth')
+    vis.setAnnotationCacheDirectory(None)
+    return vis
+
+# ------------
+# A 5 frame series whose frame 2 repeats frame 1
+def _getSeries():
+    series = np.zeros((5, 36))
+    for t in range(5):
+        series[t, :4 * t + 1] = 1.0
+    series[2] = series[1]
+    return series
+
+# ------------
+def _save(vis, actv, saveAs, method, **options):
+    frames = actv.iterateSimulationFrames(_getSeries(), 0.0, 1.0)
+
+    if method == 'session':
+        return vis.saveHemisphereActivationSeries(actv, frames, saveAs, 'Left', ['lateral', 'medial'], **options)
+
+    return vis.pipelineHemisphereActivationSeries(actv, frames, saveAs, 'Left', ['lateral', 'medial'])
+
+# ------------
+@pytest.mark.parametrize('method', ['session', 'pipeline'])
+def test_series(tksurferLog, subjectPath, tmp_path, method):
+    vis = _getVisualizer(subjectPath)
+    actv = activationDesikanKilliany('Left')
+    saveAs = str(tmp_path / 'run')
+
+    written = _save(vis, actv, saveAs, method)
+
+    assert written == [f"{saveAs}_{t:04d}_{view}.tiff" for t in range(5) for view in ['lateral', 'medial']]
+    assert all(os.path.exists(image) for image in written)
+
+    # the repeated frame is copied rather than passed to tksurfer
+    calls = readTksurferLog(tksurferLog)
+    assert len(calls) == (1 if method == 'session' else 4)
+    assert all(call.startswith(f"SUBJECTS_DIR={subjectPath}/ ") and ' synth lh pial -tcl ' in call for call in calls)
+
+    with open(f"{saveAs}_0001_lateral.tiff", 'rb') as a, open(f"{saveAs}_0002_lateral.tiff", 'rb') as b:
+        assert a.read() == b.read()
+
+# ------------
+def test_series_batches(tksurferLog, subjectPath, tmp_path):
+    vis = _getVisualizer(subjectPath)
+    written = _save(vis, activationDesikanKilliany('Left'), str(tmp_path / 'run'), 'session', batchSize=3)
+
+    assert len(written) == 10
+    assert len(readTksurferLog(tksurferLog)) == 2
+
+# ------------
+@pytest.mark.parametrize('method', ['session', 'pipeline'])
+def test_failed_session(tksurferLog, subjectPath, tmp_path, monkeypatch, capsys, method):
+    monkeypatch.setenv('TKSURFER_EXIT', '1')
+    vis = _getVisualizer(subjectPath)
+
+    written = _save(vis, activationDesikanKilliany('Left'), str(tmp_path / 'run'), method)
+
+    assert written == []
+    assert 'frame(s) of the series were not saved: [0, 1, 2, 3, 4]' in capsys.readouterr().out
+
+# ------------
+@pytest.mark.parametrize('method', ['session', 'pipeline'])
+def test_missing_images(tksurferLog, subjectPath, tmp_path, monkeypatch, capsys, method):
+    # tksurfer "succeeds" without saving frame 1, so frame 2 (a copy
+    # of frame 1) is missing as well
+    monkeypatch.setenv('TKSURFER_SKIP', 'run_0001_medial')
+    vis = _getVisualizer(subjectPath)
+    saveAs = str(tmp_path / 'run')
+
+    written = _save(vis, activationDesikanKilliany('Left'), saveAs, method)
+
+    assert f"{saveAs}_0001_medial.tiff" not in written
+    assert f"{saveAs}_0002_medial.tiff" not in written
+    assert len(written) == 8 and all(os.path.exists(image) for image in written)
+    assert 'frame(s) of the series were not saved: [1, 2]' in capsys.readouterr().out